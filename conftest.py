@@ -0,0 +1,6 @@
+# pytest configuration
+
+# gripper_serialcom_timing_test.py and gripper_load_test.py are benchmark
+# scripts, not tests, but their names match pytest's *_test.py pattern.
+# The tests are the test_*.py files.
+collect_ignore_glob = ['gripper_*.py']
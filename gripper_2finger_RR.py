@@ -1,192 +1,1075 @@
 # Connect to Robotiq 2-finger gripper via Robot Racontuer
 
-# NOTE: This script accepts a single argument as the communication port.
-# If a number is not provided, the default value will be used.
+# NOTE: This script accepts a single argument as the communication port
+# (a COM port number or a device name such as /dev/ttyUSB0).
+# If a port is not provided, the default value will be used.
+# Further options are given as name=value arguments (see OPTIONS below),
+# e.g. "python gripper_2finger_RR.py 3 poll_rate=50".
 
 import serial
-import time
-import binascii
 import sys
 import RobotRaconteur as RR
-import thread
 import threading
 import os
+import numpy
+import gripper_protocol
+import gripper_serial
+from gripper_serial import activate
+import gripper_poller
+import gripper_commands
+import gripper_bus
+import gripper_transport
+import gripper_metrics
+import gripper_telemetry
+import gripper_shared_state
+import gripper_watchdog
+import gripper_calibration
+from gripper_options import parse_options, is_port, port_name
 
-def crc_comp(data_str):
-    # Generate cyclic redundancy check for modbus RTU protocol
-    # Inputs:
-        # data_str: data message as a string (in hex)
-    # Outputs:
-        # crc: cyclic redundancy check as a string (in hex)
-        # NOTE: message must be re-arranged so that lowest byte is sent first
-    data = bytearray.fromhex(data_str)
-    crc = 0xFFFF
-    for pos in data:
-        crc ^= pos
-        for i in range(8):
-            if ((crc & 1) !=0):
-                crc >>=1
-                crc ^= 0xA001
-            else:
-                crc >>=1
-    return("%04X"%(crc))
+try:
+    input = raw_input # Python 2: input() would evaluate the line
+except NameError:
+    pass
+
+# Options and their defaults; override with name=value arguments
+# poll_rate: status polling rate in Hz (0 reads the gripper on every get call,
+#   auto measures the bus at startup). Polled samples also feed the state
+#   wire and state_stream pipe.
+# stream_rate: with poll_rate=0, polling rate in Hz while state wire or
+#   state_stream clients are connected (0 for none, auto measures the bus
+#   when the first client connects)
+# grippers: comma separated port:slave_id entries to serve several grippers
+#   from one process, e.g. grippers=3:9,3:10,4:9 (slave ID defaults to 9).
+#   Grippers on the same port share the line. Empty serves one gripper on
+#   the comm port argument.
+# metrics: record per-operation latency metrics (getMetrics, getMetricsText)
+# telemetry: log file recording every state sample and command (empty for
+#   none); with several grippers the index of the entry in grippers is
+#   added to the name, e.g. telemetry=run.tlm writes run0.tlm, run1.tlm, ...
+# telemetry_buffer: telemetry ring buffer size in records
+# read_deadline: seconds a status read may wait behind other requests on
+#   the bus before it is dropped and the call fails (0 waits indefinitely)
+# retries: attempts after a missing or corrupted reply before a call fails
+# reply_timeout: seconds the gripper may take to start a reply before the
+#   request is retried
+# suppress: skip setPosition writes that repeat the last command while the
+#   gripper is following it (setPositionForced always writes)
+# deadband: also skip setpoints within this many position counts of the
+#   last command sent (0 only skips exact repeats)
+# shared_state: shared-memory file the latest state is published to for
+#   local readers (empty for none; see gripper_shared_state), e.g.
+#   shared_state=/dev/shm/gripper.state; with several grippers the index
+#   of the entry in grippers is added to the name as for telemetry
+# transports: comma separated Robot Raconteur transports to serve on: tcp
+#   (port tcp_port), local (clients on this host, by node name) and intra
+#   (clients in the same process, see gripper_service)
+# tcp_port: port of the tcp transport
+# reconnect: reopen a failed serial line without restarting (see
+#   gripper_watchdog); calls fail at once while the line is down
+# failure_limit: failed transactions in a row that take a gripper offline
+#   (its calls fail at once while the others keep the line); the line
+#   counts as failed once every gripper on it is failing
+# max_backoff: longest wait in seconds between attempts to reopen the port
+# calibration: calibration file from gripper_calibration.py (empty for the
+#   nominal curves); with several grippers the index of the entry in
+#   grippers is added to the name, e.g. cal.json reads cal0.json, cal1.json, ...
+OPTIONS = {'poll_rate': '0', 'stream_rate': 'auto', 'grippers': '', 'metrics': True,
+    'telemetry': '', 'telemetry_buffer': 65536, 'calibration': '', 'read_deadline': 0.0,
+    'retries': 2, 'reply_timeout': 0.02, 'suppress': True, 'deadband': 0, 'shared_state': '',
+    'transports': 'tcp,local,intra', 'tcp_port': 6006,
+    'reconnect': True, 'failure_limit': 3, 'max_backoff': 5.0}
+
+NODE_NAME = "GripperController"
+SERVICE_TYPE = "edu.rpi.gripper.gripcon"
+TRANSPORTS = ('tcp', 'local', 'intra')
+DEFAULT_TRANSPORTS = OPTIONS['transports']
+TCP_PORT = OPTIONS['tcp_port']
 
-def activate(gripper,gripper_connected):
-    # This function activates the gripper and moves the gripper to an
-    # open position.
+def gripper_state_struct(state, cal):
+    # Copy a decoded gripper_state into a GripperState RR structure
     # Inputs:
-        # gripper: gripper serial communication
-        # gripper_connected: boolean checking that connection was successful
-        #
+        # state: gripper_protocol.gripper_state
+        # cal: gripper_calibration.calibration for the physical units
     # Outputs:
-        # gripper_activated: boolean stating whether activation was successful or not
-    if gripper_connected:
-        print("Activating gripper...")
-        gripper.write(bytearray.fromhex("091003E80003060000000000007330")) # clear rAct
-        time.sleep(0.01)
-        gripper.write(bytearray.fromhex("091003E800030601000000000072E1")) # activate 
-        time.sleep(0.01)
-        data = gripper.readline() # read entire line to clear all data
-
-        # Wait until activation has completed
-        timeout = 10
-        gripper_activated = False
-        t_start = time.time()
-        t = time.time()-t_start
-        while (t<timeout)&(not gripper_activated):
-            gripper.write(bytearray.fromhex("090307D0000185CF")) # read data
-            data = binascii.hexlify(gripper.readline())
-            if int(data[6])==3:
-                gripper_activated = True
-                print("Gripper activated!")
-            time.sleep(0.5)
-            t = time.time()-t_start
-        if not gripper_activated:
-            print("Activation timed out.")
-        return gripper_activated
-    else:
-        gripper_activated = False
-        return gripper_activated
+        # s: edu.rpi.gripper.GripperState
+            # position: position as fraction of 255 (0 fully open, 255 closed)
+            # current: current in mA
+            # position_request: echo of the commanded position
+            # object_status: gOBJ (0 moving, 1 object found opening, 2 object found closing, 3 at position)
+            # fault: fault status byte (0 no fault)
+            # activation_status: gSTA (0 reset, 1 activating, 3 activated)
+            # timestamp: server monotonic time of the read in seconds
+            # position_mm: finger opening in mm
+            # force_n: grip force in N estimated from the current
+    s = RR.RobotRaconteurNode.s.NewStructure("edu.rpi.gripper.GripperState")
+    s.position = state.position
+    s.current = float(state.current)
+    s.position_request = state.position_echo
+    s.object_status = state.gOBJ
+    s.fault = state.fault
+    s.activation_status = state.gSTA
+    s.timestamp = state.timestamp
+    s.position_mm = cal.mm(state.position)
+    s.force_n = cal.newtons(state.current)
+    return s
+
+class state_broadcaster:
+    # Sends each polled state to every connected state wire and state_stream pipe
+    def __init__(self, cal):
+        self.calibration = cal
+        self._lock = threading.Lock()
+        self._wires = {}
+        self._pipes = {}
+        self.on_subscribers = None # called when the first subscriber connects or the last leaves
+        self.samples = 0
+        self.send_errors = 0
+    def subscribers(self):
+        return len(self._wires)+len(self._pipes)
+    def _changed(self, before):
+        on_subscribers = self.on_subscribers
+        if on_subscribers is not None and (before == 0) != (self.subscribers() == 0):
+            on_subscribers()
+    def wireConnect(self, wire):
+        with self._lock:
+            before = self.subscribers()
+            self._wires[wire.Endpoint] = wire
+        wire.WireConnectionClosedCallback = self.wireClosed
+        self._changed(before)
+    def wireClosed(self, wire):
+        with self._lock:
+            before = self.subscribers()
+            self._wires.pop(wire.Endpoint, None)
+        self._changed(before)
+    def pipeConnect(self, pipe):
+        with self._lock:
+            before = self.subscribers()
+            self._pipes[(pipe.Endpoint, pipe.Index)] = pipe
+        pipe.PipeEndpointClosedCallback = self.pipeClosed
+        self._changed(before)
+    def pipeClosed(self, pipe):
+        with self._lock:
+            before = self.subscribers()
+            self._pipes.pop((pipe.Endpoint, pipe.Index), None)
+        self._changed(before)
+    def publish(self, state):
+        # Poller listener: build the structure once and send it to everyone
+        if not self._wires and not self._pipes:
+            return
+        s = gripper_state_struct(state, self.calibration)
+        with self._lock:
+            wires = list(self._wires.values())
+            pipes = list(self._pipes.values())
+        for wire in wires:
+            try:
+                wire.OutValue = s
+            except Exception:
+                self.send_errors += 1
+                self.wireClosed(wire)
+        for pipe in pipes:
+            try:
+                pipe.SendPacket(s)
+            except Exception:
+                self.send_errors += 1
+                self.pipeClosed(pipe)
+        self.samples += 1
 
-class gripper_imp:
+class gripper_imp(object):
     # Object implementation of gripper control
-    def __init__(self,gripper):
-        self._lock = threading.RLock()
-        self._gripper = gripper
-    def setPosition(self, position, speed, force):
+    def __init__(self,gripper,slave_id=gripper_protocol.SLAVE_ID,metrics=True,calibration=None,
+            read_deadline=0.0, suppress=True, deadband=0, index=None):
+        # Inputs:
+            # gripper: gripper serial communication, or a gripper_bus.bus
+                # shared with other grippers on the same line
+            # slave_id: modbus slave ID of this gripper
+            # metrics: record latency metrics (see gripper_metrics)
+            # calibration: gripper_calibration.calibration (None for nominal)
+            # read_deadline: seconds a status read may wait for the bus before
+                # it is dropped with gripper_bus.request_expired (0 waits)
+            # suppress, deadband: redundant setpoint suppression (see setPosition)
+            # index: index of the entry in the grippers option, which numbers
+                # the service and files of this gripper (None when only one
+                # gripper is configured)
+        if not isinstance(gripper, gripper_bus.bus):
+            gripper = gripper_bus.bus(gripper)
+        self._bus = gripper
+        self._gripper = gripper.gripper
+        self._slave_id = slave_id
+        self.index = index
+        self._lock = gripper.access(slave_id) # this gripper's turn on the line
+        self._frames = gripper_protocol.frames(slave_id)
+        self._commands = gripper_protocol.command_builder(slave_id) # only used during our turn
+        self._read_deadline = read_deadline
+        self._poller = None
+        self._polling_lock = threading.Lock()
+        self._streaming = False # polling only for state wire and state_stream clients
+        # polling rate in Hz while there are such clients and no other
+        # polling (0 for none, None to measure the bus on the first client)
+        self.stream_rate = 0.0
+        if calibration is None:
+            calibration = gripper_calibration.calibration()
+        self._calibration = calibration
+        self._broadcaster = state_broadcaster(calibration)
+        self._broadcaster.on_subscribers = self._subscribersChanged
+        self._state_wire = None
+        self._state_stream = None
+        self._command_wire = None
+        self._writer = None
+        self._writer_lock = threading.Lock() # NOT the bus, which is held during writes
+        self._metrics_registry = gripper_metrics.registry()
+        self._metrics = None # the registry while metrics are on, checked on the hot path
+        self.enableMetrics(metrics)
+        self._recorder = None
+        self._shared_state = None
+        # redundant setpoint suppression
+        self._suppress = suppress
+        self._deadband = deadband
+        self._command_lock = threading.RLock() # held by setPosition, and recover()
+        self._last_command = None # (position, speed, force) last acknowledged
+        self._last_sent_at = 0.0
+        self._last_state = None # latest state read, polled or not
+        self._setpoint = None # last acknowledged command, restored by recover()
+        self._sent = 0
+        self._duplicates = 0 # suppressed repeats of the last command
+        self._deadband_skips = 0 # suppressed setpoints within the deadband
+    # state wire and state_stream pipe, set by Robot Raconteur on registration.
+    # Both are fed by the poller; without polling, the first client to
+    # connect starts it at stream_rate and the last to leave stops it.
+    @property
+    def state(self):
+        return self._state_wire
+    @state.setter
+    def state(self, wire):
+        self._state_wire = wire
+        wire.WireConnectCallback = self._broadcaster.wireConnect
+    @property
+    def state_stream(self):
+        return self._state_stream
+    @state_stream.setter
+    def state_stream(self, pipe):
+        self._state_stream = pipe
+        pipe.PipeConnectCallback = self._broadcaster.pipeConnect
+    # command wire, set by Robot Raconteur on registration. Values sent by
+    # clients are queued with queueSetPosition (latest wins).
+    @property
+    def command(self):
+        return self._command_wire
+    @command.setter
+    def command(self, wire):
+        self._command_wire = wire
+        wire.WireConnectCallback = self._commandConnect
+    def _commandConnect(self, wire):
+        wire.WireValueChanged += self._commandChanged
+    def _commandChanged(self, wire, value, time):
+        self.queueSetPosition(value.position, value.speed, value.force)
+    def setPosition(self, position, speed, force, always_send=False):
         # Set gripper position with specified speed and force
         # Inputs:
             # position: gripper position as a fraction of 255 (0 open, 255 closed)
             # speed: gripper speed as a fraction of 255 (0 slowest, 255 fastest)
             # force: gripper force as a fraction of 255 (0 min force, 255 max force)
-        with self._lock:
-            position = round(position)
-            speed = round(speed)
-            force = round(force)
-            if position<0:
-                position = 0
-            elif position>255:
-                position = 255
-            if speed<0:
-                speed = 0
-            elif speed>255:
-                speed = 255
-            if force<0:
-                force = 0
-            elif force>255:
-                force = 255
-            position = int(position)
-            speed = int(speed)
-            force = int(force)
-
-            command = "091003E8000306090000"+hex(position)[2:].zfill(2) + hex(speed)[2:].zfill(2) + hex(force)[2:].zfill(2)
-            crc = crc_comp(command)
-            command = command + crc[2]+crc[3]+crc[0]+crc[1]
-            self._gripper.write(bytearray.fromhex(command))
-            data = self._gripper.read(8)
+            # always_send: write even if the setpoint would be suppressed
+        # A setpoint repeating the last acknowledged command (or within the
+        # deadband of its position, at the same speed and force) is not
+        # written, unless a state read since that write shows the gripper
+        # is not following it (reset, fault, or a different position request).
+        # Raises gripper_protocol.protocol_error if the write is not
+        # acknowledged (no valid reply after every retry).
+        position = gripper_protocol.clamp_byte(position)
+        speed = gripper_protocol.clamp_byte(speed)
+        force = gripper_protocol.clamp_byte(force)
+        # one setpoint at a time, from the suppression check to recording
+        # its acknowledgement, so concurrent writers cannot record their
+        # commands out of order (the writes are serialized on the bus anyway)
+        with self._command_lock:
+            last = self._last_command
+            if last is not None and self._suppress and not always_send and speed == last[1] \
+                    and force == last[2] and abs(position-last[0]) <= self._deadband \
+                    and self._following(last[0]):
+                if position == last[0]:
+                    self._duplicates += 1
+                else:
+                    self._deadband_skips += 1
+                return
+            self._last_command = None # unknown until acknowledged
+            # the frame is built during our turn: self._commands is one shared buffer
+            command = lambda: self._commands.set_position(position, speed, force)
+            metrics = self._metrics
+            if metrics is None:
+                ack = self._bus.transact(self._slave_id, command, gripper_protocol.WRITE_ACK_LEN,
+                    gripper_bus.PRIORITY_COMMAND)
+            else:
+                ack = self._measured(metrics.operation('setPosition'), command,
+                    gripper_protocol.WRITE_ACK_LEN, gripper_bus.PRIORITY_COMMAND, None, False, None)
+            gripper_protocol.check_write_ack(ack, self._slave_id)
+            self._sent += 1
+            recorder = self._recorder
+            if recorder is not None:
+                recorder.record_command(position, speed, force)
+            self._last_sent_at = gripper_protocol.monotonic()
+            self._last_command = (position, speed, force)
+            self._setpoint = self._last_command
+    def setPositionForced(self, position, speed, force):
+        # setPosition that is always written to the gripper
+        self.setPosition(position, speed, force, True)
+    def _following(self, position):
+        # False if a state read after the last write shows the gripper is
+        # not executing a go-to to position
+        state = self._last_state
+        if state is None or state.timestamp < self._last_sent_at:
+            return True # nothing newer than the acknowledged write
+        return state.gSTA == 3 and state.gGTO == 1 and state.fault == 0 \
+            and state.position_echo == position
+    def setDeadband(self, deadband):
+        # Position counts within which a changed setpoint is not written (0 for exact repeats only)
+        self._deadband = deadband
+    def getSuppressionCounters(self):
+        # Outputs:
+            # counters: SuppressionCounters structure
+                # sent: setpoints written to and acknowledged by the gripper
+                # duplicates: repeats of the last command not written
+                # deadband: setpoints within the deadband not written
+                # bus_time_saved: suppressed setpoints times the mean
+                    # setPosition time (s; 0 when metrics are off)
+        c = RR.RobotRaconteurNode.s.NewStructure("edu.rpi.gripper.SuppressionCounters")
+        c.sent = self._sent
+        c.duplicates = self._duplicates
+        c.deadband = self._deadband_skips
+        c.bus_time_saved = 0.0
+        h = self._metrics_registry.operation('setPosition').phases[gripper_metrics.TOTAL]
+        n = h.samples()
+        if n:
+            c.bus_time_saved = (self._duplicates+self._deadband_skips)*h.sum/n
+        return c
+    def queueSetPosition(self, position, speed, force):
+        # Queue a setpoint without waiting for it to be written. A setpoint
+        # that has not been sent yet is replaced (coalesced) by a newer one.
+        # Inputs: as setPosition
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = gripper_commands.setpoint_writer(self.setPosition)
+                self._writer.start()
+        self._writer.put(gripper_protocol.clamp_byte(position),
+            gripper_protocol.clamp_byte(speed), gripper_protocol.clamp_byte(force))
+    def stopCommandWriter(self):
+        # Stop the queued setpoint writer thread (unsent setpoint is dropped)
+        with self._writer_lock:
+            writer = self._writer
+            self._writer = None
+        if writer is not None:
+            writer.stop()
+    def getCommandCounters(self):
+        # Queued setpoint counters
+        # Outputs:
+            # counters: CommandCounters structure (received, sent, coalesced, errors)
+        c = RR.RobotRaconteurNode.s.NewStructure("edu.rpi.gripper.CommandCounters")
+        writer = self._writer
+        if writer is not None:
+            c.received, c.sent, c.coalesced, c.errors = writer.counters()
+        else:
+            c.received = c.sent = c.coalesced = c.errors = 0
+        return c
+    def moveAndWait(self, position, speed, force, timeout):
+        # Move and wait on the server until the motion has finished
+        # Inputs:
+            # position, speed, force: as setPosition
+            # timeout: seconds to wait for the motion to finish
+        # Outputs:
+            # result: MoveResult structure
+                # outcome: 3 position reached, 2 object detected while closing,
+                    # 1 object detected while opening, 0 timed out while moving
+                # position, current, fault: final status
+                # duration: seconds from the command to the final status
+        position = gripper_protocol.clamp_byte(position)
+        speed = gripper_protocol.clamp_byte(speed)
+        t_start = gripper_protocol.monotonic()
+        distance = position-self.latestState().position
+        # always written: a setpoint in the deadband would never be echoed
+        self.setPosition(position, speed, force, True)
+        # sleep through most of the expected travel, then poll back to back
+        # until gPR echoes the command and gOBJ reports the motion finished
+        finished, state = gripper_serial.wait_for(lambda: self.readState('moveAndWait'),
+            lambda state: state.position_echo == position and state.gOBJ != 0,
+            timeout, interval=0.0, first_wait=0.8*gripper_protocol.travel_time(distance, speed))
+        if state is None:
+            state = self.readState()
+        r = RR.RobotRaconteurNode.s.NewStructure("edu.rpi.gripper.MoveResult")
+        r.outcome = state.gOBJ if finished else 0
+        r.position = state.position
+        r.current = float(state.current)
+        r.fault = state.fault
+        r.duration = gripper_protocol.monotonic()-t_start
+        return r
+    def grasp(self, speed, force, timeout):
+        # Close until an object is detected or the fingers are fully closed
+        # (see moveAndWait; outcome 2 means an object was grasped)
+        return self.moveAndWait(255, speed, force, timeout)
+    def executeTrajectory(self, times, positions, speeds, forces):
+        # Stream timed waypoints to the gripper from the server
+        # Inputs:
+            # times: waypoint times in seconds from the start (non-decreasing)
+            # positions, speeds, forces: waypoint values as fractions of 255
+        # Outputs:
+            # result: TrajectoryResult structure with per-waypoint send time,
+                # lateness and write time (s), the position read just before
+                # the next waypoint was due (for the last waypoint, after its
+                # expected travel time), and the number of missed deadlines
+        result = gripper_commands.execute_trajectory(times, positions, speeds, forces,
+            self.setPosition, lambda: self.latestState().position)
+        r = RR.RobotRaconteurNode.s.NewStructure("edu.rpi.gripper.TrajectoryResult")
+        r.send_time = numpy.array(result['send_time'], dtype=numpy.float64)
+        r.lateness = numpy.array(result['lateness'], dtype=numpy.float64)
+        r.write_time = numpy.array(result['write_time'], dtype=numpy.float64)
+        r.position_reached = numpy.array(result['position_reached'], dtype=numpy.uint8)
+        r.deadline_misses = result['deadline_misses']
+        return r
+    def readState(self, operation='readState'):
+        # Read the full gripper status block in one transaction
+        # Inputs:
+            # operation: name the read is recorded under in the metrics
+        # Outputs:
+            # state: gripper_protocol.gripper_state (position, current, status bits)
+        # reads give way to queued commands and merge with an identical queued read
+        deadline = None
+        if self._read_deadline > 0:
+            deadline = gripper_protocol.monotonic()+self._read_deadline
+        metrics = self._metrics
+        if metrics is None:
+            data = self._bus.transact(self._slave_id, self._frames.read_status,
+                gripper_protocol.STATUS_REPLY_LEN, gripper_bus.PRIORITY_READ, deadline, True)
+            state = gripper_protocol.decode_status(data, self._slave_id, gripper_protocol.monotonic())
+        else:
+            state = self._measured(metrics.operation(operation), self._frames.read_status,
+                gripper_protocol.STATUS_REPLY_LEN, gripper_bus.PRIORITY_READ, deadline, True,
+                lambda data, t: gripper_protocol.decode_status(data, self._slave_id, t))
+        self._last_state = state
+        recorder = self._recorder
+        if recorder is not None:
+            recorder.record_state(state)
+        shared_state = self._shared_state
+        if shared_state is not None:
+            shared_state.publish(state)
+        return state
+    def _measured(self, op, request, reply_len, priority, deadline, merge, decode):
+        # One bus transaction recorded in op's phase histograms
+        # Inputs:
+            # op: gripper_metrics.operation
+            # request, reply_len, priority, deadline, merge: as gripper_bus.bus.transact
+            # decode: function of (reply, read time) returning the result, or None
+        clock = gripper_protocol.monotonic
+        phases = op.phases
+        op.count += 1
+        t0 = clock()
+        timed_out = False
+        try:
+            times = [None, None, None]
+            try:
+                data = self._bus.transact(self._slave_id, request, reply_len, priority,
+                    deadline, merge, times)
+            except gripper_bus.request_expired:
+                timed_out = True
+                op.timeouts += 1
+                raise
+            t1, t2, t3 = times
+            if t1 is None:
+                # answered by an identical queued read: no phases of our own
+                op.merged += 1
+                t3 = clock()
+            else:
+                phases[gripper_metrics.LOCK_WAIT].record(t1-t0)
+                phases[gripper_metrics.WRITE].record(t2-t1)
+                phases[gripper_metrics.READ].record(t3-t2)
+            if len(data) < reply_len:
+                timed_out = True
+                op.timeouts += 1
+            if decode is None:
+                return data
+            result = decode(data, t3)
+            phases[gripper_metrics.DECODE].record(clock()-t3)
+            return result
+        except Exception:
+            if not timed_out:
+                op.errors += 1
+            raise
+        finally:
+            phases[gripper_metrics.TOTAL].record(clock()-t0)
+    def activate(self, timeout=10):
+        # Activate the gripper unless it already is active (see gripper_serial.activate)
+        # Outputs:
+            # gripper_activated: boolean stating whether activation was successful or not
+        metrics = self._metrics
+        if metrics is None:
+            with self._lock:
+                return activate(self._gripper, True, timeout, self._slave_id)
+        op = metrics.operation('activate')
+        op.count += 1
+        t0 = gripper_protocol.monotonic()
+        try:
+            with self._lock:
+                op.phases[gripper_metrics.LOCK_WAIT].record(gripper_protocol.monotonic()-t0)
+                activated = activate(self._gripper, True, timeout, self._slave_id)
+        except Exception:
+            op.errors += 1
+            raise
+        finally:
+            op.phases[gripper_metrics.TOTAL].record(gripper_protocol.monotonic()-t0)
+        if not activated:
+            op.timeouts += 1
+        return activated
+    def recover(self):
+        # Bring the gripper back after its serial line was reopened or it
+        # went offline (called by gripper_watchdog): activate it only if the
+        # status register shows it lost activation, then resend the last
+        # acknowledged setpoint
+        # Outputs:
+            # recovered: False if the gripper did not answer, or activation
+                # or the setpoint write failed
+        try:
+            self.readState('recover')
+        except (gripper_protocol.protocol_error, gripper_transport.link_down):
+            return False # not answering: fail now rather than wait out an activation
+        if not self.activate():
+            return False
+        with self._command_lock: # no setpoint may be acknowledged in between
+            setpoint = self._setpoint
+            if setpoint is not None:
+                try:
+                    self.setPositionForced(*setpoint)
+                except gripper_protocol.protocol_error:
+                    return False # not acknowledged
+        return True
+    def getConnectionStatus(self):
+        # State of the serial line and its reconnections (see gripper_watchdog)
+        # Outputs:
+            # status: ConnectionStatus structure
+                # online: 0 while the line is down or this gripper is
+                    # offline, and its calls fail at once
+                # down_for: seconds the line has been down (0 while up)
+                # disconnects, reconnects, attempts, failed_attempts: counters
+                # last_reconnect_time, max_reconnect_time, mean_reconnect_time:
+                    # seconds from failure to recovery
+                # last_error: why the last reopen attempt failed
+        c = RR.RobotRaconteurNode.s.NewStructure("edu.rpi.gripper.ConnectionStatus")
+        w = self._bus.watchdog
+        if w is None:
+            c.online = 1
+            c.down_for = 0.0
+            c.disconnects = c.reconnects = c.attempts = c.failed_attempts = 0
+            c.last_reconnect_time = c.max_reconnect_time = c.mean_reconnect_time = 0.0
+            c.last_error = ''
+            return c
+        h = w.reconnect_times
+        c.online = 1 if w.online(self._slave_id) else 0
+        c.down_for = w.down_for()
+        c.disconnects = w.disconnects
+        c.reconnects = w.reconnects
+        c.attempts = w.attempts
+        c.failed_attempts = w.failed_attempts
+        c.last_reconnect_time = w.last_reconnect_time
+        c.max_reconnect_time = h.max
+        c.mean_reconnect_time = h.sum/h.samples() if h.samples() else 0.0
+        c.last_error = w.last_error
+        return c
+    def enableMetrics(self, enabled):
+        # Switch latency metrics on or off (switching on keeps earlier samples)
+        # Inputs:
+            # enabled: nonzero to record metrics
+        if enabled:
+            self._metrics = self._metrics_registry
+        else:
+            self._metrics = None
+    def getMetrics(self):
+        # Latency metrics per operation
+        # Outputs:
+            # metrics: map of operation name to OperationMetrics structure
+                # count, errors, timeouts, merged: counters
+                # bucket_bounds: histogram bucket upper bounds in seconds
+                # lock_wait, write, read, decode, total: histogram bucket counts per phase
+                # phase_sum, phase_max: summed and longest time per phase (s),
+                    # in the order lock_wait, write, read, decode, total
+        registry = self._metrics_registry
+        result = {}
+        bounds = numpy.array(gripper_metrics.bucket_bounds(), dtype=numpy.float64)
+        for name in registry.names():
+            op = registry.operation(name)
+            m = RR.RobotRaconteurNode.s.NewStructure("edu.rpi.gripper.OperationMetrics")
+            m.count = op.count
+            m.errors = op.errors
+            m.timeouts = op.timeouts
+            m.merged = op.merged
+            m.bucket_bounds = bounds
+            for i in range(len(gripper_metrics.PHASES)):
+                setattr(m, gripper_metrics.PHASES[i], numpy.array(op.phases[i].counts, dtype=numpy.uint32))
+            m.phase_sum = numpy.array([h.sum for h in op.phases], dtype=numpy.float64)
+            m.phase_max = numpy.array([h.max for h in op.phases], dtype=numpy.float64)
+            result[name] = m
+        return result
+    def getMetricsText(self):
+        # Latency metrics as a plain-text report (see gripper_metrics.registry.dump)
+        text = self._metrics_registry.dump()+self._bus.dump()
+        if isinstance(self._gripper, gripper_transport.transport):
+            text += self._gripper.dump()
+        if self._bus.watchdog is not None:
+            text += self._bus.watchdog.dump()
+        return text
+    def getBusMetrics(self):
+        # Scheduling metrics of the serial line this gripper is on
+        # Outputs:
+            # metrics: BusMetrics structure
+                # queue_depth, max_queue_depth: requests waiting for the line
+                # turns, waits, merged, expired, preempted: counters
+                # bucket_bounds: histogram bucket upper bounds in seconds
+                # command_wait, read_wait: histograms of time waited for the line
+                # command_wait_max, read_wait_max: longest waits in seconds
+        bus = self._bus
+        b = RR.RobotRaconteurNode.s.NewStructure("edu.rpi.gripper.BusMetrics")
+        b.queue_depth = bus.queue_depth()
+        b.max_queue_depth = bus.max_depth
+        b.turns = bus.turns
+        b.waits = bus.waits
+        b.merged = bus.merged
+        b.expired = bus.expired
+        b.preempted = bus.preempted
+        b.bucket_bounds = numpy.array(gripper_metrics.bucket_bounds(), dtype=numpy.float64)
+        command, read = bus.wait_times[gripper_bus.PRIORITY_COMMAND], bus.wait_times[gripper_bus.PRIORITY_READ]
+        b.command_wait = numpy.array(command.counts, dtype=numpy.uint32)
+        b.read_wait = numpy.array(read.counts, dtype=numpy.uint32)
+        b.command_wait_max = command.max
+        b.read_wait_max = read.max
+        return b
+    def getTransportStats(self):
+        # Error statistics of the serial line this gripper is on
+        # Outputs:
+            # stats: TransportStats structure (see gripper_transport.transport.stats);
+                # all zero when the line has no gripper_transport
+        t = RR.RobotRaconteurNode.s.NewStructure("edu.rpi.gripper.TransportStats")
+        stats = [0]*8
+        if isinstance(self._gripper, gripper_transport.transport):
+            stats = self._gripper.stats()
+        t.frames, t.retried, t.timeouts, t.short_frames, t.crc_errors, t.resync_bytes, \
+            t.exceptions, t.failures = stats
+        return t
+    def resetMetrics(self):
+        # Clear all latency metrics
+        self._metrics_registry.reset()
+    def startTelemetry(self, path, capacity=65536):
+        # Record every state read and acknowledged command to a telemetry log
+        # (see gripper_telemetry)
+        self.stopTelemetry()
+        recorder = gripper_telemetry.recorder(path, self._slave_id, capacity)
+        recorder.start()
+        self._recorder = recorder
+    def stopTelemetry(self):
+        # Flush and close the telemetry log
+        recorder = self._recorder
+        self._recorder = None
+        if recorder is not None:
+            recorder.stop()
+            print("Telemetry: %d records in %s, %d dropped" % (recorder.records,
+                recorder.path, recorder.dropped))
+    def startSharedState(self, path):
+        # Publish every state read to a shared-memory segment for local
+        # readers (see gripper_shared_state)
+        self.stopSharedState()
+        self._shared_state = gripper_shared_state.publisher(path, self._slave_id, self._calibration)
+    def stopSharedState(self):
+        # Mark the shared state offline and stop publishing to it
+        shared_state = self._shared_state
+        self._shared_state = None
+        if shared_state is not None:
+            shared_state.close()
+    def startPolling(self, rate):
+        # Read the status block in a background thread at rate Hz. The get
+        # functions then return the latest snapshot without serial traffic.
+        poller = self._newPoller(rate)
+        with self._polling_lock:
+            previous = self._poller
+            self._poller = poller
+            self._streaming = False
+            poller.start()
+        if previous is not None:
+            previous.stop()
+    def stopPolling(self):
+        # Stop background polling; the get functions read the gripper again
+        with self._polling_lock:
+            poller = self._poller
+            self._poller = None
+            self._streaming = False
+        if poller is not None:
+            poller.stop()
+    def _newPoller(self, rate):
+        poller = gripper_poller.state_poller(self.readState, rate)
+        poller.add_listener(self._broadcaster.publish)
+        return poller
+    def _subscribersChanged(self):
+        # Poll while state wire or state_stream clients are connected, unless
+        # polling anyway. Called by the broadcaster, also from the poller
+        # thread, so the poller is stopped outside the lock.
+        rate = self.stream_rate
+        if rate is None and self._broadcaster.subscribers() and self._poller is None:
+            try:
+                # as poll_rate=auto
+                rate = self.stream_rate = gripper_poller.measure_rate(self.readState) \
+                    / len(self._bus.slave_ids)
+            except (gripper_protocol.protocol_error, gripper_transport.link_down):
+                return # no streaming until the next client connects
+        stopped = None
+        with self._polling_lock:
+            if self._broadcaster.subscribers():
+                if self._poller is None and rate:
+                    self._poller = self._newPoller(rate)
+                    self._poller.start()
+                    self._streaming = True
+            elif self._streaming:
+                stopped = self._poller
+                self._poller = None
+                self._streaming = False
+        if stopped is not None:
+            stopped.stop()
+    def latestState(self, operation='readState'):
+        # Latest polled state, or a fresh read when not polling. Raises
+        # gripper_transport.link_down while the line is down or this gripper
+        # is offline, rather than returning the snapshot polled before.
+        # Inputs:
+            # operation: name the call is recorded under in the metrics
+        # Outputs:
+            # state: gripper_protocol.gripper_state
+        poller = self._poller
+        if poller is not None:
+            watchdog = self._bus.watchdog
+            if watchdog is not None:
+                watchdog.transport.check(self._slave_id)
+            state = poller.latest()
+            if state is not None:
+                metrics = self._metrics
+                if metrics is not None:
+                    metrics.operation(operation).count += 1 # served without serial traffic
+                return state
+        return self.readState(operation)
+    def getStateAge(self):
+        # Age of the polled state returned by the get functions
+        # Outputs:
+            # age: seconds since the snapshot was read (0 when not polling)
+        poller = self._poller
+        if poller is not None:
+            state, age = poller.snapshot()
+            if state is not None:
+                return age
+        return 0.0
+    def getState(self):
+        # Read position, current and status bits together in one transaction
+        # (or from the latest snapshot when polling)
+        # Outputs:
+            # state: GripperState structure (see gripper_state_struct)
+        return gripper_state_struct(self.latestState('getState'), self._calibration)
     def getPosition(self):
         # Read current gripper position
         # Outputs:
             # pos: position as fraction of 255 (0 fully open, 255 closed)
-        with self._lock:
-            self._gripper.write(bytearray.fromhex("090307D00003040E"))
-            data = binascii.hexlify(self._gripper.read(11))
-            pos = int(data[14]+data[15],16)
-            return pos
+        return self.latestState('getPosition').position
     def getCurrent(self):
         # Read current gripper current
         # Outputs:
             # current: current in mA
-        with self._lock:
-            self._gripper.write(bytearray.fromhex("090307D00003040E"))
-            data = binascii.hexlify(self._gripper.read(11))
-            current = 10*int(data[16]+data[17],16)
-            return current
+        return self.latestState('getCurrent').current
+    def setPositionMM(self, opening, speed, force):
+        # Set the finger opening in mm (see setPosition for speed and force)
+        self.setPosition(self._calibration.counts(opening), speed, force)
+    def getPositionMM(self):
+        # Read the finger opening
+        # Outputs:
+            # opening: finger opening in mm
+        return self._calibration.mm(self.latestState('getPosition').position)
+    def getForce(self):
+        # Read the grip force
+        # Outputs:
+            # force: grip force in N estimated from the current
+        return self._calibration.newtons(self.latestState('getCurrent').current)
+    def getCalibration(self):
+        # Conversion tables, for converting logged raw values on the client
+        # Outputs:
+            # cal: Calibration structure
+                # position_mm: opening in mm for each position count (256 entries)
+                # force_n: force in N for each current register value,
+                    # i.e. current/10 mA (256 entries)
+        c = RR.RobotRaconteurNode.s.NewStructure("edu.rpi.gripper.Calibration")
+        c.position_mm = numpy.array(self._calibration.mm_table, dtype=numpy.float64)
+        c.force_n = numpy.array(self._calibration.newton_table, dtype=numpy.float64)
+        return c
+
+def gripper_list(grippers, comm_port):
+    # Parse the grippers option
+    # Outputs:
+        # list of [port, slave_id] pairs
+    if not grippers:
+        return [[comm_port, gripper_protocol.SLAVE_ID]]
+    result = []
+    for entry in grippers.split(','):
+        if ':' in entry:
+            port, slave_id = entry.rsplit(':', 1)
+            result.append([port, int(slave_id, 0)])
+        else:
+            result.append([entry, gripper_protocol.SLAVE_ID])
+    return result
+
+def indexed_path(path, index):
+    # File name for the gripper with the given index: path itself for the
+    # only gripper (index None), else the index added before the extension
+    if index is None:
+        return path
+    base, ext = os.path.splitext(path)
+    return base+str(index)+ext
+
+def open_port(port):
+    # Open the serial port of a gripper line
+    return serial.Serial(port=port_name(port),
+        baudrate=115200, bytesize=8,parity='N',stopbits=1,timeout=1)
+
+def connect_grippers(options, comm_port):
+    # Open the serial lines, then create and activate a gripper_imp per
+    # entry of the grippers option (one bus per port)
+    # Inputs:
+        # options: OPTIONS with overrides (grippers, retries, reply_timeout,
+            # calibration, metrics, read_deadline, suppress, deadband)
+        # comm_port: port of the single gripper when grippers is empty
+    # Outputs:
+        # [buses, controllers]: port -> gripper_bus.bus (None if it could
+            # not be opened), and the activated gripper_imp objects. Each
+            # keeps the index of its entry in grippers, so a gripper that
+            # fails to activate does not renumber the others.
+    buses = {}
+    gripperControllers = []
+    grippers = gripper_list(options['grippers'], comm_port)
+    for index in range(len(grippers)):
+        port, slave_id = grippers[index]
+        if port not in buses:
+            print("Connecting to gripper(s) on "+port_name(port)+"...")
+            try:
+                gripper = open_port(port)
+                # validate, resync and retry replies instead of waiting out the timeout
+                gripper = gripper_transport.transport(gripper, options['retries'], options['reply_timeout'])
+                buses[port] = gripper_bus.bus(gripper)
+            except:
+                print("Error connecting to gripper.")
+                buses[port] = None
+        if buses[port] is None:
+            continue
+        numbered = index if len(grippers)>1 else None
+        # Load calibration:
+        cal = None
+        if options['calibration']:
+            path = indexed_path(options['calibration'], numbered)
+            try:
+                cal = gripper_calibration.load(path)
+                print("Calibration loaded from "+path)
+            except (IOError, ValueError, KeyError) as e:
+                print("Nominal calibration used, could not load "+path+": "+str(e))
+        # Activate gripper:
+        gripperController = gripper_imp(buses[port], slave_id, options['metrics'], cal,
+            options['read_deadline'], options['suppress'], options['deadband'], numbered)
+        if gripperController.activate():
+            gripperControllers.append(gripperController)
+        else:
+            print("Gripper %d on %s not served." % (slave_id, port_name(port)))
+    return [buses, gripperControllers]
+
+def start_watchdogs(buses, controllers, options):
+    # Start a gripper_watchdog per line, reopening its port if it fails
+    # Outputs:
+        # watchdogs: the started gripper_watchdog.watchdog objects
+    watchdogs = []
+    for port in buses:
+        bus = buses[port]
+        if bus is None or not isinstance(bus.gripper, gripper_transport.transport):
+            continue
+        on_bus = [c for c in controllers if c._bus is bus]
+        w = gripper_watchdog.watchdog(bus, lambda port=port: open_port(port), on_bus,
+            options['failure_limit'], max_backoff=options['max_backoff'])
+        w.start()
+        watchdogs.append(w)
+    return watchdogs
+
+def close_grippers(buses):
+    # Close the serial lines opened by connect_grippers
+    for port in buses:
+        if buses[port] is not None:
+            buses[port].gripper.close()
+
+def service_definition():
+    # Text of gripper_controller.robdef, which sits next to this script
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gripper_controller.robdef')
+    with open(path, 'r') as f:
+        return f.read()
+
+def start_transports(transports, tcp_port=TCP_PORT, node_name=NODE_NAME):
+    # Register the Robot Raconteur server transports named in transports
+    # Inputs:
+        # transports: comma separated list of tcp (port tcp_port), local
+            # (same-host clients, found by node name) and intra (clients in
+            # this process)
+    # Outputs:
+        # names of the transports started (intra is skipped with a message
+            # on Robot Raconteur versions without IntraTransport)
+    names = [name.strip() for name in transports.split(',') if name.strip()]
+    for name in names:
+        if name not in TRANSPORTS:
+            raise ValueError("Unknown transport "+name+" (expected one of "+",".join(TRANSPORTS)+")")
+    node = RR.RobotRaconteurNode.s
+    if 'local' not in names:
+        node.NodeName = node_name # set by StartServerAsNodeName otherwise
+    started = []
+    for name in names:
+        if name == 'local':
+            t = RR.LocalTransport()
+            t.StartServerAsNodeName(node_name)
+        elif name == 'tcp':
+            t = RR.TcpTransport()
+            t.StartServer(tcp_port)
+        else:
+            if not hasattr(RR, 'IntraTransport'):
+                print("IntraTransport is not available in this Robot Raconteur version")
+                continue
+            t = RR.IntraTransport()
+            t.StartServer()
+        node.RegisterTransport(t)
+        started.append(name)
+    return started
+
+def service_urls(service_name, transports, tcp_port=TCP_PORT, node_name=NODE_NAME):
+    # Connection URLs of a registered service, one per started transport
+    urls = []
+    for name in transports:
+        if name == 'tcp':
+            urls.append("tcp://localhost:%d/%s/%s" % (tcp_port, node_name, service_name))
+        else:
+            urls.append("rr+%s:///?nodename=%s&service=%s" % (name, node_name, service_name))
+    return urls
+
+class gripper_service:
+    # Robot Raconteur service for a list of gripper_imp objects, run by
+    # main() or embedded in a Python controller's own process, e.g.
+    #   buses, grippers = connect_grippers(options, port)
+    #   service = gripper_service(grippers, 'intra,local')
+    #   service.start()
+    #   gripper = RR.RobotRaconteurNode.s.ConnectService(service.urls['gripcon'][0])
+    # The controller can also call the gripper_imp methods directly.
+    # One service per gripper: gripcon, or gripcon0, gripcon1, ... numbered
+    # by the index of the gripper's entry in the grippers option
+    def __init__(self, controllers, transports=DEFAULT_TRANSPORTS, tcp_port=TCP_PORT, node_name=NODE_NAME):
+        # Inputs:
+            # controllers: gripper_imp objects to serve
+            # transports: comma separated transports (see start_transports)
+        self.controllers = list(controllers)
+        self.transports = transports
+        self.tcp_port = tcp_port
+        self.node_name = node_name
+        self.started = [] # transports started
+        self.urls = {} # service name -> connection URLs
+    def service_names(self):
+        names = []
+        for i in range(len(self.controllers)):
+            index = self.controllers[i].index
+            if index is None and len(self.controllers)>1:
+                index = i # not created by connect_grippers: number by position
+            names.append("gripcon" if index is None else "gripcon"+str(index))
+        return names
+    def start(self):
+        # Start the transports and register the service type and services
+        node = RR.RobotRaconteurNode.s
+        self.started = start_transports(self.transports, self.tcp_port, self.node_name)
+        node.RegisterServiceType(service_definition())
+        names = self.service_names()
+        for i in range(len(self.controllers)):
+            node.RegisterService(names[i], SERVICE_TYPE, self.controllers[i])
+            self.urls[names[i]] = service_urls(names[i], self.started, self.tcp_port, self.node_name)
+        return self.urls
+    def stop(self):
+        # Shut down the Robot Raconteur node (all transports and services)
+        RR.RobotRaconteurNode.s.Shutdown()
 
 def main():
-    # Specify comm port:
+    t_start = gripper_protocol.monotonic() # for the startup time report
+    # Specify comm port and options:
     comm_default = 3
-    if len(sys.argv)>1:
-        if sys.argv[1].isdigit():
-            print"Comm port specified: ",str(sys.argv[1])
-            comm_port = sys.argv[1]
+    options, args = parse_options(sys.argv[1:], OPTIONS)
+    if len(args)>0:
+        if is_port(args[0]):
+            print("Comm port specified: "+str(args[0]))
+            comm_port = args[0]
         else:
-            print"Default comm port used: ",str(comm_default)
+            print("Default comm port used: "+str(comm_default))
             comm_port = comm_default
     else:
-        print"Default comm port used: ",str(comm_default)
+        print("Default comm port used: "+str(comm_default))
         comm_port = comm_default
 
-    # Connect to gripper:
-    print("Connecting to gripper...")
-    try:
-        gripper = serial.Serial(port='COM'+str(comm_port),
-            baudrate=115200, bytesize=8,parity='N',stopbits=1,timeout=1)
-        gripper_connected = True
-    except:
-        print("Error connecting to gripper.")
-        gripper_connected = False
-    # Activate gripper:
-    if gripper_connected:
-        gripper_activated = activate(gripper,gripper_connected)
+    # Connect to grippers (one bus per port):
+    buses, gripperControllers = connect_grippers(options, comm_port)
 
     # Connect Via Robot Raconteur:
-    if gripper_connected&gripper_activated:
-        RR.RobotRaconteurNode.s.NodeName = "GripperController"
-        gripperController = gripper_imp(gripper)
-        # set gripper to open position:
-        gripperController.setPosition(0, 50, 50)
-        time.sleep(4)
-
-        t = RR.TcpTransport()
-        t.StartServer(6006)
-        RR.RobotRaconteurNode.s.RegisterTransport(t)
-
-        cwd = os.getcwd()
-        try:
-            with open(cwd+'\gripper_controller.robdef','r') as f:
-                service_def = f.read()
-        except Exception as e:
-            print("error1")
-            print(e)
+    if gripperControllers:
+        # set grippers to open position and wait until they get there
+        for gripperController in gripperControllers:
+            if gripperController.moveAndWait(0, 50, 50, 5).outcome == 0:
+                print("Gripper did not report reaching the open position.")
+        for gripperController in gripperControllers:
+            if options['poll_rate']=='auto':
+                # leave half of the measured bus time free for commands,
+                # shared between the grippers on the line
+                poll_rate = gripper_poller.measure_rate(gripperController.readState) \
+                    / len(gripperController._bus.slave_ids)
+            else:
+                poll_rate = float(options['poll_rate'])
+            if poll_rate>0:
+                print("Polling gripper state at %.1f Hz" % poll_rate)
+                gripperController.startPolling(poll_rate)
+            elif options['stream_rate']=='auto':
+                gripperController.stream_rate = None # measured on the first client
+            else:
+                gripperController.stream_rate = float(options['stream_rate'])
+        if options['telemetry']:
+            for gripperController in gripperControllers:
+                path = indexed_path(options['telemetry'], gripperController.index)
+                gripperController.startTelemetry(path, options['telemetry_buffer'])
+        if options['shared_state']:
+            for gripperController in gripperControllers:
+                path = indexed_path(options['shared_state'], gripperController.index)
+                try:
+                    gripperController.startSharedState(path)
+                    print("Publishing gripper state to "+path)
+                except (IOError, OSError) as e:
+                    print("Could not create shared state "+path+": "+str(e))
 
+        watchdogs = []
+        if options['reconnect']:
+            watchdogs = start_watchdogs(buses, gripperControllers, options)
+        service = gripper_service(gripperControllers, options['transports'], options['tcp_port'])
         try:
-            RR.RobotRaconteurNode.s.RegisterServiceType(service_def)
+            urls = service.start()
+            for name in service.service_names():
+                for url in urls[name]:
+                    print("Connect at "+url)
+            print("Service ready %.2f s after startup" % (gripper_protocol.monotonic()-t_start))
+            input("press enter to quit...\r\n")
         except Exception as e:
-            print("error2")
-            print(e)
-        try:
-            RR.RobotRaconteurNode.s.RegisterService("gripcon","edu.rpi.gripper.gripcon",gripperController)
-            print("Connect at tcp://localhost:6006/GripperController/gripcon")
-            raw_input("press enter to quit...\r\n")
-        except Exception as e:
-            print("error3")
+            print("Error starting the Robot Raconteur service:")
             print(e)
     # Shutdown:
         print("Shutting down...")
-        RR.RobotRaconteurNode.s.Shutdown()
-        gripperController._gripper.close()
+        service.stop()
+        for w in watchdogs:
+            w.stop()
+        for gripperController in gripperControllers:
+            gripperController.stopPolling()
+            gripperController.stopCommandWriter()
+            gripperController.stopTelemetry()
+            gripperController.stopSharedState()
+            if gripperController._metrics is not None:
+                print("Metrics for gripper %d (ms):" % gripperController._slave_id)
+                print(gripperController.getMetricsText())
+        close_grippers(buses)
         print("Shutdown complete!")
+    else:
+        close_grippers(buses)
 
 if __name__=='__main__':
     main()
@@ -0,0 +1,383 @@
+# asyncio transport and client for the Robotiq 2-finger gripper
+
+# NOTE: requires Python 3.5+ (asyncio). The rest of the driver also runs
+# on Python 2, so this module is only imported by Python 3 code.
+
+# Callers await transactions instead of blocking a thread each. Requests
+# go into a bounded queue; a writer task puts them on the line back to
+# back and a single reader coroutine matches the reply bytes to the
+# request in flight: as in gripper_transport, bytes before a frame header
+# with the request's slave ID and function code are skipped and a frame
+# failing its CRC is dropped. Modbus RTU is half duplex and the gripper answers one
+# request at a time, so there is never more than one request on the wire,
+# but there is no idle gap between transactions and any number of callers
+# can wait without a thread each. Every request has a deadline: requests
+# still queued at their deadline are dropped, and a reply that does not
+# arrive in time fails only that request. After such a timeout, or a
+# caller cancelling a request in flight, the writer waits until the line
+# is quiet before the next request, so a late reply is discarded instead
+# of being taken as the next request's reply.
+# Frames are the same as gripper_imp's (gripper_protocol).
+# Run this file to benchmark many concurrent callers against the simulator:
+#   python3 gripper_async.py callers=10,100,500 duration=2
+
+import asyncio
+import os
+import sys
+import serial
+import gripper_protocol
+from gripper_options import parse_options, port_name
+
+try:
+    import serial_asyncio # pyserial-asyncio, optional
+except ImportError:
+    serial_asyncio = None
+
+class queue_full(Exception):
+    # Raised when a request cannot be queued before its deadline
+    pass
+
+class _request:
+    __slots__ = ('frame', 'reply_len', 'deadline', 'future')
+
+    def __init__(self, frame, reply_len, deadline, future):
+        self.frame = frame
+        self.reply_len = reply_len
+        self.deadline = deadline
+        self.future = future
+
+class async_transport:
+    # Owns one serial line through an asyncio StreamReader/StreamWriter pair
+    def __init__(self, reader, writer, max_queue=256, timeout=0.1, gap=0.00175):
+        # Inputs:
+            # reader, writer: asyncio streams for the serial line
+            # max_queue: requests that may wait for the line
+            # timeout: default seconds from submission to reply
+            # gap: silence in seconds after which the line counts as quiet
+                # (the Modbus RTU inter-frame gap, see gripper_transport)
+        self._reader = reader
+        self._writer = writer
+        self._queue = asyncio.Queue(max_queue)
+        self._inflight = None
+        self._buf = bytearray()
+        self._tasks = []
+        self.timeout = timeout
+        self.gap = gap
+        self._received = 0 # bytes read, to tell when the line has gone quiet
+        # counters
+        self.transactions = 0
+        self.timeouts = 0
+        self.expired = 0 # dropped while still queued
+        self.stray_bytes = 0 # received with no request in flight, or skipped as noise
+        self.crc_errors = 0
+        self.exceptions = 0 # modbus exception replies
+        self.cancelled = 0 # given up by the caller while in flight
+        self.drains = 0 # waits for a quiet line after a timeout or cancellation
+
+    def start(self):
+        self._tasks = [asyncio.ensure_future(self._write_loop()),
+            asyncio.ensure_future(self._read_loop())]
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._writer.close()
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    async def transact(self, frame, reply_len, timeout=None):
+        # Queue frame and wait for its reply_len byte reply
+        # Inputs:
+            # frame: request bytes (copied, so shared buffers may be reused)
+            # reply_len: expected reply length
+            # timeout: seconds until the request is abandoned (default self.timeout)
+        # Outputs:
+            # reply: reply bytes (slave ID, function code and CRC checked)
+        loop = asyncio.get_event_loop()
+        if timeout is None:
+            timeout = self.timeout
+        request = _request(bytes(frame), reply_len, loop.time()+timeout, loop.create_future())
+        try:
+            await asyncio.wait_for(self._queue.put(request), timeout)
+        except asyncio.TimeoutError:
+            raise queue_full("Request queue full for %.3f s" % timeout)
+        return await request.future
+
+    async def _write_loop(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            request = await self._queue.get()
+            if request.future.done():
+                continue # caller gave up
+            remaining = request.deadline-loop.time()
+            if remaining <= 0:
+                self.expired += 1
+                request.future.set_exception(asyncio.TimeoutError("Request expired in queue"))
+                continue
+            del self._buf[:]
+            self._inflight = request
+            self._writer.write(request.frame)
+            try:
+                # asyncio.wait leaves the future alone on timeout
+                await asyncio.wait([request.future], timeout=remaining)
+            except asyncio.CancelledError:
+                request.future.cancel()
+                raise
+            if request.future.cancelled():
+                # the caller gave up (e.g. asyncio.wait_for): its reply may
+                # still be on the way, so handle it like a timeout
+                self.cancelled += 1
+            elif request.future.done():
+                self.transactions += 1
+                continue
+            else:
+                self.timeouts += 1
+                request.future.set_exception(asyncio.TimeoutError("No reply from gripper"))
+            if self._inflight is request:
+                self._inflight = None
+                await self._drain()
+
+    async def _drain(self):
+        # Wait until the line has been quiet for a gap (at most self.timeout);
+        # bytes arriving meanwhile have no request in flight and are dropped
+        loop = asyncio.get_event_loop()
+        t_end = loop.time()+self.timeout
+        self.drains += 1
+        while True:
+            received = self._received
+            await asyncio.sleep(self.gap)
+            if self._received == received or loop.time() >= t_end:
+                break
+
+    async def _read_loop(self):
+        # The only reader: hand the first valid reply to the request in flight
+        while True:
+            data = await self._reader.read(256)
+            if not data:
+                break
+            self._received += len(data)
+            self._buf += data
+            request = self._inflight
+            if request is None:
+                self.stray_bytes += len(self._buf)
+                del self._buf[:]
+                continue
+            reply = self._match(request)
+            if reply is None:
+                continue # wait for the rest of the frame
+            self._inflight = None
+            if request.future.done():
+                continue
+            if len(reply) == 5 and request.reply_len != 5:
+                self.exceptions += 1
+                request.future.set_exception(gripper_protocol.protocol_error(
+                    "Modbus exception 0x%02X from slave %d" % (reply[2], reply[0])))
+            else:
+                request.future.set_result(reply)
+
+    def _match(self, request):
+        # Take a valid reply to request from the start of the buffer (the
+        # same checks as gripper_transport._read_frame)
+        # Outputs:
+            # reply: reply or exception reply bytes, None until one is complete
+        buf = self._buf
+        slave_id = request.frame[0]
+        function = request.frame[1]
+        error_function = function | 0x80
+        while True:
+            # skip line noise up to the next plausible frame header
+            i = 0
+            while i < len(buf) and not (buf[i] == slave_id and
+                    (i+1 == len(buf) or buf[i+1] == function or buf[i+1] == error_function)):
+                i += 1
+            if i:
+                del buf[0:i]
+                self.stray_bytes += i
+            need = request.reply_len
+            if len(buf) >= 2 and buf[1] == error_function:
+                need = 5
+            if len(buf) < need:
+                return None
+            if gripper_protocol.crc16(buf, 0, need) == 0:
+                reply = bytes(buf[0:need])
+                del buf[0:need]
+                return reply
+            self.crc_errors += 1
+            del buf[0]
+            self.stray_bytes += 1
+
+async def _open_posix(port, baudrate):
+    # Stream pair for a serial port without pyserial-asyncio (POSIX only):
+    # pyserial configures the line, asyncio pipe transports do the I/O
+    loop = asyncio.get_event_loop()
+    line = serial.Serial(port=port, baudrate=baudrate, bytesize=8, parity='N', stopbits=1, timeout=0)
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader),
+        os.fdopen(os.dup(line.fileno()), 'rb', 0))
+    transport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin,
+        os.fdopen(os.dup(line.fileno()), 'wb', 0))
+    writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+    line.close() # the pipe transports own duplicates of the descriptor
+    return reader, writer
+
+async def open_transport(port, baudrate=115200, max_queue=256, timeout=0.1):
+    # Open a serial port and start an async_transport on it
+    # Inputs:
+        # port: comm port number or device name
+    if serial_asyncio is not None:
+        reader, writer = await serial_asyncio.open_serial_connection(url=port_name(port), baudrate=baudrate)
+    elif os.name == 'posix':
+        reader, writer = await _open_posix(port_name(port), baudrate)
+    else:
+        raise RuntimeError("gripper_async needs pyserial-asyncio on this platform")
+    gap = 0.00175 if baudrate > 19200 else 38.5/baudrate # 3.5 characters of 11 bits
+    transport = async_transport(reader, writer, max_queue, timeout, gap)
+    transport.start()
+    return transport
+
+class async_gripper:
+    # Gripper client on an async_transport (several may share one transport)
+    def __init__(self, transport, slave_id=gripper_protocol.SLAVE_ID):
+        self.transport = transport
+        self.slave_id = slave_id
+        self._frames = gripper_protocol.frames(slave_id)
+        self._commands = gripper_protocol.command_builder(slave_id)
+
+    async def set_position(self, position, speed, force, timeout=None):
+        # Set gripper position with specified speed and force (see gripper_imp.setPosition)
+        frame = self._commands.set_position(gripper_protocol.clamp_byte(position),
+            gripper_protocol.clamp_byte(speed), gripper_protocol.clamp_byte(force))
+        reply = await self.transport.transact(frame, gripper_protocol.WRITE_ACK_LEN, timeout)
+        gripper_protocol.check_write_ack(reply, self.slave_id)
+
+    async def get_state(self, timeout=None):
+        # Outputs:
+            # state: gripper_protocol.gripper_state
+        reply = await self.transport.transact(self._frames.read_status,
+            gripper_protocol.STATUS_REPLY_LEN, timeout)
+        return gripper_protocol.decode_status(reply, self.slave_id, gripper_protocol.monotonic())
+
+    async def activate(self, timeout=10):
+        # Activate the gripper unless it already is active (see gripper_serial.activate)
+        # Outputs:
+            # gripper_activated: boolean stating whether activation was successful or not
+        try:
+            state = await self.get_state()
+            if state.gACT == 1 and state.gSTA == 3 and state.fault == 0:
+                return True
+        except (gripper_protocol.protocol_error, asyncio.TimeoutError):
+            pass
+        for frame in (self._frames.clear_activation, self._frames.activate):
+            reply = await self.transport.transact(frame, gripper_protocol.WRITE_ACK_LEN)
+            gripper_protocol.check_write_ack(reply, self.slave_id)
+        loop = asyncio.get_event_loop()
+        t_end = loop.time()+timeout
+        interval = 0.02
+        while loop.time() < t_end:
+            try:
+                state = await self.get_state()
+                if state.gACT == 1 and state.gSTA == 3:
+                    return True
+            except (gripper_protocol.protocol_error, asyncio.TimeoutError):
+                pass
+            await asyncio.sleep(interval)
+            interval = min(interval*1.5, 0.2)
+        return False
+
+class async_serial_adapter:
+    # Serial-like object (write/read/close) backed by an async_transport
+    # running on an event loop in another thread. gripper_imp, and so the
+    # Robot Raconteur service, can run on top of the asyncio transport by
+    # passing this object in place of the serial.Serial port.
+    def __init__(self, transport, loop, timeout=1.0):
+        self._transport = transport
+        self._loop = loop
+        self._timeout = timeout
+        self._request = None # set by write, sent by the following read
+
+    def write(self, data):
+        # NOTE: callers hold gripper_imp's bus access between write and
+        # read, as they do with a real port
+        self._request = bytes(data)
+
+    def read(self, n):
+        request = self._request
+        self._request = None
+        if request is None:
+            return b'' # nothing sent, so nothing to answer
+        future = asyncio.run_coroutine_threadsafe(
+            self._transport.transact(request, n, self._timeout), self._loop)
+        try:
+            return future.result()
+        except (asyncio.TimeoutError, queue_full):
+            return b'' # a short read, as from a serial port timeout
+
+    def reset_input_buffer(self):
+        pass
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self._transport.close(), self._loop).result()
+
+# Options and their defaults for the benchmark; override with name=value arguments
+# callers: comma separated numbers of concurrent callers to test
+# duration: seconds per test
+# timeout: request timeout in seconds
+# max_queue: request queue bound
+# baud: simulated baud rate
+OPTIONS = {'callers': '1,10,100,500', 'duration': 2.0, 'timeout': 1.0,
+    'max_queue': 1024, 'baud': 115200}
+
+async def _caller(gripper, t_end, latencies, errors):
+    loop = asyncio.get_event_loop()
+    while loop.time() < t_end:
+        t_start = loop.time()
+        try:
+            await gripper.get_state()
+            latencies.append(loop.time()-t_start)
+        except Exception:
+            errors.append(1)
+
+async def _benchmark(port, options):
+    transport = await open_transport(port, options['baud'], options['max_queue'], options['timeout'])
+    gripper = async_gripper(transport)
+    if not await gripper.activate():
+        print("Activation failed")
+        return
+    loop = asyncio.get_event_loop()
+    print("%8s %10s %10s %10s %10s %8s" % ('callers', 'replies/s', 'p50 ms', 'p99 ms', 'max ms', 'errors'))
+    for callers in [int(x) for x in options['callers'].split(',')]:
+        latencies = []
+        errors = []
+        t_start = loop.time()
+        t_end = t_start+options['duration']
+        await asyncio.gather(*[_caller(gripper, t_end, latencies, errors) for x in range(callers)])
+        elapsed = loop.time()-t_start
+        latencies.sort()
+        if latencies:
+            print("%8d %10.1f %10.2f %10.2f %10.2f %8d" % (callers, len(latencies)/elapsed,
+                1e3*latencies[len(latencies)//2], 1e3*latencies[int(0.99*(len(latencies)-1))],
+                1e3*latencies[-1], len(errors)))
+        else:
+            print("%8d no replies, %d errors" % (callers, len(errors)))
+    await transport.close()
+
+def main():
+    import gripper_simulator
+    options, args = parse_options(sys.argv[1:], OPTIONS)
+    sim = gripper_simulator.simulator(baud=options['baud'], activation_time=0.1)
+    port = sim.start()
+    print("Simulated gripper on "+port)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(_benchmark(port, options))
+    loop.close()
+    sim.stop()
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,281 @@
+# Shared RS-485 bus for several Robotiq grippers
+
+# Several grippers (slave IDs) can share one serial line. Only one
+# transaction can be on the line at a time, so callers take turns: when
+# the line is busy, waiting callers are queued per priority and slave ID.
+# The line goes to queued commands before any queued read, so a burst of
+# status reads cannot hold back a setpoint by more than the transaction
+# already on the line (a transaction in progress is never interrupted).
+# Within a priority the line is handed to the slave IDs in round-robin
+# order, so a gripper with many queued requests cannot starve the others.
+# A read that is identical to one already queued is merged into it: it
+# waits for that transaction and gets the same reply. A request may carry
+# a deadline; if it is still queued when its deadline has passed it is
+# dropped at the next handover and its caller gets request_expired.
+# Each caller runs its own transaction in its own thread once it has the
+# line, so there is no extra thread hop per transaction.
+
+import threading
+import collections
+import gripper_protocol
+import gripper_metrics
+
+PRIORITY_COMMAND = 0 # setpoints: served before any queued read
+PRIORITY_READ = 1
+PRIORITIES = ('command', 'read')
+
+class request_expired(Exception):
+    # Raised when a request's deadline passes while it waits for the line
+    pass
+
+class _waiter:
+    # A queued request (and the merged requests waiting on its reply)
+    __slots__ = ('lock', 'priority', 'deadline', 'queued_at', 'expired', 'key',
+        'followers', 'reply', 'error')
+
+    def __init__(self, priority, deadline, key):
+        self.lock = threading.Lock()
+        self.lock.acquire() # released when the line is handed over or the request expires
+        self.priority = priority
+        self.deadline = deadline
+        self.queued_at = gripper_protocol.monotonic()
+        self.expired = False
+        self.key = key
+        self.followers = []
+        self.reply = None
+        self.error = None
+
+class bus:
+    # One serial line and the grippers on it
+    def __init__(self, gripper):
+        # Inputs:
+            # gripper: serial communication for the line
+        self.gripper = gripper
+        self._lock = threading.Lock() # guards the scheduling state below
+        self._busy = False
+        self._waiting = [{} for p in PRIORITIES] # per priority: slave ID -> deque of waiters
+        self._order = [collections.deque() for p in PRIORITIES] # slave IDs with waiters, next turn first
+        self._merge = {} # (slave ID, request, reply length) -> queued waiter
+        self._deadlines = 0 # queued waiters with a deadline
+        self._depth = 0 # queued waiters
+        self.slave_ids = []
+        self.watchdog = None # gripper_watchdog.watchdog reconnecting the line, if any
+        # counters
+        self.turns = 0
+        self.waits = 0 # turns that had to wait for the line
+        self.merged = 0 # requests answered by an identical queued request
+        self.expired = 0 # requests dropped at their deadline
+        self.preempted = 0 # commands served ahead of queued reads
+        self.max_depth = 0
+        self.wait_times = [gripper_metrics.histogram() for p in PRIORITIES] # seconds queued, per priority
+
+    def access(self, slave_id, priority=PRIORITY_READ):
+        # Context manager giving slave_id a turn on the line
+        # (used in place of a per-gripper lock)
+        if slave_id not in self.slave_ids:
+            self.slave_ids.append(slave_id)
+        return bus_access(self, slave_id, priority)
+
+    def queue_depth(self):
+        # Requests waiting for the line (merged requests not counted)
+        return self._depth
+
+    def dump(self):
+        # Plain-text report of the scheduling counters and wait times (ms)
+        lines = ["bus turns=%d waits=%d merged=%d expired=%d preempted=%d queue_depth=%d max_depth=%d" % (
+            self.turns, self.waits, self.merged, self.expired, self.preempted, self._depth, self.max_depth)]
+        for i in range(len(PRIORITIES)):
+            h = self.wait_times[i]
+            n = h.samples()
+            if n:
+                lines.append("  %-12s n=%d mean=%.3f p50<=%.3f p90<=%.3f p99<=%.3f max=%.3f" % (
+                    PRIORITIES[i]+'_wait', n, 1e3*h.sum/n, 1e3*h.quantile(0.5), 1e3*h.quantile(0.9),
+                    1e3*h.quantile(0.99), 1e3*h.max))
+        return "".join([line+"\n" for line in lines])
+
+    def acquire(self, slave_id, priority=PRIORITY_READ, deadline=None):
+        # Wait for slave_id's turn on the line
+        # Inputs:
+            # priority: PRIORITY_COMMAND or PRIORITY_READ
+            # deadline: gripper_protocol.monotonic() time after which the
+                # request is dropped if it is still queued (None to wait)
+        with self._lock:
+            waiter = self._enqueue(slave_id, priority, deadline, None)
+        if waiter is not None:
+            self._wait(waiter)
+
+    def release(self):
+        # Hand the line to the next request: commands first, then reads,
+        # slave IDs in round-robin order within each priority
+        expired = []
+        with self._lock:
+            if self._deadlines:
+                self._expire(expired)
+            waiter = None
+            for priority in range(len(PRIORITIES)):
+                order = self._order[priority]
+                if not order:
+                    continue
+                slave_id = order.popleft()
+                queue = self._waiting[priority][slave_id]
+                waiter = queue.popleft()
+                if queue:
+                    order.append(slave_id) # more waiting: back of the line
+                else:
+                    del self._waiting[priority][slave_id]
+                break
+            if waiter is None:
+                self._busy = False
+            else:
+                self._dequeued(waiter)
+                if waiter.priority == PRIORITY_COMMAND and self._order[PRIORITY_READ]:
+                    self.preempted += 1
+        for w in expired:
+            self._finish_followers(w)
+            w.lock.release()
+        if waiter is not None:
+            waiter.lock.release()
+
+    def transact(self, slave_id, request, reply_len, priority=PRIORITY_READ, deadline=None,
+            merge=False, times=None):
+        # Write request and read reply_len bytes during slave_id's turn
+        # Inputs:
+            # request: frame, or function returning the frame (called during
+                # the turn, so it may fill a shared buffer)
+            # priority, deadline: as acquire
+            # merge: share the reply of an identical request already queued
+                # (request must be a frame)
+            # times: list to receive the monotonic times the turn started,
+                # the request was written and the reply was read (left
+                # unchanged when the reply came from a merged request)
+        # Outputs:
+            # reply: reply bytes (not yet validated)
+        key = None
+        with self._lock:
+            if merge:
+                key = (slave_id, bytes(request), reply_len)
+                leader = self._merge.get(key)
+                if leader is not None:
+                    self.merged += 1
+                    follower = _waiter(priority, None, None)
+                    leader.followers.append(follower)
+            if key is None or leader is None:
+                follower = None
+                waiter = self._enqueue(slave_id, priority, deadline, key)
+        if follower is not None:
+            follower.lock.acquire() # released when the merged request completes
+            if follower.error is not None:
+                raise follower.error
+            return follower.reply
+        if waiter is not None:
+            self._wait(waiter)
+        reply = None
+        error = None
+        try:
+            monotonic = gripper_protocol.monotonic
+            t_turn = monotonic()
+            if callable(request):
+                request = request()
+            self.gripper.write(request)
+            t_written = monotonic()
+            reply = self.gripper.read(reply_len)
+            if times is not None:
+                times[0:3] = [t_turn, t_written, monotonic()]
+            return reply
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.release()
+            if waiter is not None and waiter.followers:
+                waiter.reply = reply
+                waiter.error = error
+                self._finish_followers(waiter)
+
+    def _enqueue(self, slave_id, priority, deadline, key):
+        # (holding self._lock) Take the line if it is free, else queue a waiter
+        self.turns += 1
+        if not self._busy:
+            self._busy = True
+            self.wait_times[priority].record(0.0)
+            return None
+        self.waits += 1
+        waiter = _waiter(priority, deadline, key)
+        waiting = self._waiting[priority]
+        queue = waiting.get(slave_id)
+        if queue is None:
+            queue = waiting[slave_id] = collections.deque()
+            self._order[priority].append(slave_id)
+        queue.append(waiter)
+        self._depth += 1
+        if self._depth > self.max_depth:
+            self.max_depth = self._depth
+        if deadline is not None:
+            self._deadlines += 1
+        if key is not None:
+            self._merge[key] = waiter
+        return waiter
+
+    def _dequeued(self, waiter):
+        # (holding self._lock) Bookkeeping for a waiter leaving the queue
+        self._depth -= 1
+        if waiter.deadline is not None:
+            self._deadlines -= 1
+        if waiter.key is not None and self._merge.get(waiter.key) is waiter:
+            del self._merge[waiter.key] # later requests need a fresh transaction
+
+    def _expire(self, expired):
+        # (holding self._lock) Remove queued waiters whose deadline has passed
+        now = gripper_protocol.monotonic()
+        for priority in range(len(PRIORITIES)):
+            waiting = self._waiting[priority]
+            for slave_id in list(waiting):
+                queue = waiting[slave_id]
+                if not [w for w in queue if w.deadline is not None and w.deadline < now]:
+                    continue
+                keep = collections.deque()
+                for w in queue:
+                    if w.deadline is not None and w.deadline < now:
+                        w.expired = True
+                        self.expired += 1
+                        self._dequeued(w)
+                        expired.append(w)
+                    else:
+                        keep.append(w)
+                if keep:
+                    waiting[slave_id] = keep
+                else:
+                    del waiting[slave_id]
+                    self._order[priority].remove(slave_id)
+
+    def _wait(self, waiter):
+        waiter.lock.acquire() # released by release() when the line is handed over
+        self.wait_times[waiter.priority].record(gripper_protocol.monotonic()-waiter.queued_at)
+        if waiter.expired:
+            raise request_expired("Request dropped after %.3f s waiting for the bus" %
+                (gripper_protocol.monotonic()-waiter.queued_at))
+
+    def _finish_followers(self, waiter):
+        # Give the merged requests the leader's reply (or error)
+        error = waiter.error
+        if waiter.expired:
+            error = request_expired("Merged request dropped at its deadline")
+        for follower in waiter.followers:
+            follower.reply = waiter.reply
+            follower.error = error
+            follower.lock.release()
+
+class bus_access:
+    # with-statement helper returned by bus.access()
+    def __init__(self, bus, slave_id, priority=PRIORITY_READ):
+        self.bus = bus
+        self.slave_id = slave_id
+        self.priority = priority
+
+    def __enter__(self):
+        self.bus.acquire(self.slave_id, self.priority)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.bus.release()
+        return False
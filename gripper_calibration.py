@@ -0,0 +1,188 @@
+# Calibration of Robotiq 2-finger gripper readings to physical units
+
+# Position counts (0 open to 255 closed) map to finger opening in mm, and
+# motor current to grip force in N, through per-gripper piecewise linear
+# curves. The curves are expanded once into 256-entry tables (one entry
+# per position count and per current register value, 10 mA steps), so a
+# scalar conversion is a list index and a whole log converts with one
+# NumPy indexing operation. The opening curve must be monotonic, and its
+# inverse is expanded the same way into a table of counts at evenly spaced
+# openings, so commanding an opening in mm is an index as well. Fitting
+# averages the logged pairs in bins of equal raw width and rejects a curve
+# that is not monotonic.
+# Curves are fitted from logged pairs of raw readings and measured values
+# (e.g. calliper openings or load cell forces) and saved as JSON:
+#   python gripper_calibration.py position=opening.csv force=force.csv output=gripper9.json
+# where each CSV file has two columns: raw value (counts or mA) and the
+# measured value (mm or N). Without a calibration file the nominal curves
+# below are used (see the Robotiq manual; custom curves are more accurate).
+
+import sys
+import json
+import numpy
+from gripper_options import parse_options
+
+# nominal 2F-85 curves: opening falls linearly over the stroke, and grip
+# force rises roughly linearly with current up to the rated 235 N
+NOMINAL_POSITION = [[0, 255], [85.0, 0.0]] # counts, opening mm
+NOMINAL_FORCE = [[0, 1000], [0.0, 235.0]] # current mA, force N
+CURRENT_STEP = 10 # mA per current register count
+
+INVERSE_SIZE = 4096 # entries of the mm to counts table (about 0.02 mm apart nominally)
+
+def _check_curve(curve, name, monotonic):
+    # Raise ValueError unless curve's raw breakpoints increase (and, if
+    # monotonic, its values strictly increase or decrease)
+    raw = numpy.asarray(curve[0], dtype=numpy.float64)
+    values = numpy.asarray(curve[1], dtype=numpy.float64)
+    if raw.ndim != 1 or raw.shape != values.shape or raw.size < 2:
+        raise ValueError("%s curve needs two or more breakpoints of equal length" % name)
+    if not numpy.all(numpy.diff(raw) > 0):
+        raise ValueError("%s curve breakpoints must increase" % name)
+    if monotonic:
+        steps = numpy.diff(values)
+        if not (numpy.all(steps > 0) or numpy.all(steps < 0)):
+            raise ValueError("%s curve must be strictly monotonic to be inverted" % name)
+
+class calibration:
+    # Conversion tables of one gripper
+    def __init__(self, position=NOMINAL_POSITION, force=NOMINAL_FORCE):
+        # Inputs:
+            # position: [counts, mm] breakpoint lists, counts increasing and
+                # mm strictly monotonic
+            # force: [current_mA, newtons] breakpoint lists, current increasing
+        # Raises ValueError for curves that do not meet these conditions
+        _check_curve(position, 'position', True)
+        _check_curve(force, 'force', False)
+        self.position = [list(position[0]), list(position[1])]
+        self.force = [list(force[0]), list(force[1])]
+        counts = numpy.arange(256)
+        # 256-entry tables; NumPy arrays for batches, lists for scalars
+        self.mm_table = numpy.interp(counts, self.position[0], self.position[1])
+        self.newton_table = numpy.interp(counts*CURRENT_STEP, self.force[0], self.force[1])
+        self._mm = self.mm_table.tolist()
+        self._newtons = self.newton_table.tolist()
+        # inverse: the count for each of INVERSE_SIZE openings evenly spaced
+        # over the curve, so mm to counts is a list index too
+        mm = self.position[1]
+        raw = self.position[0]
+        if mm[0] > mm[-1]:
+            mm = mm[::-1]
+            raw = raw[::-1]
+        self._mm_min = float(mm[0])
+        self._mm_step = (float(mm[-1])-self._mm_min)/(INVERSE_SIZE-1)
+        openings = self._mm_min+numpy.arange(INVERSE_SIZE)*self._mm_step
+        self.counts_table = numpy.clip(numpy.rint(numpy.interp(openings, mm, raw)),
+            0, 255).astype(numpy.uint8)
+        self._counts = self.counts_table.tolist()
+
+    def mm(self, counts):
+        # Finger opening in mm for a position count (0-255)
+        return self._mm[counts]
+
+    def newtons(self, current):
+        # Grip force in N for a current in mA
+        i = current//CURRENT_STEP
+        return self._newtons[i if i < 256 else 255]
+
+    def counts(self, mm):
+        # Position count (0-255) nearest to a finger opening in mm
+        i = int(round((mm-self._mm_min)/self._mm_step))
+        return self._counts[min(max(i, 0), INVERSE_SIZE-1)]
+
+    def to_mm(self, counts):
+        # Openings in mm for an array of position counts
+        return self.mm_table[numpy.asarray(counts, dtype=numpy.intp)]
+
+    def to_newtons(self, current):
+        # Forces in N for an array of currents in mA
+        i = numpy.asarray(current, dtype=numpy.intp)//CURRENT_STEP
+        return self.newton_table[numpy.minimum(i, 255)]
+
+    def to_counts(self, mm):
+        # Position counts (uint8) for an array of openings in mm
+        i = numpy.rint((numpy.asarray(mm, dtype=numpy.float64)-self._mm_min)/self._mm_step)
+        return self.counts_table[numpy.clip(i, 0, INVERSE_SIZE-1).astype(numpy.intp)]
+
+    def to_dict(self):
+        return {'position': {'counts': self.position[0], 'mm': self.position[1]},
+            'force': {'current_mA': self.force[0], 'newtons': self.force[1]}}
+
+def fit_curve(raw, measured, points=16, monotonic=True):
+    # Fit a piecewise linear curve to logged pairs
+    # Inputs:
+        # raw: raw readings (counts or mA)
+        # measured: measured values at those readings (mm or N)
+        # points: maximum number of breakpoints
+        # monotonic: raise ValueError unless the fitted values strictly
+            # increase or decrease
+    # Outputs:
+        # [raw breakpoints, values]: the pairs split into points bins of
+            # equal raw width, with the mean raw and measured value of each
+            # bin that has pairs (averaging out measurement noise)
+    raw = numpy.asarray(raw, dtype=numpy.float64)
+    measured = numpy.asarray(measured, dtype=numpy.float64)
+    if raw.shape != measured.shape or raw.size < 2:
+        raise ValueError("Need at least two raw/measured pairs of equal length")
+    lo = raw.min()
+    width = (raw.max()-lo)/points
+    if width == 0:
+        raise ValueError("Need measurements at two or more raw values")
+    bins = numpy.minimum(((raw-lo)/width).astype(numpy.intp), points-1)
+    n = numpy.bincount(bins, minlength=points)
+    filled = n > 0
+    values = (numpy.bincount(bins, weights=raw, minlength=points)[filled]/n[filled])
+    means = (numpy.bincount(bins, weights=measured, minlength=points)[filled]/n[filled])
+    if monotonic:
+        steps = numpy.diff(means)
+        if not (numpy.all(steps > 0) or numpy.all(steps < 0)):
+            raise ValueError("Measured values are not monotonic in the raw value over %d "
+                "bins; check the data or fit fewer points" % points)
+    return [values.tolist(), means.tolist()]
+
+def fit(position=None, force=None, points=16):
+    # Calibration from logged pairs
+    # Inputs:
+        # position: [counts, mm] arrays, or None for the nominal curve
+        # force: [current_mA, newtons] arrays, or None for the nominal curve
+    # Raises ValueError for a position curve that is not monotonic (it must
+    # be inverted) or a force curve that is not monotonic
+    position_curve = fit_curve(position[0], position[1], points) if position is not None else NOMINAL_POSITION
+    force_curve = fit_curve(force[0], force[1], points) if force is not None else NOMINAL_FORCE
+    return calibration(position_curve, force_curve)
+
+def load(path):
+    # Calibration saved by save()
+    with open(path, 'r') as f:
+        data = json.load(f)
+    return calibration([data['position']['counts'], data['position']['mm']],
+        [data['force']['current_mA'], data['force']['newtons']])
+
+def save(cal, path):
+    with open(path, 'w') as f:
+        json.dump(cal.to_dict(), f, indent=2)
+
+# Options and their defaults; override with name=value arguments
+# position: CSV of position counts and measured openings in mm (empty for nominal)
+# force: CSV of currents in mA and measured forces in N (empty for nominal)
+# points: maximum breakpoints per curve
+# output: calibration file to write
+OPTIONS = {'position': '', 'force': '', 'points': 16, 'output': 'gripper_calibration.json'}
+
+def main():
+    options, args = parse_options(sys.argv[1:], OPTIONS)
+    pairs = {}
+    for name in ('position', 'force'):
+        if options[name]:
+            data = numpy.loadtxt(options[name], delimiter=',', ndmin=2)
+            pairs[name] = [data[:, 0], data[:, 1]]
+            print("%s: %d pairs from %s" % (name, data.shape[0], options[name]))
+        else:
+            pairs[name] = None
+            print("%s: nominal curve" % name)
+    cal = fit(pairs['position'], pairs['force'], options['points'])
+    save(cal, options['output'])
+    print("Calibration saved to "+options['output'])
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,151 @@
+# Streaming setpoints for the Robotiq 2-finger gripper
+
+# High-rate clients (e.g. teleoperation) put setpoints into a latest-wins
+# slot instead of waiting on the write acknowledgement for every command.
+# A writer thread sends whatever is newest each time the bus is free, so
+# setpoints that were superseded before they could be sent are dropped.
+# Timed trajectories are streamed from the server with execute_trajectory,
+# so a whole motion costs one request from the client.
+
+import threading
+import time
+import gripper_protocol
+
+class setpoint_slot:
+    # Holds the newest (position, speed, force) setpoint not yet sent
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._value = None
+        self._closed = False
+        # counters
+        self.received = 0
+        self.coalesced = 0 # setpoints replaced before they were sent
+
+    def put(self, value):
+        # Store value, replacing any setpoint that has not been sent yet
+        with self._cond:
+            if self._value is not None:
+                self.coalesced += 1
+            self._value = value
+            self.received += 1
+            self._cond.notify()
+
+    def take(self):
+        # Wait for and remove the newest setpoint
+        # Outputs:
+            # value: the setpoint, or None once the slot is closed
+        # NOTE: waits without a timeout, since timed Condition.wait polls in
+        # coarse steps on python 2
+        with self._cond:
+            while self._value is None and not self._closed:
+                self._cond.wait()
+            value = self._value
+            self._value = None
+            return value
+
+    def close(self):
+        # Wake the writer and make take() return None
+        with self._cond:
+            self._closed = True
+            self._value = None
+            self._cond.notify_all()
+
+class setpoint_writer:
+    # Thread that drains a setpoint_slot into send(position, speed, force)
+    def __init__(self, send):
+        # Inputs:
+            # send: blocking function that writes one setpoint to the gripper
+        self._send = send
+        self.slot = setpoint_slot()
+        self.sent = 0
+        self.errors = 0
+        self.last_error = None
+        self._thread = threading.Thread(target=self._run, name="gripper_setpoint_writer")
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self.slot.close()
+        self._thread.join()
+
+    def put(self, position, speed, force):
+        self.slot.put((position, speed, force))
+
+    def counters(self):
+        # Outputs:
+            # [received, sent, coalesced, errors]
+        return [self.slot.received, self.sent, self.slot.coalesced, self.errors]
+
+    def _run(self):
+        while True:
+            value = self.slot.take()
+            if value is None:
+                break
+            try:
+                self._send(*value)
+                self.sent += 1
+            except Exception as e:
+                self.errors += 1
+                self.last_error = e
+
+def execute_trajectory(times, positions, speeds, forces, send, read_position, read_margin=0.005):
+    # Send timed waypoints from the server instead of one RPC per step
+    # Inputs:
+        # times: waypoint times in seconds from the start (non-decreasing)
+        # positions, speeds, forces: waypoint values (0-255)
+        # send: blocking function send(position, speed, force)
+        # read_position: function returning the current position
+        # read_margin: seconds a read_position call is expected to take at
+            # first; raised to the longest read seen, so the read before a
+            # waypoint finishes by the time that waypoint is due
+    # Outputs:
+        # result: dict of per-waypoint lists
+            # send_time: when each waypoint was sent, seconds from the start
+            # lateness: send_time minus the scheduled time
+            # write_time: duration of each send
+            # position_reached: position read just before the next waypoint
+                # was due; for the final waypoint, read once the expected
+                # travel time to it (gripper_protocol.travel_time) has passed
+        # and deadline_misses: waypoints whose send finished after the next
+            # waypoint was due
+    n = len(times)
+    if n == 0 or len(positions) != n or len(speeds) != n or len(forces) != n:
+        raise ValueError("Trajectory arrays must be non-empty and of equal length")
+    for i in range(1, n):
+        if times[i] < times[i-1]:
+            raise ValueError("Trajectory times must be non-decreasing")
+    monotonic = gripper_protocol.monotonic
+    result = {'send_time': [], 'lateness': [], 'write_time': [],
+        'position_reached': [], 'deadline_misses': 0}
+    reached = result['position_reached']
+    position = None
+    t_start = monotonic()
+    for i in range(n):
+        if i > 0:
+            # position the previous waypoint reached, read as late as
+            # possible while still finishing before this one is due
+            delay = t_start+times[i]-read_margin-monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            t_read = monotonic()
+            position = read_position()
+            read_margin = max(read_margin, monotonic()-t_read)
+            reached.append(position)
+        delay = t_start+times[i]-monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        t_send = monotonic()
+        send(positions[i], speeds[i], forces[i])
+        t_done = monotonic()
+        result['send_time'].append(t_send-t_start)
+        result['lateness'].append(t_send-t_start-times[i])
+        result['write_time'].append(t_done-t_send)
+        if i+1 < n and t_done-t_start > times[i+1]:
+            result['deadline_misses'] += 1
+    if position is None:
+        position = read_position()
+    time.sleep(gripper_protocol.travel_time(positions[-1]-position, speeds[-1]))
+    reached.append(read_position())
+    return result
@@ -0,0 +1,305 @@
+# Robotiq 2-Finger Gripper Service Load Test
+
+# Starts many Robot Raconteur clients of the gripcon service at once and
+# reports how the service holds up: calls per second, latency percentiles
+# per operation, errors, and how evenly the calls were shared between the
+# clients (Jain's fairness index: 1 when every client completed the same
+# number of calls, 1/N when one client got them all).
+# Each client repeatedly calls an operation drawn from a weighted mix
+# (mix=setPosition:1,getPosition:2,...), either as fast as the service
+# answers or at a target rate per client (rate=... Hz). The run is repeated
+# for each client count in clients=..., so the step where throughput stops
+# rising while latency climbs shows the saturation point.
+# Clients are threads of this process (mode=threads, one connection each)
+# or separate processes (mode=processes), which keeps the clients' own
+# CPU use from competing with a service hosted here.
+# NOTE: With sim as the argument, a gripper_simulator.py pty and the
+# gripcon service (gripper_2finger_RR.gripper_service) are started in this
+# process and the clients connect over the transport option. Otherwise
+# give the URL of a running service, e.g.
+#   python gripper_load_test.py sim clients=1,2,4,8,16 duration=5
+#   python gripper_load_test.py url=tcp://localhost:6006/GripperController/gripcon mode=processes
+# Results are saved as JSON; compare=old.json prints the change against an
+# earlier run.
+
+import sys
+import os
+import time
+import json
+import random
+import platform
+import threading
+import subprocess
+import RobotRaconteur as RR
+import gripper_protocol
+from gripper_serialcom_timing_test import percentile
+from gripper_options import parse_options
+
+OPERATIONS = ('setPosition', 'getPosition', 'getCurrent', 'getState')
+
+# Options and their defaults; override with name=value arguments
+# url: service URL to load (empty with the sim argument)
+# clients: comma separated client counts, run one after the other
+# mode: threads or processes
+# mix: comma separated operation:weight entries (operations: setPosition,
+#   getPosition, getCurrent, getState)
+# rate: target calls per second per client (0 calls back to back)
+# duration: seconds per client count
+# pause: seconds between client counts
+# transport: transport the clients use to reach a service started with sim
+# transports: transports of a service started with sim
+# poll_rate: poll_rate of a service started with sim (0 reads the gripper
+#   on every get call)
+# output: JSON results file
+# compare: earlier JSON results file to compare against
+# label: free text stored with the results (e.g. driver version)
+# seed: random seed of the first client (client i uses seed+i)
+# worker, start_at: set by mode=processes for the client processes
+OPTIONS = {'url': '', 'clients': '1,2,4,8', 'mode': 'threads',
+    'mix': 'setPosition:1,getPosition:1,getCurrent:1', 'rate': 0.0, 'duration': 5.0,
+    'pause': 1.0, 'transport': 'tcp', 'transports': 'tcp,local', 'poll_rate': '0',
+    'output': 'load_results.json', 'compare': '', 'label': '', 'seed': 1,
+    'worker': -1, 'start_at': 0.0}
+
+def parse_mix(mix):
+    # Outputs:
+        # list of operation names, each repeated by its weight
+    ops = []
+    for entry in mix.split(','):
+        if ':' in entry:
+            name, weight = entry.split(':', 1)
+            weight = int(weight)
+        else:
+            name, weight = entry, 1
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise ValueError("Unknown operation "+name+" (expected one of "+",".join(OPERATIONS)+")")
+        ops += [name]*weight
+    if not ops:
+        raise ValueError("Empty operation mix")
+    return ops
+
+def start_client_node():
+    # Client transports for a process that does not host the service
+    node = RR.RobotRaconteurNode.s
+    node.RegisterTransport(RR.TcpTransport())
+    node.RegisterTransport(RR.LocalTransport())
+    return node
+
+def run_client(client, options, index, start_at):
+    # Call the service until the end of the run
+    # Inputs:
+        # client: connected gripcon object
+        # index: client number (seeds its random operations and positions)
+        # start_at: time.time() at which every client starts
+    # Outputs:
+        # result: dict with the latencies (s) per operation, errors per
+            # operation and calls started more than a period late
+    rng = random.Random(options['seed']+index)
+    ops = parse_mix(options['mix'])
+    latency = dict((op, []) for op in OPERATIONS)
+    errors = dict((op, 0) for op in OPERATIONS)
+    late = 0
+    calls = {'setPosition': lambda: client.setPosition(rng.randint(0, 255), 150, 150),
+        'getPosition': client.getPosition, 'getCurrent': client.getCurrent,
+        'getState': client.getState}
+    delay = start_at-time.time()
+    if delay > 0:
+        time.sleep(delay)
+    monotonic = gripper_protocol.monotonic
+    period = 1.0/options['rate'] if options['rate'] > 0 else 0.0
+    t_end = monotonic()+options['duration']
+    t_next = monotonic()
+    while True:
+        if period:
+            delay = t_next-monotonic()
+            if delay > 0:
+                time.sleep(delay)
+                t_next += period
+            elif delay < -period:
+                late += 1
+                t_next = monotonic()+period # drop the backlog rather than burst
+            else:
+                t_next += period
+        t_start = monotonic()
+        if t_start >= t_end:
+            break
+        op = rng.choice(ops)
+        try:
+            calls[op]()
+            latency[op].append(monotonic()-t_start)
+        except Exception:
+            errors[op] += 1
+    return {'latency': latency, 'errors': errors, 'late': late}
+
+def run_threads(url, n, options):
+    # n clients on threads of this process, one connection each
+    node = RR.RobotRaconteurNode.s
+    clients = [node.ConnectService(url) for i in range(n)]
+    results = [None]*n
+    start_at = time.time()+0.5
+    def run(i):
+        results[i] = run_client(clients[i], options, i, start_at)
+    threads = [threading.Thread(target=run, args=(i,), name="load_client_%d" % i) for i in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for client in clients:
+        node.DisconnectService(client)
+    return results
+
+def run_processes(url, n, options):
+    # n clients in separate processes (this script with worker=i), each
+    # printing its result as JSON
+    start_at = time.time()+2.0 # leaves time to start and connect
+    args = [sys.executable, os.path.abspath(__file__), 'url='+url, 'mix='+options['mix'],
+        'rate=%r' % options['rate'], 'duration=%r' % options['duration'],
+        'seed=%d' % options['seed'], 'start_at=%r' % start_at]
+    workers = [subprocess.Popen(args+['worker=%d' % i], stdout=subprocess.PIPE) for i in range(n)]
+    results = []
+    for p in workers:
+        out = p.communicate()[0]
+        try:
+            results.append(json.loads(out.decode().strip().splitlines()[-1]))
+        except (ValueError, IndexError):
+            print("Client process failed (exit code %s)" % p.returncode)
+    return results
+
+def summarize_step(results, n, duration):
+    # Summary of one client count
+    summary = {'clients': n, 'operations': {}}
+    total = 0
+    per_client = []
+    for op in OPERATIONS:
+        times = []
+        errors = 0
+        for r in results:
+            times += r['latency'][op]
+            errors += r['errors'][op]
+        if not times and not errors:
+            continue
+        s = sorted(times)
+        summary['operations'][op] = {'count': len(s), 'errors': errors,
+            'mean': sum(s)/len(s) if s else 0.0, 'p50': percentile(s, 50), 'p90': percentile(s, 90),
+            'p99': percentile(s, 99), 'max': s[-1] if s else 0.0}
+        total += len(s)
+    for r in results:
+        per_client.append(sum([len(r['latency'][op]) for op in OPERATIONS]))
+    summary['calls'] = total
+    summary['throughput'] = total/duration
+    summary['errors'] = sum([summary['operations'][op]['errors'] for op in summary['operations']])
+    summary['late'] = sum([r['late'] for r in results])
+    summary['per_client'] = per_client
+    squares = sum([float(c)*c for c in per_client])
+    summary['fairness'] = float(sum(per_client))**2/(len(per_client)*squares) if squares else 0.0
+    return summary
+
+def print_step(summary):
+    print("%d clients: %.1f calls/s, %d errors, %d late, fairness %.3f (per client %d-%d calls)" % (
+        summary['clients'], summary['throughput'], summary['errors'], summary['late'],
+        summary['fairness'], min(summary['per_client'] or [0]), max(summary['per_client'] or [0])))
+    for op in OPERATIONS:
+        if op in summary['operations']:
+            s = summary['operations'][op]
+            print("    %-12s n=%-7d p50 %8.3f ms  p90 %8.3f ms  p99 %8.3f ms  max %8.3f ms  errors %d" % (
+                op, s['count'], 1e3*s['p50'], 1e3*s['p90'], 1e3*s['p99'], 1e3*s['max'], s['errors']))
+
+def compare(results, old):
+    # Print throughput and p99 changes against an earlier run, per client count
+    old_steps = dict((s['clients'], s) for s in old['steps'])
+    for step in results['steps']:
+        if step['clients'] not in old_steps:
+            continue
+        o = old_steps[step['clients']]
+        line = "%d clients: %.1f -> %.1f calls/s" % (step['clients'], o['throughput'], step['throughput'])
+        for op in OPERATIONS:
+            if op in step['operations'] and op in o['operations']:
+                line += ", %s p99 %.3f -> %.3f ms" % (op, 1e3*o['operations'][op]['p99'],
+                    1e3*step['operations'][op]['p99'])
+        print(line)
+
+def main():
+    options, args = parse_options(sys.argv[1:], OPTIONS)
+    if options['worker'] >= 0:
+        # client process of mode=processes
+        node = start_client_node()
+        client = node.ConnectService(options['url'])
+        result = run_client(client, options, options['worker'], options['start_at'])
+        node.DisconnectService(client)
+        node.Shutdown()
+        print(json.dumps(result))
+        return
+    parse_mix(options['mix']) # fail before starting anything
+    sim = None
+    service = None
+    controllers = []
+    buses = {}
+    url = options['url']
+    if len(args)>0 and args[0]=='sim':
+        import gripper_simulator
+        import gripper_2finger_RR
+        sim = gripper_simulator.simulator(activation_time=0.1)
+        port = sim.start()
+        print("Simulated gripper on "+port)
+        service_options = dict(gripper_2finger_RR.OPTIONS)
+        service_options['transports'] = options['transports']
+        buses, controllers = gripper_2finger_RR.connect_grippers(service_options, port)
+        if not controllers:
+            sim.stop()
+            return
+        poll_rate = float(options['poll_rate'])
+        if poll_rate > 0:
+            controllers[0].startPolling(poll_rate)
+        service = gripper_2finger_RR.gripper_service(controllers, options['transports'])
+        urls = service.start()['gripcon']
+        if options['transport'] not in service.started:
+            print("Transport "+options['transport']+" was not started")
+            service.stop()
+            gripper_2finger_RR.close_grippers(buses)
+            sim.stop()
+            return
+        url = urls[service.started.index(options['transport'])]
+    elif url:
+        start_client_node()
+    else:
+        print("usage: python gripper_load_test.py sim|url=service_url [name=value ...]")
+        return
+    print("Loading "+url)
+
+    results = {'label': options['label'], 'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'url': url, 'simulated': sim is not None, 'python': platform.python_version(),
+        'options': options, 'steps': []}
+    counts = [int(c) for c in options['clients'].split(',')]
+    for i in range(len(counts)):
+        if i:
+            time.sleep(options['pause'])
+        n = counts[i]
+        if options['mode'] == 'processes':
+            step_results = run_processes(url, n, options)
+        else:
+            step_results = run_threads(url, n, options)
+        summary = summarize_step(step_results, n, options['duration'])
+        results['steps'].append(summary)
+        print_step(summary)
+
+    with open(options['output'],'w') as datafile:
+        json.dump(results, datafile, indent=1)
+    print("Results saved to "+options['output'])
+    if options['compare']:
+        with open(options['compare'],'r') as datafile:
+            compare(results, json.load(datafile))
+
+    if service is not None:
+        for controller in controllers:
+            controller.stopPolling()
+        if controllers[0]._metrics is not None:
+            print("Service metrics over all runs (ms):")
+            print(controllers[0].getMetricsText())
+        service.stop()
+        gripper_2finger_RR.close_grippers(buses)
+    if sim is not None:
+        sim.stop()
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,110 @@
+# Low-overhead latency metrics for the gripper driver
+
+# Each operation (setPosition, getPosition, activate, ...) keeps a call
+# count, error and timeout counts and a latency histogram per phase:
+# waiting for the bus (lock_wait), writing the request (write), waiting for
+# the reply bytes (read), decoding the reply (decode) and the whole call
+# (total). Histogram buckets are powers of two from 2 us, so recording a
+# sample is one frexp() and a list increment.
+# Updates are not locked: a count may be lost when two threads record the
+# same operation at the same instant, which is acceptable for metrics and
+# keeps locks out of the hot path. When metrics are off, gripper_imp holds
+# None instead of a registry and skips all timing.
+
+import math
+import threading
+
+PHASES = ('lock_wait', 'write', 'read', 'decode', 'total')
+LOCK_WAIT, WRITE, READ, DECODE, TOTAL = range(len(PHASES))
+BUCKETS = 24 # bucket i holds samples below 2**(i+1) us; the last takes anything slower
+_MICRO = 1e6
+
+def bucket_bounds():
+    # Upper bound of each histogram bucket in seconds
+    return [2.0**(i+1)/_MICRO for i in range(BUCKETS)]
+
+class histogram:
+    # Latency histogram with power-of-two buckets
+    __slots__ = ('counts', 'sum', 'max')
+
+    def __init__(self):
+        self.counts = [0]*BUCKETS
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        i = math.frexp(seconds*_MICRO)[1]-1 # floor(log2(us))
+        if i < 0:
+            i = 0
+        elif i >= BUCKETS:
+            i = BUCKETS-1
+        self.counts[i] += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def samples(self):
+        return sum(self.counts)
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding quantile q (0-1), in seconds
+        n = self.samples()
+        if n == 0:
+            return 0.0
+        rank = q*n
+        seen = 0
+        for i in range(BUCKETS):
+            seen += self.counts[i]
+            if seen >= rank:
+                return min(2.0**(i+1)/_MICRO, self.max)
+        return self.max
+
+class operation:
+    # Counters and phase histograms of one operation
+    __slots__ = ('count', 'errors', 'timeouts', 'merged', 'phases')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0 # exceptions and invalid replies
+        self.timeouts = 0 # short reads (no complete reply before the serial timeout)
+            # and requests dropped at their bus deadline
+        self.merged = 0 # answered by an identical request already queued
+        self.phases = [histogram() for phase in PHASES]
+
+class registry:
+    # The operations of one gripper, created on first use
+    def __init__(self):
+        self._lock = threading.Lock() # guards creation only
+        self._operations = {}
+
+    def operation(self, name):
+        op = self._operations.get(name)
+        if op is None:
+            with self._lock:
+                op = self._operations.setdefault(name, operation())
+        return op
+
+    def names(self):
+        return sorted(self._operations)
+
+    def reset(self):
+        with self._lock:
+            self._operations = {}
+
+    def dump(self):
+        # Plain-text report: one line of counters per operation, then one
+        # line per phase that has samples (times in ms; quantiles are
+        # bucket upper bounds)
+        lines = []
+        for name in self.names():
+            op = self._operations[name]
+            lines.append("%s count=%d errors=%d timeouts=%d merged=%d" % (name, op.count,
+                op.errors, op.timeouts, op.merged))
+            for i in range(len(PHASES)):
+                h = op.phases[i]
+                n = h.samples()
+                if n == 0:
+                    continue
+                lines.append("  %-9s n=%d mean=%.3f p50<=%.3f p90<=%.3f p99<=%.3f max=%.3f" % (PHASES[i], n,
+                    1e3*h.sum/n, 1e3*h.quantile(0.5), 1e3*h.quantile(0.9), 1e3*h.quantile(0.99), 1e3*h.max))
+        return "".join([line+"\n" for line in lines])
@@ -0,0 +1,36 @@
+# Command line helpers shared by the gripper scripts
+
+def parse_options(args, defaults):
+    # Split command line arguments into name=value options and positional arguments
+    # Inputs:
+        # args: command line arguments (without the script name)
+        # defaults: dict of option names and default values (sets each option's type)
+    # Outputs:
+        # [options, positional]: dict of option values, list of remaining arguments
+    options = dict(defaults)
+    positional = []
+    for arg in args:
+        if '=' in arg:
+            name, value = arg.split('=', 1)
+            if name not in defaults:
+                print("Unknown option ignored: "+name)
+                continue
+            if isinstance(defaults[name], bool):
+                options[name] = value.lower() in ('1', 'true', 'yes', 'on')
+            else:
+                options[name] = type(defaults[name])(value)
+        else:
+            positional.append(arg)
+    return [options, positional]
+
+def is_port(arg):
+    # True if arg names a comm port: a COM port number or a device
+    # name such as /dev/ttyUSB0 or a gripper_simulator.py pty
+    return arg.isdigit() or arg.startswith('/dev/') or arg.upper().startswith('COM')
+
+def port_name(comm_port):
+    # Serial port name for a comm port number or device name
+    comm_port = str(comm_port)
+    if comm_port.isdigit():
+        return 'COM'+comm_port
+    return comm_port
@@ -0,0 +1,121 @@
+# Background polling of the Robotiq 2-finger gripper status block
+
+# One thread reads the full status block at a fixed rate and keeps the
+# latest decoded gripper_state. Readers get that snapshot (and its age)
+# without touching the serial port, and listeners (e.g. Robot Raconteur
+# wire/pipe publishers) are handed every new sample.
+
+import threading
+import time
+import gripper_protocol
+
+def sustainable_rate(read_times, bus_share=0.5):
+    # Polling rate that keeps status reads to a share of the bus time
+    # Inputs:
+        # read_times: measured status read durations in seconds
+        # bus_share: fraction of bus time to spend polling (rest is left for commands)
+    # Outputs:
+        # rate: polling rate in Hz, based on the 90th percentile read time
+    times = sorted(read_times)
+    t = times[int(0.9*(len(times)-1))]
+    return bus_share/t
+
+def measure_rate(read_state, samples=20, bus_share=0.5):
+    # Time samples status reads and return sustainable_rate() for them
+    monotonic = gripper_protocol.monotonic
+    read_times = []
+    for x in range(samples):
+        t_start = monotonic()
+        read_state()
+        read_times.append(monotonic()-t_start)
+    return sustainable_rate(read_times, bus_share)
+
+class state_poller:
+    # Periodically calls read_state() and keeps the latest result
+    def __init__(self, read_state, rate):
+        # Inputs:
+            # read_state: function returning a gripper_protocol.gripper_state
+            # rate: polling rate in Hz
+        self._read_state = read_state
+        self.rate = float(rate)
+        self._state = None
+        self._running = False
+        self._thread = None
+        self._listeners = []
+        # counters
+        self.samples = 0
+        self.errors = 0
+        self.overruns = 0 # polls that started late because a read overran the period
+        self.last_error = None
+        self.listener_errors = 0
+
+    def add_listener(self, listener):
+        # Call listener(state) from the polling thread for every new sample
+        # NOTE: listeners run on the polling thread, so they must be quick
+        self._listeners = self._listeners+[listener]
+
+    def remove_listener(self, listener):
+        self._listeners = [l for l in self._listeners if l is not listener]
+
+    def start(self):
+        # Start the polling thread
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="gripper_state_poller")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        # Stop the polling thread and wait for it to exit (unless called
+        # from a listener, on the polling thread itself)
+        self._running = False
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+            self._thread = None
+
+    def is_running(self):
+        return self._running
+
+    def latest(self):
+        # Latest gripper_state, or None if no poll has succeeded yet
+        return self._state
+
+    def snapshot(self):
+        # Outputs:
+            # [state, age]: latest gripper_state and its age in seconds
+            # (None, None if no poll has succeeded yet)
+        state = self._state
+        if state is None:
+            return [None, None]
+        return [state, gripper_protocol.monotonic()-state.timestamp]
+
+    def _run(self):
+        period = 1.0/self.rate
+        monotonic = gripper_protocol.monotonic
+        t_next = monotonic()
+        while self._running:
+            try:
+                state = self._read_state()
+            except Exception as e:
+                self.errors += 1
+                self.last_error = e
+            else:
+                self._state = state
+                self.samples += 1
+                for listener in self._listeners:
+                    try:
+                        listener(state)
+                    except Exception:
+                        self.listener_errors += 1
+            # NOTE: time.sleep is used rather than Event.wait, which polls
+            # in coarse steps on python 2
+            t_next += period
+            delay = t_next-monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # fell behind: skip missed polls instead of bursting to catch up
+                self.overruns += 1
+                t_next = monotonic()
@@ -0,0 +1,286 @@
+# Modbus RTU protocol for the Robotiq 2-finger gripper
+
+# Request frames are built straight into preallocated bytearrays using a
+# precomputed 256-entry CRC-16/Modbus table. Constant frames (activation
+# writes, status reads) are built once per slave ID and cached.
+# Replies are decoded with struct straight from the bytes returned by the
+# serial read and checked (slave ID, function code, byte count, crc) before
+# use. This module does no I/O; it is shared by all of the gripper scripts.
+
+import itertools
+import struct
+import sys
+import time
+
+SLAVE_ID = 0x09 # default gripper slave ID
+
+FC_READ = 0x03 # read holding registers
+FC_WRITE = 0x10 # preset multiple registers
+
+REG_OUTPUT = 0x03E8 # first gripper command (robot output) register
+REG_INPUT = 0x07D0 # first gripper status (robot input) register
+
+# Action request bits (first byte written to REG_OUTPUT)
+ACT_ACTIVATE = 0x01 # rACT
+ACT_GOTO = 0x08 # rGTO
+
+# 2F-85 finger motion, used for travel time estimates and the simulator
+STROKE_MM = 85.0 # full stroke, position 0 to 255
+MIN_SPEED_MM_S = 20.0 # finger speed at rSP = 0
+MAX_SPEED_MM_S = 150.0 # finger speed at rSP = 255
+
+WRITE_ACK_LEN = 8 # reply length for a 3-register write
+STATUS_REPLY_LEN = 11 # reply length for a read of the full status block
+
+def _clock_monotonic():
+    # CLOCK_MONOTONIC through ctypes for Python 2 on POSIX, where time has
+    # no monotonic clock and time.time() steps with the wall clock (NTP)
+    import ctypes
+    import ctypes.util
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+    libc = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'))
+    clock_gettime = libc.clock_gettime
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    clock_id = 6 if sys.platform == 'darwin' else 1 # CLOCK_MONOTONIC
+    byref = ctypes.byref
+    def monotonic():
+        ts = timespec() # one per call: callers run on several threads
+        if clock_gettime(clock_id, byref(ts)) != 0:
+            raise OSError(ctypes.get_errno(), "clock_gettime failed")
+        return ts.tv_sec+ts.tv_nsec*1e-9
+    monotonic()
+    return monotonic
+
+# Monotonic high-resolution clock for timestamps and timing
+# CLOCK: name of the clock behind monotonic()
+try:
+    monotonic = time.perf_counter
+    CLOCK = 'perf_counter'
+except AttributeError:
+    if sys.platform == 'win32':
+        monotonic = time.clock # QueryPerformanceCounter
+        CLOCK = 'clock'
+    else:
+        try:
+            monotonic = _clock_monotonic()
+            CLOCK = 'CLOCK_MONOTONIC'
+        except (OSError, AttributeError, TypeError):
+            monotonic = time.time # last resort: not monotonic
+            CLOCK = 'time'
+
+class protocol_error(Exception):
+    # Raised for replies that are short, corrupted or not what was requested
+    pass
+
+def _crc_table():
+    # Precompute the CRC-16/Modbus (reflected polynomial 0xA001) table
+    table = []
+    for byte in range(256):
+        crc = byte
+        for i in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0xA001
+            else:
+                crc >>= 1
+        table.append(crc)
+    return tuple(table)
+
+CRC_TABLE = _crc_table()
+
+def crc16(data, start=0, end=None, crc=0xFFFF):
+    # Table-driven cyclic redundancy check for modbus RTU protocol
+    # Inputs:
+        # data: bytearray (or other sequence of ints) holding the message
+        # start, end: byte range of data to include (default: all of it)
+        # crc: initial value, or a partial crc to continue from
+    # Outputs:
+        # crc: cyclic redundancy check as an integer
+        # NOTE: low byte is sent first on the wire
+    table = CRC_TABLE
+    for byte in itertools.islice(data, start, end):
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+    return crc
+
+def append_crc(frame, length):
+    # Write the crc of frame[0:length] into frame[length:length+2]
+    crc = crc16(frame, 0, length)
+    frame[length] = crc & 0xFF
+    frame[length+1] = crc >> 8
+    return frame
+
+def clamp_byte(value):
+    # Round a commanded value and limit it to the 0-255 register range
+    value = int(round(value))
+    if value < 0:
+        return 0
+    if value > 255:
+        return 255
+    return value
+
+def finger_speed(speed):
+    # Finger speed in position counts per second for a speed byte (0-255)
+    return (MIN_SPEED_MM_S+(MAX_SPEED_MM_S-MIN_SPEED_MM_S)*speed/255.0)*255.0/STROKE_MM
+
+def travel_time(distance, speed):
+    # Expected seconds to move distance position counts at a speed byte
+    return abs(distance)/finger_speed(speed)
+
+def write_frame(action, position=0, speed=0, force=0, slave_id=SLAVE_ID):
+    # Build a 15-byte write to the three gripper command registers
+    # Inputs:
+        # action: action request byte (rACT, rGTO, ...)
+        # position, speed, force: rPR, rSP and rFR bytes (0-255)
+        # slave_id: modbus slave ID of the gripper
+    # Outputs:
+        # frame: bytearray ready to be written to the serial port
+    frame = bytearray((slave_id, FC_WRITE, REG_OUTPUT >> 8, REG_OUTPUT & 0xFF,
+        0x00, 0x03, 0x06, action, 0x00, 0x00, position, speed, force, 0, 0))
+    return append_crc(frame, 13)
+
+def read_frame(register=REG_INPUT, count=3, slave_id=SLAVE_ID):
+    # Build an 8-byte read of count registers starting at register
+    frame = bytearray((slave_id, FC_READ, register >> 8, register & 0xFF,
+        count >> 8, count & 0xFF, 0, 0))
+    return append_crc(frame, 6)
+
+def read_reply_len(count):
+    # Reply length for a read of count registers
+    # slave ID, function code, byte count, 2 bytes per register, crc
+    return 5 + 2*count
+
+class frame_set:
+    # Constant frames for one slave ID, built once and shared
+    def __init__(self, slave_id=SLAVE_ID):
+        self.slave_id = slave_id
+        self.clear_activation = bytes(write_frame(0x00, slave_id=slave_id))
+        self.activate = bytes(write_frame(ACT_ACTIVATE, slave_id=slave_id))
+        self.read_gripper_status = bytes(read_frame(count=1, slave_id=slave_id)) # gripper status register only
+        self.read_status = bytes(read_frame(count=3, slave_id=slave_id)) # full status block
+
+_frame_sets = {}
+
+def frames(slave_id=SLAVE_ID):
+    # Return the cached constant frames for slave_id
+    try:
+        return _frame_sets[slave_id]
+    except KeyError:
+        fs = _frame_sets[slave_id] = frame_set(slave_id)
+        return fs
+
+class command_builder:
+    # Builds setPosition frames in place in one preallocated buffer
+    # NOTE: the returned frame is overwritten by the next call, so callers
+    # must hold their own lock and write it out before building another one
+    def __init__(self, slave_id=SLAVE_ID):
+        self.slave_id = slave_id
+        self._frame = write_frame(ACT_ACTIVATE | ACT_GOTO, slave_id=slave_id)
+        # crc state after the constant header and action bytes
+        self._crc_prefix = crc16(self._frame, 0, 10)
+
+    def set_position(self, position, speed, force):
+        # Fill in position, speed and force (already limited to 0-255)
+        # Outputs:
+            # frame: the shared 15-byte command buffer
+        frame = self._frame
+        table = CRC_TABLE
+        crc = self._crc_prefix
+        crc = (crc >> 8) ^ table[(crc ^ position) & 0xFF]
+        crc = (crc >> 8) ^ table[(crc ^ speed) & 0xFF]
+        crc = (crc >> 8) ^ table[(crc ^ force) & 0xFF]
+        frame[10] = position
+        frame[11] = speed
+        frame[12] = force
+        frame[13] = crc & 0xFF
+        frame[14] = crc >> 8
+        return frame
+
+# slave ID, function code, register, register count, crc (low byte first)
+_WRITE_ACK = struct.Struct('>BBHHBB')
+
+def check_write_ack(data, slave_id=SLAVE_ID):
+    # Check the reply to a write of the three command registers
+    # Inputs:
+        # data: reply bytes as returned by the serial read
+        # slave_id: expected modbus slave ID
+    if len(data) != WRITE_ACK_LEN:
+        raise protocol_error("Expected %d byte write reply, got %d bytes"
+            % (WRITE_ACK_LEN, len(data)))
+    slave, fc, register, count, crc_lo, crc_hi = _WRITE_ACK.unpack_from(data)
+    if slave != slave_id:
+        raise protocol_error("Reply from slave ID %d, expected %d" % (slave, slave_id))
+    if fc != FC_WRITE or register != REG_OUTPUT or count != 3:
+        raise protocol_error("Unexpected write reply (function code 0x%02X)" % fc)
+    if crc16((slave, fc, register >> 8, register & 0xFF, count >> 8, count & 0xFF)) != crc_lo | crc_hi << 8:
+        raise protocol_error("CRC mismatch in write reply")
+
+# slave ID, function code, byte count, 6 status bytes, crc (low byte first)
+_STATUS_REPLY = struct.Struct('<9BH')
+_status_crc_prefix = {} # crc of the constant reply header, per slave ID
+
+class gripper_state(object):
+    # Decoded gripper status block (registers 0x07D0-0x07D2)
+    #   gACT: activation status (1 activated)
+    #   gGTO: action status (1 go to position request)
+    #   gSTA: gripper status (0 reset, 1 activating, 3 activation complete)
+    #   gOBJ: object detection status (0 moving, 1 object detected while opening,
+    #         2 object detected while closing, 3 at requested position, no object)
+    #   fault: fault status byte (gFLT in the low nibble, kFLT in the high nibble)
+    #   position_echo: echo of the requested position (0-255)
+    #   position: actual position (0 open, 255 closed)
+    #   current: motor current in mA
+    #   timestamp: monotonic() time at which the reply was received
+    __slots__ = ('gACT', 'gGTO', 'gSTA', 'gOBJ', 'fault',
+        'position_echo', 'position', 'current', 'timestamp')
+
+    def __repr__(self):
+        return ("gripper_state(gACT=%d, gGTO=%d, gSTA=%d, gOBJ=%d, fault=0x%02X, "
+            "position_echo=%d, position=%d, current=%d, timestamp=%f)" % (
+            self.gACT, self.gGTO, self.gSTA, self.gOBJ, self.fault,
+            self.position_echo, self.position, self.current, self.timestamp))
+
+def decode_status(data, slave_id=SLAVE_ID, timestamp=0.0, state=None):
+    # Decode the reply to a full status block read
+    # Inputs:
+        # data: reply bytes as returned by the serial read
+        # slave_id: expected modbus slave ID
+        # timestamp: time at which the reply was received
+        # state: optional gripper_state to fill in instead of allocating one
+    # Outputs:
+        # state: gripper_state holding every status register field
+    if len(data) != STATUS_REPLY_LEN:
+        raise protocol_error("Expected %d byte status reply, got %d bytes"
+            % (STATUS_REPLY_LEN, len(data)))
+    slave, fc, count, status, reserved, fault, echo, pos, cur, crc_rx = _STATUS_REPLY.unpack_from(data)
+    if slave != slave_id:
+        raise protocol_error("Reply from slave ID %d, expected %d" % (slave, slave_id))
+    if fc != FC_READ:
+        raise protocol_error("Unexpected function code 0x%02X in status reply" % fc)
+    if count != 6:
+        raise protocol_error("Unexpected byte count %d in status reply" % count)
+    # header crc is constant per slave, so only the 6 data bytes are hashed
+    try:
+        crc = _status_crc_prefix[slave]
+    except KeyError:
+        crc = _status_crc_prefix[slave] = crc16((slave, FC_READ, 6))
+    table = CRC_TABLE
+    crc = (crc >> 8) ^ table[(crc ^ status) & 0xFF]
+    crc = (crc >> 8) ^ table[(crc ^ reserved) & 0xFF]
+    crc = (crc >> 8) ^ table[(crc ^ fault) & 0xFF]
+    crc = (crc >> 8) ^ table[(crc ^ echo) & 0xFF]
+    crc = (crc >> 8) ^ table[(crc ^ pos) & 0xFF]
+    crc = (crc >> 8) ^ table[(crc ^ cur) & 0xFF]
+    if crc != crc_rx:
+        raise protocol_error("CRC mismatch in status reply")
+    if state is None:
+        state = gripper_state()
+    state.gACT = status & 0x01
+    state.gGTO = (status >> 3) & 0x01
+    state.gSTA = (status >> 4) & 0x03
+    state.gOBJ = status >> 6
+    state.fault = fault
+    state.position_echo = echo
+    state.position = pos
+    state.current = 10*cur
+    state.timestamp = timestamp
+    return state
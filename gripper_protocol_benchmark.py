@@ -0,0 +1,116 @@
+# Robotiq 2-Finger Gripper Protocol Benchmark
+
+# Measures how many request frames per second can be built, and how many
+# status replies per second can be decoded, by the original hex-string path
+# (crc_comp, binascii.hexlify) and by gripper_protocol.
+# No gripper is needed; nothing is written to a serial port.
+# NOTE: This script accepts a single argument as the number of frames per test.
+# If a number is not provided, the default value will be used.
+
+import time
+import sys
+import binascii
+import gripper_protocol
+
+def crc_comp(data_str):
+    # Original bit-by-bit crc, kept here as the baseline
+    # Inputs:
+        # data_str: data message as a string (in hex)
+    # Outputs:
+        # crc: cyclic redundancy check as a string (in hex)
+    data = bytearray.fromhex(data_str)
+    crc = 0xFFFF
+    for pos in data:
+        crc ^= pos
+        for i in range(8):
+            if ((crc & 1) !=0):
+                crc >>=1
+                crc ^= 0xA001
+            else:
+                crc >>=1
+    return("%04X"%(crc))
+
+def legacy_command(position, speed, force):
+    # setPosition frame as built by the original scripts
+    command = "091003E8000306090000"+hex(position)[2:].zfill(2) + hex(speed)[2:].zfill(2) + hex(force)[2:].zfill(2)
+    crc = crc_comp(command)
+    command = command + crc[2]+crc[3]+crc[0]+crc[1]
+    return bytearray.fromhex(command)
+
+def legacy_status_read():
+    # status read frame as built by the original scripts
+    return bytearray.fromhex("090307D00003040E")
+
+def legacy_decode(data):
+    # status reply decoded as in the original readPosCurrent (no validation)
+    data = binascii.hexlify(data)
+    pos = int(data[14:16],16)
+    current = 10*int(data[16:18],16)
+    return [pos,current]
+
+def legacy_decode_checked(data):
+    # hex-string decode doing the same work as decode_status:
+    # header and crc checks plus every status field
+    data = binascii.hexlify(data)
+    if data[0:6] != b"090306":
+        raise ValueError("bad header")
+    crc = crc_comp(data[0:18].decode())
+    if data[18:22].upper() != (crc[2:4]+crc[0:2]).encode():
+        raise ValueError("bad crc")
+    status = int(data[6:8],16)
+    return [status & 0x01, (status >> 3) & 0x01, (status >> 4) & 0x03, status >> 6,
+        int(data[10:12],16), int(data[12:14],16), int(data[14:16],16), 10*int(data[16:18],16)]
+
+def status_reply(position, current):
+    # Build a valid status reply as it is returned by the serial read
+    reply = bytearray((gripper_protocol.SLAVE_ID, gripper_protocol.FC_READ, 6,
+        0xF9, 0x00, 0x00, position, position, current // 10, 0, 0))
+    return bytes(gripper_protocol.append_crc(reply, 9))
+
+def run(name, fn, n):
+    # Time n calls of fn and print frames per second
+    # Outputs:
+        # rate: frames per second
+    t_start = time.time()
+    for x in range(n):
+        fn(x & 0xFF)
+    t = time.time()-t_start
+    rate = n/t
+    print("%-28s %10.0f frames/s  %8.2f us/frame" % (name, rate, 1e6*t/n))
+    return rate
+
+def main():
+    n_default = 100000
+    if len(sys.argv)>1 and sys.argv[1].isdigit():
+        n = int(sys.argv[1])
+    else:
+        n = n_default
+    print("Frames per test: "+str(n))
+
+    # Make sure both paths produce identical frames before timing them
+    builder = gripper_protocol.command_builder()
+    for x in range(256):
+        assert bytearray(builder.set_position(x, 255-x, 150)) == legacy_command(x, 255-x, 150)
+    assert bytearray(gripper_protocol.frames().read_status) == legacy_status_read()
+
+    reply = status_reply(140, 220)
+    state = gripper_protocol.decode_status(reply)
+    assert [state.position, state.current] == legacy_decode(reply)
+    assert legacy_decode_checked(reply) == [state.gACT, state.gGTO, state.gSTA, state.gOBJ,
+        state.fault, state.position_echo, state.position, state.current]
+
+    frames = gripper_protocol.frames()
+    old_cmd = run("setPosition (crc_comp)", lambda x: legacy_command(x, 150, 150), n)
+    new_cmd = run("setPosition (table crc)", lambda x: builder.set_position(x, 150, 150), n)
+    old_read = run("status read (fromhex)", lambda x: legacy_status_read(), n)
+    new_read = run("status read (cached)", lambda x: frames.read_status, n)
+    old_dec = run("status decode (hexlify)", lambda x: legacy_decode(reply), n)
+    old_chk = run("status decode (hex+crc_comp)", lambda x: legacy_decode_checked(reply), n)
+    new_dec = run("status decode (struct+crc)", lambda x: gripper_protocol.decode_status(reply), n)
+    reuse_dec = run("status decode (reused state)", lambda x: gripper_protocol.decode_status(reply, state=state), n)
+    print("setPosition speedup: %.1fx" % (new_cmd/old_cmd))
+    print("status read speedup: %.1fx" % (new_read/old_read))
+    print("status decode speedup: %.1fx vs unchecked hexlify, %.1fx vs checked hex path" % (new_dec/old_dec, new_dec/old_chk))
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,216 @@
+# Capture and replay of gripper serial traffic
+
+# capture wraps a serial port and logs every write and read, with its
+# monotonic timestamp, to a binary file. replay serves such a log back as
+# a serial-like object with no delay: each write is answered with bytes
+# read after a matching request in the capture. Running the driver on a
+# replay measures its own CPU cost per transaction (frame building, CRC,
+# decoding, locking, scheduling) without wire time, so the numbers are
+# reproducible and can be profiled.
+# Log file layout (little-endian): magic 'GRCP', version, baud rate, then
+# one record per call: time (double), kind (0 write, 1 read), length, data.
+# NOTE: Capture with gripper_serialcom_timing_test.py capture=run.cap, then
+# benchmark gripper_imp on the capture with
+#   python gripper_replay.py run.cap transactions=20000 profile=true
+# or rerun the timing scenarios on it with
+#   python gripper_serialcom_timing_test.py replay=run.cap scenarios=throughput,command,read interval=0
+
+import sys
+import time
+import struct
+import gripper_protocol
+from gripper_options import parse_options
+
+MAGIC = b'GRCP'
+VERSION = 1
+HEADER = struct.Struct('<4sBI')
+RECORD = struct.Struct('<dBH')
+KIND_WRITE = 0
+KIND_READ = 1
+
+try:
+    cpu_time = time.process_time
+except AttributeError:
+    cpu_time = time.clock # CPU time on POSIX under Python 2
+
+class capture:
+    # Serial port wrapper logging all traffic to path
+    def __init__(self, port, path):
+        self.port = port
+        self._file = open(path, 'wb')
+        self._file.write(HEADER.pack(MAGIC, VERSION, getattr(port, 'baudrate', 115200)))
+        self.writes = 0
+        self.reads = 0
+
+    # forwarded so gripper_transport can set the port timeout
+    @property
+    def baudrate(self):
+        return self.port.baudrate
+    @property
+    def timeout(self):
+        return self.port.timeout
+    @timeout.setter
+    def timeout(self, value):
+        self.port.timeout = value
+
+    def write(self, data):
+        data = bytes(data)
+        self._file.write(RECORD.pack(gripper_protocol.monotonic(), KIND_WRITE, len(data)))
+        self._file.write(data)
+        self.writes += 1
+        return self.port.write(data)
+
+    def read(self, n):
+        data = self.port.read(n)
+        self._file.write(RECORD.pack(gripper_protocol.monotonic(), KIND_READ, len(data)))
+        self._file.write(data)
+        self.reads += 1
+        return data
+
+    def reset_input_buffer(self):
+        try:
+            self.port.reset_input_buffer()
+        except AttributeError:
+            self.port.flushInput()
+
+    def flushInput(self):
+        self.reset_input_buffer()
+
+    def close(self):
+        self._file.close()
+        self.port.close()
+
+def load(path):
+    # Outputs:
+        # [baudrate, records]: capture baud rate and [time, kind, data] records
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, version, baudrate = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(path+" is not a version %d gripper capture" % VERSION)
+    records = []
+    offset = HEADER.size
+    while offset+RECORD.size <= len(data):
+        t, kind, length = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        records.append([t, kind, data[offset:offset+length]])
+        offset += length
+    return [baudrate, records]
+
+class replay:
+    # Serial-like object answering writes from a capture with no delay
+    def __init__(self, path):
+        # Inputs:
+            # path: capture file
+        # Each write is answered with a reply captured for a request with
+        # the same header (slave ID, function code, register and count),
+        # taking the captured replies in turn and starting again after the
+        # last. Write acknowledgements do not depend on the values written,
+        # so any sequence of calls can run on any capture that has them.
+        self.baudrate, records = load(path)
+        self.timeout = 0
+        self._replies = {} # request header -> captured replies
+        request = None
+        for t, kind, data in records:
+            if kind == KIND_WRITE:
+                request = data
+                self._replies.setdefault(request[0:6], []).append(bytearray())
+            elif request is not None:
+                self._replies[request[0:6]][-1] += data
+        for header in list(self._replies):
+            replies = [bytes(reply) for reply in self._replies[header] if reply] # no timeouts
+            if replies:
+                self._replies[header] = replies
+            else:
+                del self._replies[header]
+        if not self._replies:
+            raise ValueError(path+" has no replies")
+        self._next = dict.fromkeys(self._replies, 0)
+        self._rx = b''
+        self._rx_pos = 0
+        # counters
+        self.transactions = 0
+        self.unknown = 0 # writes with no captured reply (answered with nothing)
+        self.wraps = 0 # times a request's captured replies started again
+
+    def write(self, data):
+        header = bytes(data[0:6])
+        replies = self._replies.get(header)
+        self._rx_pos = 0
+        self.transactions += 1
+        if replies is None:
+            self.unknown += 1
+            self._rx = b''
+            return len(data)
+        i = self._next[header]
+        self._rx = replies[i]
+        i += 1
+        if i == len(replies):
+            i = 0
+            self.wraps += 1
+        self._next[header] = i
+        return len(data)
+
+    def read(self, n):
+        data = self._rx[self._rx_pos:self._rx_pos+n]
+        self._rx_pos += len(data)
+        return data
+
+    def reset_input_buffer(self):
+        self._rx = b''
+        self._rx_pos = 0
+
+    def flushInput(self):
+        self.reset_input_buffer()
+
+    def close(self):
+        pass
+
+# Options and their defaults for the benchmark; override with name=value arguments
+# transactions: setPosition/getPosition calls to time
+# metrics: record gripper_imp latency metrics while benchmarking
+# transport: run on gripper_transport as the service does
+# profile: print the 20 most expensive functions (cProfile)
+OPTIONS = {'transactions': 10000, 'metrics': True, 'transport': True, 'profile': False}
+
+def benchmark(path, options):
+    # CPU cost per gripper_imp transaction on a replayed capture
+    import gripper_2finger_RR
+    import gripper_transport
+    port = replay(path)
+    gripper = port
+    if options['transport']:
+        gripper = gripper_transport.transport(port)
+    controller = gripper_2finger_RR.gripper_imp(gripper, metrics=options['metrics'], suppress=False)
+    n = options['transactions']
+    def run():
+        for x in range(n):
+            if x % 2:
+                controller.getPosition()
+            else:
+                controller.setPosition((x*8) & 0xFF, 150, 150)
+    t_wall = gripper_protocol.monotonic()
+    t_cpu = cpu_time()
+    if options['profile']:
+        import cProfile
+        import pstats
+        profiler = cProfile.Profile()
+        profiler.runcall(run)
+    else:
+        run()
+    cpu = cpu_time()-t_cpu
+    wall = gripper_protocol.monotonic()-t_wall
+    print("%d transactions: %.1f us CPU, %.1f us wall per transaction" % (n, 1e6*cpu/n, 1e6*wall/n))
+    print("Replayed %d transactions (%d without a captured reply)" % (port.transactions, port.unknown))
+    if options['profile']:
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
+
+def main():
+    options, args = parse_options(sys.argv[1:], OPTIONS)
+    if not args:
+        print("usage: python gripper_replay.py capture_file [name=value ...]")
+        return
+    benchmark(args[0], options)
+
+if __name__=='__main__':
+    main()
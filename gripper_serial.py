@@ -0,0 +1,105 @@
+# Serial transactions shared by the gripper scripts
+
+# Every transaction writes one request frame and reads the exact reply
+# length, so nothing waits on readline() for a newline the gripper never
+# sends.
+
+import time
+import gripper_protocol
+
+def flush_input(gripper):
+    # Discard any unread bytes (pyserial 3 and 2 names)
+    try:
+        gripper.reset_input_buffer()
+    except AttributeError:
+        gripper.flushInput()
+
+def transact(gripper, request, reply_len):
+    # Write request and read exactly reply_len bytes (fewer on timeout)
+    gripper.write(request)
+    return gripper.read(reply_len)
+
+def read_state(gripper, slave_id=gripper_protocol.SLAVE_ID):
+    # Read and decode the full status block
+    # Outputs:
+        # state: gripper_protocol.gripper_state
+    data = transact(gripper, gripper_protocol.frames(slave_id).read_status,
+        gripper_protocol.STATUS_REPLY_LEN)
+    return gripper_protocol.decode_status(data, slave_id, gripper_protocol.monotonic())
+
+def is_active(state):
+    # True if activation has completed
+    return state.gACT == 1 and state.gSTA == 3
+
+def wait_for(read_state, done, timeout, interval=0.005, max_interval=0.1, first_wait=0.0):
+    # Poll read_state() until done(state) is true
+    # Inputs:
+        # read_state: function returning a gripper_protocol.gripper_state
+        # done: function of a gripper_state returning True when finished
+        # timeout: seconds to wait
+        # interval, max_interval: first and longest pause between polls;
+            # the pause grows by half each poll, so short waits end quickly
+            # and long ones do not flood the bus (0 polls back to back)
+        # first_wait: pause before the first poll, e.g. most of an
+            # expected travel time
+    # Outputs:
+        # [finished, state]: whether done(state) became true before the timeout,
+            # and the last gripper_state read (None if there was no valid reply)
+    monotonic = gripper_protocol.monotonic
+    t_end = monotonic()+timeout
+    state = None
+    if first_wait > 0:
+        time.sleep(min(first_wait, timeout))
+    while True:
+        try:
+            state = read_state()
+            if done(state):
+                return [True, state]
+        except gripper_protocol.protocol_error:
+            pass # short or corrupted reply, try again
+        if monotonic() >= t_end:
+            return [False, state]
+        if interval > 0:
+            time.sleep(interval)
+            interval = min(interval*1.5, max_interval)
+
+def wait_for_state(gripper, done, timeout, slave_id=gripper_protocol.SLAVE_ID,
+        interval=0.005, max_interval=0.1):
+    # wait_for() reading the status block straight from the serial port
+    return wait_for(lambda: read_state(gripper, slave_id), done, timeout,
+        interval, max_interval)
+
+def activate(gripper, gripper_connected, timeout=10, slave_id=gripper_protocol.SLAVE_ID):
+    # This function activates the gripper, unless it already is active
+    # Inputs:
+        # gripper: gripper serial communication
+        # gripper_connected: boolean checking that connection was successful
+        # timeout: seconds to wait for activation to complete
+        # slave_id: modbus slave ID of the gripper
+    # Outputs:
+        # gripper_activated: boolean stating whether activation was successful or not
+    if not gripper_connected:
+        return False
+    frames = gripper_protocol.frames(slave_id)
+    t_start = gripper_protocol.monotonic()
+    flush_input(gripper)
+    try:
+        state = read_state(gripper, slave_id)
+        if is_active(state) and state.fault == 0:
+            print("Gripper already activated.")
+            return True
+    except gripper_protocol.protocol_error:
+        flush_input(gripper) # no valid reply: activate anyway
+
+    print("Activating gripper...")
+    transact(gripper, frames.clear_activation, gripper_protocol.WRITE_ACK_LEN) # clear rAct
+    transact(gripper, frames.activate, gripper_protocol.WRITE_ACK_LEN) # activate
+
+    # Wait until activation has completed
+    gripper_activated, state = wait_for_state(gripper, is_active, timeout, slave_id,
+        interval=0.02, max_interval=0.2)
+    if gripper_activated:
+        print("Gripper activated in %.2f s!" % (gripper_protocol.monotonic()-t_start))
+    else:
+        print("Activation timed out.")
+    return gripper_activated
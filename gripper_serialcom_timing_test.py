@@ -1,60 +1,63 @@
 # Robotiq 2-Finger Gripper Timing Test Script
 
-# This script tests command send and read data execution times
-# and saves the results as .csv files
-# Four files are saved:
-    # rand_cmd.csv: 20 data points for random position, speed, and force commands
-    # rand_cmd_pos.csv: 20 data points for random position, fixed speed and force commands
-    # inc_cmd.csv: large number of data points for incrementally specified position at the same speed and force
-    # inc_read.csv: large number of data points for reading position and current (includes position and current data)
-        # 1st row: timing data
-        # 2nd row: position data
-        # 3rd row: current data
+# Latency benchmark harness for serial communication with the gripper.
+# Runs against a real comm port or an in-process gripper_simulator.py, and
+# saves every sample plus summary statistics (p50/p90/p99/max, histogram)
+# as JSON so runs can be compared across driver versions.
+# Scenarios (run in this order, select with scenarios=...):
+    # command: setPos latency for random position, speed and force commands
+    # read: readPosCurrent latency
+    # mixed: alternating setPos/readPosCurrent at a target rate (rate=...),
+        # including how late each transaction started against its schedule
+    # throughput: back-to-back setPos/readPosCurrent for duration seconds,
+        # reporting sustained transactions per second
+    # transport: per-call cost of the Robot Raconteur service on each of
+        # the transports option, hosted in this process (not run by default)
+# NOTE: This script accepts a single argument as the communication port
+# (a COM port number, a device name such as /dev/ttyUSB0, or sim to start
+# a simulated gripper). If a port is not provided, the default value will
+# be used. Further options are name=value arguments (see OPTIONS below),
+# e.g. "python gripper_serialcom_timing_test.py sim samples=1000 output=new.json compare=old.json"
+# capture=file logs all serial traffic of the run; replay=file runs the
+# scenarios on such a log with no wire time, measuring driver CPU cost only
+# (see gripper_replay.py; use interval=0 and leave out the mixed scenario).
 import serial
 import time
-import binascii
 import sys
+import json
+import platform
 import random
-import csv
+import gripper_protocol
+from gripper_serial import activate
+import gripper_poller
+import gripper_replay
+from gripper_options import parse_options, is_port, port_name
 
-def activate(gripper,gripper_connected):
-    # This function activates the gripper and moves the gripper to an
-    # open position.
-    # Inputs:
-        # gripper: gripper serial communication
-        # gripper_connected: boolean checking that connection was successful
-        #
-    # Outputs:
-        # gripper_activated: boolean stating whether activation was successful or not
+FRAMES = gripper_protocol.frames() # constant request frames
+COMMANDS = gripper_protocol.command_builder() # setPos frame buffer
 
-        
-    if gripper_connected:
-        print("Activating gripper...")
-        gripper.write(bytearray.fromhex("091003E80003060000000000007330")) # clear rAct
-        time.sleep(0.01)
-        gripper.write(bytearray.fromhex("091003E800030601000000000072E1")) # activate
-        time.sleep(0.01)
-        data = gripper.readline() # read entire line to clear all data
-
-        # Wait until activation has completed
-        timeout = 10
-        gripper_activated = False
-        t_start = time.time()
-        t = time.time()-t_start
-        while (t<timeout)&(not gripper_activated):
-            gripper.write(bytearray.fromhex("090307D0000185CF")) # read data
-            data = binascii.hexlify(gripper.readline())
-            if int(data[6])==3:
-                gripper_activated = True
-                print("Gripper activated!")
-            time.sleep(0.5)
-            t = time.time()-t_start
-        if not gripper_activated:
-            print("Activation timed out.")
-        return gripper_activated
-    else:
-        gripper_activated = False
-        return gripper_activated
+# Options and their defaults; override with name=value arguments
+# scenarios: comma separated scenarios to run
+# samples: measured transactions per scenario (command, read, mixed)
+# warmup: untimed transactions before each scenario
+# interval: pause between transactions in the command and read scenarios (s)
+# rate: target transaction rate of the mixed scenario (Hz)
+# duration: length of the throughput scenario (s)
+# bins: histogram bins
+# output: JSON results file
+# compare: earlier JSON results file to compare against
+# label: free text stored with the results (e.g. driver version)
+# baud: baud rate (also used by the simulator)
+# capture: file to log all serial traffic to (gripper_replay.capture)
+# replay: capture file to run on instead of a port (gripper_replay.replay)
+# seed: random seed for the commanded values (-1 for a random run)
+# transports, tcp_port: Robot Raconteur transports of the transport scenario
+OPTIONS = {'scenarios': 'command,read,mixed,throughput', 'samples': 256, 'warmup': 20,
+    'interval': 0.01, 'rate': 50.0, 'duration': 5.0, 'bins': 20,
+    'output': 'timing_results.json', 'compare': '', 'label': '', 'baud': 115200,
+    'capture': '', 'replay': '', 'seed': -1, 'transports': 'tcp,local,intra', 'tcp_port': 6006}
+
+TRANSPORT_POLL_RATE = 100.0 # Hz, status polling of the transport scenario
 
 def readPosCurrent(gripper):
     # Read current gripper state
@@ -65,13 +68,12 @@ def readPosCurrent(gripper):
         # Note: position data is a fraction of 255, where 0 corresponds
             # to fully open and 255 corresponds to fully closed
             # Current is in mA
-    gripper.write(bytearray.fromhex("090307D00003040E"))
-    data = binascii.hexlify(gripper.read(11)) # read specific number of bytes for this message
+    gripper.write(FRAMES.read_status)
+    data = gripper.read(gripper_protocol.STATUS_REPLY_LEN) # read specific number of bytes for this message
     # NOTE: using readline() will be slow
     # gripper does not send newline command so readline() will wait until timeout
-    pos = int(data[14]+data[15],16)
-    current = 10*int(data[16]+data[17],16)
-    return [pos,current]
+    state = gripper_protocol.decode_status(data)
+    return [state.position,state.current]
     
 
 def setPos(gripper,pos,speed,force):
@@ -82,65 +84,230 @@ def setPos(gripper,pos,speed,force):
         # speed: speed as a fraction of 255 (0 is slowest setting, 255 is full speed)
         # force: force as a fraction of 255 (0 is lowest setting, 255 is max force)
     # Make sure values are between 0 and 255:
-    speed = round(speed)
-    force = round(force)
-    if speed<0:
-        speed = 0
-    elif speed>255:
-        speed = 255
-    if force<0:
-        force = 0
-    elif force>255:
-        force = 255
-    pos = int(pos)
-    speed = int(speed)
-    force = int(force)
-
-    command = "091003E8000306090000"+hex(pos)[2:].zfill(2) + hex(speed)[2:].zfill(2) + hex(force)[2:].zfill(2)
-    # Generate crc and add to the command message
-    crc = crc_comp(command)
-    command = command + crc[2]+crc[3]+crc[0]+crc[1]
-    gripper.write(bytearray.fromhex(command))
-    data = gripper.read(8)
-
-def crc_comp(data_str):
-    # Generate cyclic redundancy check for modbus RTU protocol
-    # Inputs:
-        # data_str: data message as a string (in hex)
+    pos = gripper_protocol.clamp_byte(pos)
+    speed = gripper_protocol.clamp_byte(speed)
+    force = gripper_protocol.clamp_byte(force)
+
+    # Build command frame (crc included) in the shared buffer
+    command = COMMANDS.set_position(pos,speed,force)
+    gripper.write(command)
+    data = gripper.read(gripper_protocol.WRITE_ACK_LEN)
+
+def percentile(sorted_times, p):
+    # Nearest-rank percentile of an already sorted list
+    if not sorted_times:
+        return 0.0
+    k = int(round(p/100.0*(len(sorted_times)-1)))
+    return sorted_times[k]
+
+def histogram(times, bins):
+    # Linear histogram between the smallest and largest sample
     # Outputs:
-        # crc: cyclic redundancy check as a string (in hex)
-        # NOTE: message must be re-arranged so that lowest byte is sent first
-    data = bytearray.fromhex(data_str)
-    crc = 0xFFFF
-    for pos in data:
-        crc ^= pos
-        for i in range(8):
-            if ((crc & 1) !=0):
-                crc >>=1
-                crc ^= 0xA001
-            else:
-                crc >>=1
-    return("%04X"%(crc))
+        # [edges, counts]: bins+1 bin edges (s) and bins counts (both
+            # empty without samples)
+    if not times:
+        return [[], []]
+    lo = min(times)
+    hi = max(times)
+    width = (hi-lo)/bins or 1e-9
+    counts = [0]*bins
+    for t in times:
+        counts[min(int((t-lo)/width), bins-1)] += 1
+    edges = [lo+i*width for i in range(bins+1)]
+    return [edges, counts]
+
+def summarize(times, bins):
+    # Summary statistics of a list of latencies (s); all 0 with an empty
+    # histogram when there are none (e.g. a mixed scenario with few samples)
+    s = sorted(times)
+    if not s:
+        return {'count': 0, 'mean': 0.0, 'min': 0.0, 'p50': 0.0, 'p90': 0.0, 'p99': 0.0,
+            'max': 0.0, 'histogram': {'edges': [], 'counts': []}, 'samples': times}
+    edges, counts = histogram(s, bins)
+    return {'count': len(s), 'mean': sum(s)/len(s), 'min': s[0],
+        'p50': percentile(s, 50), 'p90': percentile(s, 90), 'p99': percentile(s, 99),
+        'max': s[-1], 'histogram': {'edges': edges, 'counts': counts}, 'samples': times}
+
+def print_summary(name, summary):
+    if not summary['count']:
+        print("%-18s n=0" % name)
+        return
+    print("%-18s n=%-6d p50 %8.3f ms  p90 %8.3f ms  p99 %8.3f ms  max %8.3f ms" % (name,
+        summary['count'], 1e3*summary['p50'], 1e3*summary['p90'], 1e3*summary['p99'], 1e3*summary['max']))
+    counts = summary['histogram']['counts']
+    edges = summary['histogram']['edges']
+    peak = max(counts)
+    for i in range(len(counts)):
+        if counts[i]:
+            print("    %8.3f ms %6d %s" % (1e3*edges[i], counts[i], '#'*int(round(40.0*counts[i]/peak))))
+
+def timed(fn, *args):
+    # Timed with gripper_protocol.monotonic (CLOCK_MONOTONIC on Python 2
+    # POSIX, so a system time change during a run cannot skew samples)
+    # Outputs:
+        # [t, result]: duration of fn(*args) in seconds and its return value
+    t_start = gripper_protocol.monotonic()
+    result = fn(*args)
+    return [gripper_protocol.monotonic()-t_start, result]
+
+def warmup(gripper, n):
+    for x in range(n):
+        setPos(gripper, random.randint(0,255), 150, 150)
+        readPosCurrent(gripper)
+
+def command_scenario(gripper, options):
+    times = []
+    for x in range(options['samples']):
+        t, _ = timed(setPos, gripper, random.randint(0,255), random.randint(0,255), random.randint(0,255))
+        times.append(t)
+        time.sleep(options['interval'])
+    return {'setPos': times}
+
+def read_scenario(gripper, options):
+    times = []
+    for x in range(options['samples']):
+        t, _ = timed(readPosCurrent, gripper)
+        times.append(t)
+        time.sleep(options['interval'])
+    return {'readPosCurrent': times}
+
+def mixed_scenario(gripper, options):
+    # Alternate commands and reads on a fixed schedule at the target rate
+    monotonic = gripper_protocol.monotonic
+    period = 1.0/options['rate']
+    cmd_times = []
+    read_times = []
+    lateness = []
+    t_next = monotonic()
+    for x in range(options['samples']):
+        delay = t_next-monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        lateness.append(max(0.0, monotonic()-t_next))
+        if x % 2:
+            t, _ = timed(readPosCurrent, gripper)
+            read_times.append(t)
+        else:
+            t, _ = timed(setPos, gripper, (x*8) & 0xFF, 150, 150)
+            cmd_times.append(t)
+        t_next += period
+    return {'setPos': cmd_times, 'readPosCurrent': read_times, 'lateness': lateness}
+
+def throughput_scenario(gripper, options):
+    # Back-to-back transactions for the configured duration
+    monotonic = gripper_protocol.monotonic
+    times = []
+    t_start = monotonic()
+    t_end = t_start+options['duration']
+    x = 0
+    while monotonic() < t_end:
+        if x % 2:
+            t, _ = timed(readPosCurrent, gripper)
+        else:
+            t, _ = timed(setPos, gripper, (x*8) & 0xFF, 150, 150)
+        times.append(t)
+        x += 1
+    elapsed = monotonic()-t_start
+    print("throughput: %.1f transactions/s" % (len(times)/elapsed))
+    return {'transaction': times}
+
+def transport_scenario(gripper, options):
+    # Per-call cost of the gripper_2finger_RR service on each Robot
+    # Raconteur transport, against calling gripper_imp directly. The service
+    # is hosted in this process and polls the gripper, so getPosition and
+    # getState return the polled state and the repeated setPosition is
+    # suppressed: the calls measure the transport, not the serial line.
+    # NOTE: needs Robot Raconteur; shuts its node down when done,
+    # so run it last.
+    import RobotRaconteur as RR
+    import gripper_2finger_RR
+    controller = gripper_2finger_RR.gripper_imp(gripper, metrics=False)
+    controller.startPolling(TRANSPORT_POLL_RATE)
+    service = gripper_2finger_RR.gripper_service([controller], options['transports'], options['tcp_port'])
+    urls = service.start()['gripcon']
+    node = RR.RobotRaconteurNode.s
+    clients = [['direct', controller]]
+    for i in range(len(service.started)):
+        clients.append([service.started[i], node.ConnectService(urls[i])])
+    data = {}
+    try:
+        for name, client in clients:
+            client.setPosition(128, 150, 150)
+            time.sleep(0.1) # until a polled state shows the gripper following it
+            for x in range(options['warmup']):
+                client.getPosition()
+            get_times = []
+            set_times = []
+            state_times = []
+            for x in range(options['samples']):
+                get_times.append(timed(client.getPosition)[0])
+                set_times.append(timed(client.setPosition, 128, 150, 150)[0])
+                state_times.append(timed(client.getState)[0])
+            data[name+' getPosition'] = get_times
+            data[name+' setPosition'] = set_times
+            data[name+' getState'] = state_times
+    finally:
+        for name, client in clients[1:]:
+            node.DisconnectService(client)
+        controller.stopPolling()
+        service.stop()
+    return data
+
+SCENARIOS = {'command': command_scenario, 'read': read_scenario,
+    'mixed': mixed_scenario, 'throughput': throughput_scenario,
+    'transport': transport_scenario}
+
+def compare(results, old):
+    # Print p50/p99 changes against an earlier results file
+    print("Compared with "+old.get('label', '')+" ("+old.get('date', '')+"):")
+    if old.get('clock') != results['clock']:
+        print("NOTE: timed with %s, the earlier run with %s" % (results['clock'],
+            old.get('clock', 'an unrecorded clock')))
+    for scenario in results['scenarios']:
+        for name in results['scenarios'][scenario]:
+            try:
+                before = old['scenarios'][scenario][name]
+            except KeyError:
+                continue
+            after = results['scenarios'][scenario][name]
+            if not before['count'] or not after['count']:
+                print("%-10s %-15s n=%d -> %d" % (scenario, name, before['count'], after['count']))
+                continue
+            print("%-10s %-15s p50 %8.3f -> %8.3f ms  p99 %8.3f -> %8.3f ms" % (scenario, name,
+                1e3*before['p50'], 1e3*after['p50'], 1e3*before['p99'], 1e3*after['p99']))
 
 def main():
-    # Specify comm port:
+    # Specify comm port and options:
     comm_default = 3
-    if len(sys.argv)>1:
-        if sys.argv[1].isdigit():
-            print"Comm port specified: ",str(sys.argv[1])
-            comm_port = sys.argv[1]
-        else:
-            print"Default comm port used: ",str(comm_default)
-            comm_port = comm_default
+    options, args = parse_options(sys.argv[1:], OPTIONS)
+    if options['seed'] >= 0:
+        random.seed(options['seed'])
+    sim = None
+    if options['replay']:
+        print("Replaying "+options['replay'])
+        comm_port = options['replay']
+    elif len(args)>0 and args[0]=='sim':
+        import gripper_simulator
+        sim = gripper_simulator.simulator(baud=options['baud'], activation_time=0.1)
+        comm_port = sim.start()
+        print("Simulated gripper on "+comm_port)
+    elif len(args)>0 and is_port(args[0]):
+        print("Comm port specified: "+str(args[0]))
+        comm_port = args[0]
     else:
-        print"Default comm port used: ",str(comm_default)
+        print("Default comm port used: "+str(comm_default))
         comm_port = comm_default
 
     # Connect to gripper:
     print("Connecting to gripper...")
     try:
-        gripper = serial.Serial(port='COM'+str(comm_port),
-            baudrate=115200, bytesize=8,parity='N',stopbits=1,timeout=1)
+        if options['replay']:
+            gripper = gripper_replay.replay(options['replay'])
+        else:
+            gripper = serial.Serial(port=port_name(comm_port),
+                baudrate=options['baud'], bytesize=8,parity='N',stopbits=1,timeout=1)
+        if options['capture']:
+            gripper = gripper_replay.capture(gripper, options['capture'])
         gripper_connected = True
     except:
         print("Error connecting to gripper.")
@@ -152,81 +319,40 @@ def main():
 
     # Test Code
     if gripper_connected&gripper_activated:
+        results = {'label': options['label'], 'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'port': str(comm_port), 'simulated': sim is not None, 'replayed': bool(options['replay']),
+            'baud': options['baud'],
+            'python': platform.python_version(), 'clock': gripper_protocol.CLOCK,
+            'options': options, 'scenarios': {}}
+        if gripper_protocol.CLOCK == 'time':
+            print("WARNING: no monotonic clock available, samples use time.time()")
+        for scenario in options['scenarios'].split(','):
+            print("Starting "+scenario+" test...")
+            warmup(gripper, options['warmup'])
+            data = SCENARIOS[scenario](gripper, options)
+            results['scenarios'][scenario] = {}
+            for name in sorted(data):
+                summary = summarize(data[name], options['bins'])
+                results['scenarios'][scenario][name] = summary
+                print_summary(name, summary)
+
+        if 'read' in results['scenarios'] and not options['replay']:
+            # Polling/streaming rate for gripper_2finger_RR.py that leaves half
+            # of the bus time free for commands
+            poll_rate = gripper_poller.sustainable_rate(results['scenarios']['read']['readPosCurrent']['samples'])
+            print("Recommended poll_rate: %.0f Hz" % poll_rate)
 
-        # random spec timing test
-        print("Starting random command test...")
-        timing_dat = []
-        for x in range(20):
-            pos = random.randint(0,256)
-            speed = random.randint(0,256)
-            force = random.randint(0,256)
-            t_start = time.time()
-            setPos(gripper,pos,speed,force)
-            t = time.time()-t_start
-            timing_dat.append(t)
-            time.sleep(2)
-            print("Complete: "+str(x+1)+" of 20")
-
-        datafile = open('rand_cmd.csv','w+')
-        with datafile:
-            writer = csv.writer(datafile)
-            writer.writerow(timing_dat)
-        datafile.close()
-
-        # random position spec with fixed speed and force timing test
-        print("Starting random position only test...")
-        timing_dat = []
-        for x in range(20):
-            pos = random.randint(0,256)
-            t_start = time.time()
-            setPos(gripper,pos,150,150)
-            t = time.time()-t_start
-            timing_dat.append(t)
-            time.sleep(2)
-            print("Complete: "+str(x+1)+" of 20")
-
-        datafile = open('rand_cmd_pos.csv','w+')
-        with datafile:
-            writer = csv.writer(datafile)
-            writer.writerow(timing_dat)
-        datafile.close()
-            
-        # incremental spec timing test
-        print("Starting incremental tests...")
-        setPos(gripper,0,150,150)
-        timing_dat_cmd = []
-        timing_dat_read = []
-        time.sleep(5)
-        for x in range(256):
-            t_start = time.time()
-            setPos(gripper,x,150,150)
-            t = time.time()-t_start
-            timing_dat_cmd.append(t)
-            time.sleep(0.01)
-            
-            t_start = time.time()
-            readDat = readPosCurrent(gripper)
-            t = time.time()-t_start
-            timing_dat_read.append([t,readDat[0],readDat[1]])
-            time.sleep(0.01)
-
-        datafile = open('inc_cmd.csv','w+')
-        with datafile:
-            writer = csv.writer(datafile)
-            writer.writerow(timing_dat_cmd)
-        datafile.close()
-
-        datafile = open('inc_read.csv','w+')
-        with datafile:
-            writer = csv.writer(datafile)
-            writer.writerows(timing_dat_read)
-        datafile.close()
-            
-            
+        with open(options['output'],'w') as datafile:
+            json.dump(results, datafile, indent=1)
+        print("Results saved to "+options['output'])
+        if options['compare']:
+            with open(options['compare'],'r') as datafile:
+                compare(results, json.load(datafile))
         gripper.close()
     elif gripper_connected:
         gripper.close()
-    
+    if sim is not None:
+        sim.stop()
 
 if __name__=='__main__':
     main()
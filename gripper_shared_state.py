@@ -0,0 +1,228 @@
+# Shared-memory gripper state for processes on the same host
+
+# The service publishes every decoded state into a small fixed-layout
+# memory-mapped file, and local readers (vision, the arm controller, a
+# logger) map the same file and read the latest state with no RPC, no
+# serial traffic and no system call per read.
+# The state is guarded by a sequence lock: the writer makes the sequence
+# number odd, writes the fields, and makes it even again. A reader copies
+# the fields between two reads of the sequence number and retries if it
+# was odd or changed, so it always gets one consistent sample and never
+# blocks the writer. There is one writer per file (publishes are
+# serialised by a lock in the service); any number of readers.
+# File layout (little-endian):
+#   header (HEADER_SIZE bytes): magic 'GRSS', version, slave ID, state
+#     size, writer process ID, wall clock time the segment was created
+#   sequence number (uint64, 8-byte aligned)
+#   state: service monotonic time of the reply, wall clock time of the
+#     publish, samples published, online flag, gACT, gGTO, gSTA, gOBJ,
+#     fault, position_echo, position, current in mA, opening in mm, force in N
+# NOTE: on Linux put the file in /dev/shm so it is never written to disk,
+# e.g. shared_state=/dev/shm/gripper.state. Run this file to print the
+# state and time reads:
+#   python gripper_shared_state.py /dev/shm/gripper.state
+
+import os
+import sys
+import mmap
+import errno
+import time
+import struct
+import threading
+import gripper_protocol
+
+MAGIC = b'GRSS'
+VERSION = 1
+HEADER = struct.Struct('<4sBBHId')
+HEADER_SIZE = 64 # HEADER plus room for later fields
+SEQUENCE = struct.Struct('<Q')
+SEQUENCE_OFFSET = HEADER_SIZE
+STATE = struct.Struct('<ddQBBBBBBBBHdd')
+STATE_OFFSET = SEQUENCE_OFFSET+SEQUENCE.size
+SEGMENT_SIZE = STATE_OFFSET+STATE.size
+SPINS = 100 # failed reads before a reader yields to the writer
+
+class segment_busy(Exception):
+    # Raised when a reader finds an update that never finishes (the writer
+    # died mid-update)
+    pass
+
+class snapshot(object):
+    # One consistent sample read from a segment
+    #   gACT, gGTO, gSTA, gOBJ, fault, position_echo, position, current,
+    #   timestamp: as gripper_protocol.gripper_state (timestamp is on the
+    #     service's monotonic clock)
+    #   wall_time: time.time() at which the service published the sample
+    #   position_mm, force_n: calibrated opening and grip force
+    #   sequence: sequence number (grows by 2 per sample)
+    #   samples: samples published since the segment was created
+    #   online: 0 once the service has stopped publishing
+    __slots__ = ('gACT', 'gGTO', 'gSTA', 'gOBJ', 'fault', 'position_echo', 'position',
+        'current', 'timestamp', 'wall_time', 'position_mm', 'force_n', 'sequence',
+        'samples', 'online')
+
+    def age(self):
+        # Seconds since the sample was published
+        return time.time()-self.wall_time
+
+    def __repr__(self):
+        return ("snapshot(position=%d, position_echo=%d, current=%d, gOBJ=%d, fault=0x%02X, "
+            "sequence=%d, online=%d)" % (self.position, self.position_echo, self.current,
+            self.gOBJ, self.fault, self.sequence, self.online))
+
+class publisher:
+    # Writer side of a shared state segment
+    def __init__(self, path, slave_id=gripper_protocol.SLAVE_ID, calibration=None):
+        # Inputs:
+            # path: segment file; created if missing, and reused in place if
+                # it exists so that readers of a previous run stay attached
+            # slave_id: modbus slave ID stored in the header
+            # calibration: gripper_calibration.calibration for the mm and N
+                # fields (None publishes 0)
+        self.path = path
+        self.slave_id = slave_id
+        self._calibration = calibration
+        self._lock = threading.Lock() # one writer at a time
+        # sized through the file object, as in gripper_telemetry: os.ftruncate
+        # is missing from Python 2 on Windows
+        try:
+            f = open(path, 'r+b') # keep the contents
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            f = open(path, 'w+b')
+        with f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() != SEGMENT_SIZE:
+                f.truncate(SEGMENT_SIZE)
+            self._map = mmap.mmap(f.fileno(), SEGMENT_SIZE)
+        self._map[0:HEADER.size] = HEADER.pack(MAGIC, VERSION, slave_id, STATE.size,
+            os.getpid(), time.time())
+        # carry on from an existing sequence number, rounded up to even
+        self._sequence = (SEQUENCE.unpack_from(self._map, SEQUENCE_OFFSET)[0]+1) & ~1
+        SEQUENCE.pack_into(self._map, SEQUENCE_OFFSET, self._sequence)
+        self._last = None # republished as offline by close()
+        self.samples = 0
+
+    def publish(self, state, online=1):
+        # Publish a gripper_protocol.gripper_state (also usable as a poller listener)
+        cal = self._calibration
+        if cal is not None:
+            position_mm = cal.mm(state.position)
+            force_n = cal.newtons(state.current)
+        else:
+            position_mm = 0.0
+            force_n = 0.0
+        with self._lock:
+            m = self._map
+            if m is None:
+                return
+            self.samples += 1
+            sequence = self._sequence
+            SEQUENCE.pack_into(m, SEQUENCE_OFFSET, sequence+1) # odd: update in progress
+            STATE.pack_into(m, STATE_OFFSET, state.timestamp, time.time(), self.samples, online,
+                state.gACT, state.gGTO, state.gSTA, state.gOBJ, state.fault, state.position_echo,
+                state.position, state.current, position_mm, force_n)
+            SEQUENCE.pack_into(m, SEQUENCE_OFFSET, sequence+2)
+            self._sequence = sequence+2
+            self._last = state
+
+    def close(self):
+        # Mark the segment offline (keeping the last state) and unmap it.
+        # The file is left in place for readers.
+        with self._lock:
+            state = self._last
+        if state is not None:
+            self.publish(state, 0)
+        with self._lock:
+            m = self._map
+            self._map = None
+        if m is not None:
+            m.close()
+
+class reader:
+    # Reader side of a shared state segment
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) < SEGMENT_SIZE:
+            raise ValueError(path+" is not a gripper shared state segment")
+        magic, version, slave_id, state_size, pid, created = HEADER.unpack_from(self._map)
+        if magic != MAGIC or version != VERSION or state_size != STATE.size:
+            raise ValueError(path+" is not a version %d gripper shared state segment" % VERSION)
+        self.path = path
+        self.slave_id = slave_id
+        self.pid = pid
+        self.created = created
+        # counters
+        self.reads = 0
+        self.retries = 0 # reads repeated because the writer was updating
+
+    def sequence(self):
+        # Current sequence number: compare with snapshot.sequence to see if
+        # a new sample has been published without reading it
+        return SEQUENCE.unpack_from(self._map, SEQUENCE_OFFSET)[0]
+
+    def read(self, result=None, timeout=0.5):
+        # Latest consistent sample
+        # Inputs:
+            # result: optional snapshot to fill in instead of allocating one
+            # timeout: seconds the sequence number may stay on one odd value
+                # (an update that never finishes) before segment_busy
+        # Outputs:
+            # snapshot, or None if nothing has been published yet
+        m = self._map
+        unpack_sequence = SEQUENCE.unpack_from
+        spins = 0
+        while True:
+            sequence = unpack_sequence(m, SEQUENCE_OFFSET)[0]
+            if not sequence & 1:
+                values = STATE.unpack_from(m, STATE_OFFSET)
+                if unpack_sequence(m, SEQUENCE_OFFSET)[0] == sequence:
+                    break
+            self.retries += 1
+            spins += 1
+            if spins % SPINS == 0:
+                # the writer may have been preempted mid-update: let it run
+                time.sleep(0)
+                if spins == SPINS or sequence != stuck:
+                    stuck = sequence # still changing: the writer is alive
+                    t_stuck = gripper_protocol.monotonic()
+                elif gripper_protocol.monotonic()-t_stuck > timeout:
+                    raise segment_busy(self.path+" has been mid-update for %.1f s" % timeout)
+        self.reads += 1
+        if values[2] == 0:
+            return None
+        if result is None:
+            result = snapshot()
+        (result.timestamp, result.wall_time, result.samples, result.online, result.gACT,
+            result.gGTO, result.gSTA, result.gOBJ, result.fault, result.position_echo,
+            result.position, result.current, result.position_mm, result.force_n) = values
+        result.sequence = sequence
+        return result
+
+    def close(self):
+        self._map.close()
+
+def main():
+    if len(sys.argv) < 2:
+        print("usage: python gripper_shared_state.py segment_file [reads]")
+        return
+    r = reader(sys.argv[1])
+    print("Gripper %d, published by process %d" % (r.slave_id, r.pid))
+    state = r.read()
+    if state is None:
+        print("No state published yet")
+        return
+    print(state)
+    print("Age: %.3f s, samples: %d, %s" % (state.age(), state.samples,
+        "online" if state.online else "offline"))
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    t_start = gripper_protocol.monotonic()
+    for x in range(n):
+        r.read(state)
+    t = gripper_protocol.monotonic()-t_start
+    print("%d reads: %.2f us per read, %d retried" % (n, 1e6*t/n, r.retries))
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,266 @@
+# Robotiq 2-Finger Gripper Simulator
+
+# Software 2F-85 that answers Modbus RTU frames on a Linux pseudo-terminal,
+# so the driver scripts can run without hardware. It answers the same
+# frames as the real gripper (activation writes to 0x03E8, status reads
+# from 0x07D0, setPosition writes), models finger motion for the commanded
+# speed, stops on a simulated object, and delays each reply by the time the
+# request and reply would take on the wire at the chosen baud rate.
+# NOTE: This script accepts name=value options (see OPTIONS below) and
+# prints the pty to use as the comm port, e.g.
+#   python gripper_simulator.py object_at=180
+#   python gripper_test_script_serialcom.py /dev/pts/3
+
+import os
+import sys
+import tty
+import time
+import select
+import random
+import threading
+import gripper_protocol
+from gripper_options import parse_options
+
+# Options and their defaults; override with name=value arguments
+# baud: simulated baud rate (sets per-byte wire time)
+# slave_ids: comma separated slave IDs of the simulated grippers on the line
+# object_at: position (0-255) where closing fingers meet an object (-1 no object)
+# activation_time: seconds from rACT to activation complete
+# response_delay: gripper processing time per request in seconds
+# fault_rate: fraction of replies damaged on the wire (a flipped byte, a
+#   truncated or missing reply, or noise before the reply)
+OPTIONS = {'baud': 115200, 'slave_ids': '9', 'object_at': -1,
+    'activation_time': 1.0, 'response_delay': 0.0005, 'fault_rate': 0.0}
+
+class gripper_model:
+    # Register and finger state of one simulated gripper
+    def __init__(self, object_at=None, activation_time=1.0):
+        # Inputs:
+            # object_at: position where closing fingers meet an object (None for no object)
+            # activation_time: seconds from rACT to activation complete
+        self.object_at = object_at
+        self.activation_time = activation_time
+        # command registers
+        self.action = 0
+        self.rPR = 0
+        self.rSP = 0
+        self.rFR = 0
+        # status
+        self.gSTA = 0
+        self.gOBJ = 0
+        self.fault = 0
+        self.position = 0.0
+        self._t = None
+        self._activated_at = None
+
+    def write_registers(self, data, now):
+        # Apply a write of the 6 command register bytes
+        self.update(now)
+        previous = self.action
+        self.action, _, _, self.rPR, self.rSP, self.rFR = data
+        if not self.action & gripper_protocol.ACT_ACTIVATE:
+            # rACT cleared: reset
+            self.gSTA = 0
+            self.gOBJ = 0
+            self.fault = 0
+            self._activated_at = None
+        elif not previous & gripper_protocol.ACT_ACTIVATE:
+            self.gSTA = 1
+            self._activated_at = now+self.activation_time
+        if self.action & gripper_protocol.ACT_GOTO:
+            if self.gSTA == 3:
+                self.gOBJ = 0 # new motion
+            else:
+                self.fault = 0x05 # action delayed, activation must be completed first
+
+    def update(self, now):
+        # Advance activation and finger motion to time now
+        if self._t is None:
+            self._t = now
+        dt = now-self._t
+        self._t = now
+        if self.gSTA == 1 and now >= self._activated_at:
+            self.gSTA = 3
+            self.position = 0.0
+        if self.gSTA != 3 or not self.action & gripper_protocol.ACT_GOTO or self.gOBJ != 0:
+            return
+        target = float(self.rPR)
+        step = gripper_protocol.finger_speed(self.rSP)*dt # counts
+        if target > self.position:
+            position = min(self.position+step, target)
+            if self.object_at is not None and self.position < self.object_at <= position and self.object_at < target:
+                self.position = float(self.object_at)
+                self.gOBJ = 2 # object detected while closing
+                return
+        else:
+            position = max(self.position-step, target)
+        self.position = position
+        if position == target:
+            self.gOBJ = 3
+
+    def status_bytes(self, now):
+        # Outputs:
+            # the 6 status register bytes (gripper status, reserved, fault,
+            # position echo, position, current/10 mA)
+        self.update(now)
+        status = (self.action & (gripper_protocol.ACT_ACTIVATE | gripper_protocol.ACT_GOTO)) \
+            | (self.gSTA << 4) | (self.gOBJ << 6)
+        if self.gOBJ == 2:
+            current = 5+self.rFR//4 # holding an object: current follows force
+        elif self.gOBJ == 0 and self.gSTA == 3 and self.action & gripper_protocol.ACT_GOTO:
+            current = 8 # moving
+        else:
+            current = 0
+        return [status, 0, self.fault, self.rPR, int(round(self.position)), current]
+
+class simulator:
+    # Serves one or more gripper_models on a pseudo-terminal
+    def __init__(self, baud=115200, slave_ids=(gripper_protocol.SLAVE_ID,), object_at=None,
+            activation_time=1.0, response_delay=0.0005, fault_rate=0.0):
+        self.byte_time = 10.0/baud # start, 8 data and stop bits
+        self.response_delay = response_delay
+        self.fault_rate = fault_rate
+        self.models = {}
+        for slave_id in slave_ids:
+            self.models[slave_id] = gripper_model(object_at, activation_time)
+        self.port = None
+        self._master = None
+        self._slave = None
+        self._running = False
+        self._thread = None
+        self._bus_free = 0.0
+        # counters
+        self.requests = 0
+        self.replies = 0
+        self.crc_errors = 0
+        self.dropped_bytes = 0
+        self.faults = 0 # replies damaged on purpose
+
+    def start(self):
+        # Open the pty and start answering requests
+        # Outputs:
+            # port: device name to open as the gripper comm port
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave) # no echo or line editing before the driver opens it
+        self.port = os.ttyname(self._slave)
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="gripper_simulator")
+        self._thread.daemon = True
+        self._thread.start()
+        return self.port
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        # the slave end stays open until now so the master never sees a hangup
+        os.close(self._master)
+        os.close(self._slave)
+
+    def _run(self):
+        buf = bytearray()
+        while self._running:
+            ready, _, _ = select.select([self._master], [], [], 0.1)
+            if not ready:
+                continue
+            try:
+                buf += os.read(self._master, 1024)
+            except OSError:
+                continue
+            now = gripper_protocol.monotonic()
+            while buf:
+                n = self._frame_len(buf)
+                if n is None or len(buf) < n:
+                    break # wait for the rest of the frame
+                if n == 0 or gripper_protocol.crc16(buf, 0, n) != 0:
+                    # line noise or a corrupted frame: resync on the next byte
+                    if n:
+                        self.crc_errors += 1
+                    del buf[0]
+                    self.dropped_bytes += 1
+                    continue
+                frame = buf[:n]
+                del buf[:n]
+                self._handle(frame, now)
+
+    def _frame_len(self, buf):
+        # Length of the request frame at the start of buf
+        # (None if more bytes are needed, 0 if it cannot be a request)
+        if len(buf) < 2:
+            return None
+        if buf[1] == gripper_protocol.FC_READ:
+            return 8
+        if buf[1] == gripper_protocol.FC_WRITE:
+            if len(buf) < 7:
+                return None
+            return 9+buf[6]
+        return 0
+
+    def _handle(self, frame, now):
+        self.requests += 1
+        model = self.models.get(frame[0])
+        if model is None:
+            return # addressed to another slave on the line
+        register = (frame[2] << 8) | frame[3]
+        count = (frame[4] << 8) | frame[5]
+        # request on the wire, gripper processing, then the reply on the wire
+        t = max(now, self._bus_free)+len(frame)*self.byte_time+self.response_delay
+        if frame[1] == gripper_protocol.FC_WRITE and register == gripper_protocol.REG_OUTPUT \
+                and count == 3 and frame[6] == 6:
+            model.write_registers(frame[7:13], t)
+            reply = bytearray(frame[0:6])+bytearray(2)
+            gripper_protocol.append_crc(reply, 6)
+        elif frame[1] == gripper_protocol.FC_READ and register == gripper_protocol.REG_INPUT \
+                and 1 <= count <= 3:
+            data = model.status_bytes(t)[0:2*count]
+            reply = bytearray([frame[0], frame[1], 2*count])+bytearray(data)+bytearray(2)
+            gripper_protocol.append_crc(reply, 3+2*count)
+        else:
+            # modbus exception 0x02: illegal data address
+            reply = bytearray([frame[0], frame[1] | 0x80, 0x02, 0, 0])
+            gripper_protocol.append_crc(reply, 3)
+        if self.fault_rate > 0 and random.random() < self.fault_rate:
+            reply = self._damage(reply)
+        t += len(reply)*self.byte_time
+        self._bus_free = t
+        delay = t-gripper_protocol.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        if reply:
+            os.write(self._master, bytes(reply))
+        self.replies += 1
+
+    def _damage(self, reply):
+        # Line fault injection: one of the faults seen on a noisy RS-485 line
+        self.faults += 1
+        fault = random.randrange(4)
+        if fault == 0:
+            reply[random.randrange(len(reply))] ^= 1 << random.randrange(8) # flipped bit
+            return reply
+        if fault == 1:
+            return reply[0:random.randrange(1, len(reply))] # truncated
+        if fault == 2:
+            return bytearray() # lost
+        return bytearray([random.randrange(256) for i in range(random.randrange(1, 4))])+reply # noise first
+
+def main():
+    options, args = parse_options(sys.argv[1:], OPTIONS)
+    slave_ids = [int(x, 0) for x in options['slave_ids'].split(',')]
+    object_at = options['object_at'] if options['object_at'] >= 0 else None
+    sim = simulator(options['baud'], slave_ids, object_at,
+        options['activation_time'], options['response_delay'], options['fault_rate'])
+    port = sim.start()
+    print("Simulated gripper(s) "+options['slave_ids']+" at "+str(options['baud'])+" baud on "+port)
+    print("press Ctrl+C to quit...")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    sim.stop()
+    print("Requests: %d, replies: %d, crc errors: %d, damaged replies: %d" % (sim.requests,
+        sim.replies, sim.crc_errors, sim.faults))
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,224 @@
+# Telemetry recorder for the Robotiq 2-finger gripper
+
+# Records every state sample and command with its monotonic timestamp as
+# a fixed-size binary record in a preallocated ring buffer, so recording
+# allocates nothing and holds a lock only for one struct.pack_into. A
+# background thread copies new records out of the ring and appends them to
+# a memory-mapped log file, which grows in large chunks. If the flusher
+# falls more than a ring behind, the oldest unflushed records are
+# overwritten and counted as dropped instead of stalling the caller.
+# Log file layout (little-endian):
+#   header (HEADER_SIZE bytes): magic 'GRTL', version, slave ID, record
+#     size, wall clock and monotonic time at the start of the log, number
+#     of records, number of dropped records
+#   records (RECORD_SIZE bytes each): time (double), kind, status byte,
+#     fault, position, requested position, speed, force, current/10 mA
+# State records have speed and force 0; command records carry the
+# commanded position in 'request' and have the status fields 0.
+# NOTE: load() needs NumPy. Run this file to summarise a log:
+#   python gripper_telemetry.py gripper.tlm
+
+import sys
+import mmap
+import time
+import struct
+import threading
+import gripper_protocol
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAGIC = b'GRTL'
+VERSION = 1
+HEADER = struct.Struct('<4sBBHddQQ')
+HEADER_SIZE = 64 # HEADER plus room for later fields
+RECORD = struct.Struct('<dBBBBBBBB')
+RECORD_SIZE = RECORD.size # 16
+KIND_STATE = 0
+KIND_COMMAND = 1
+GROW_RECORDS = 1 << 18 # file growth step (4 MB)
+
+def status_byte(state):
+    # Gripper status register byte of a gripper_protocol.gripper_state
+    return state.gACT | (state.gGTO << 3) | (state.gSTA << 4) | (state.gOBJ << 6)
+
+class recorder:
+    # Ring buffer of telemetry records flushed to a log file
+    def __init__(self, path, slave_id=gripper_protocol.SLAVE_ID, capacity=65536, flush_interval=0.5):
+        # Inputs:
+            # path: log file to create (an existing file is replaced)
+            # slave_id: modbus slave ID stored in the header
+            # capacity: ring size in records; must hold at least one
+                # flush_interval of samples
+            # flush_interval: seconds between flushes to the file
+        self.path = path
+        self.slave_id = slave_id
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self._ring = bytearray(capacity*RECORD_SIZE)
+        self._copy = bytearray(capacity*RECORD_SIZE) # records being flushed
+        self._lock = threading.Lock()
+        self._written = 0 # records ever written to the ring
+        self._flushed = 0 # records ever taken out of the ring
+        self._file = None
+        self._map = None
+        self._running = False
+        self._thread = None
+        self._wall_time = 0.0
+        self._mono_time = 0.0
+        # counters
+        self.records = 0 # records in the file
+        self.dropped = 0 # overwritten before they were flushed
+        self.flushes = 0
+
+    def start(self):
+        # Create the log file and start the flusher thread
+        self._file = open(self.path, 'w+b')
+        self._wall_time = time.time()
+        self._mono_time = gripper_protocol.monotonic()
+        self._resize(HEADER_SIZE+GROW_RECORDS*RECORD_SIZE)
+        self._write_header()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="gripper_telemetry")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        # Flush everything, trim the file to its records and close it
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._file is None:
+            return
+        self.flush()
+        self._map.close()
+        self._map = None
+        self._file.truncate(HEADER_SIZE+self.records*RECORD_SIZE)
+        self._file.close()
+        self._file = None
+
+    def record_state(self, state):
+        # Record a gripper_protocol.gripper_state (also usable as a poller listener)
+        with self._lock:
+            RECORD.pack_into(self._ring, (self._written % self.capacity)*RECORD_SIZE,
+                state.timestamp, KIND_STATE, status_byte(state), state.fault,
+                state.position, state.position_echo, 0, 0, min(state.current//10, 255))
+            self._written += 1
+
+    def record_command(self, position, speed, force, timestamp=None):
+        # Record a setpoint acknowledged by the gripper (bytes 0-255)
+        if timestamp is None:
+            timestamp = gripper_protocol.monotonic()
+        with self._lock:
+            RECORD.pack_into(self._ring, (self._written % self.capacity)*RECORD_SIZE,
+                timestamp, KIND_COMMAND, 0, 0, 0, position, speed, force, 0)
+            self._written += 1
+
+    def flush(self):
+        # Append the records written since the last flush to the file
+        # (called by the flusher thread; the caller must not race it)
+        record_size = RECORD_SIZE
+        with self._lock:
+            start = self._flushed
+            end = self._written
+            if end-start > self.capacity:
+                self.dropped += end-start-self.capacity
+                start = end-self.capacity
+            first = start % self.capacity
+            n = end-start
+            # copy out while holding the lock (at most one ring, a memcpy)
+            if first+n <= self.capacity:
+                self._copy[0:n*record_size] = self._ring[first*record_size:(first+n)*record_size]
+            else:
+                split = self.capacity-first
+                self._copy[0:split*record_size] = self._ring[first*record_size:]
+                self._copy[split*record_size:n*record_size] = self._ring[0:(n-split)*record_size]
+            self._flushed = end
+        if n == 0:
+            return
+        offset = HEADER_SIZE+self.records*record_size
+        if offset+n*record_size > len(self._map):
+            self._resize(offset+max(n, GROW_RECORDS)*record_size)
+        self._map[offset:offset+n*record_size] = bytes(self._copy[0:n*record_size])
+        self.records += n
+        self.flushes += 1
+        self._write_header()
+
+    def _resize(self, size):
+        if self._map is not None:
+            self._map.close()
+        self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), size)
+
+    def _write_header(self):
+        self._map[0:HEADER.size] = HEADER.pack(MAGIC, VERSION, self.slave_id, RECORD_SIZE,
+            self._wall_time, self._mono_time, self.records, self.dropped)
+
+    def _run(self):
+        # time.sleep rather than Event.wait, as in gripper_poller
+        while self._running:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+def read_header(path):
+    # Outputs:
+        # header: dict with slave_id, record_size, wall_time, mono_time, records, dropped
+    with open(path, 'rb') as f:
+        data = f.read(HEADER_SIZE)
+    if len(data) < HEADER.size:
+        raise ValueError(path+" is not a gripper telemetry log")
+    magic, version, slave_id, record_size, wall_time, mono_time, records, dropped = \
+        HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(path+" is not a version %d gripper telemetry log" % VERSION)
+    return {'slave_id': slave_id, 'record_size': record_size, 'wall_time': wall_time,
+        'mono_time': mono_time, 'records': records, 'dropped': dropped}
+
+def load(path):
+    # Load a telemetry log into NumPy arrays
+    # Outputs:
+        # [header, state, command]: read_header() dict, and dicts of arrays
+            # for the state records (time, position, position_request,
+            # current in mA, fault, gACT, gGTO, gSTA, gOBJ) and the command
+            # records (time, position, speed, force)
+    if numpy is None:
+        raise ImportError("gripper_telemetry.load needs NumPy")
+    header = read_header(path)
+    dtype = numpy.dtype([('time', '<f8'), ('kind', 'u1'), ('status', 'u1'), ('fault', 'u1'),
+        ('position', 'u1'), ('request', 'u1'), ('speed', 'u1'), ('force', 'u1'), ('current', 'u1')])
+    # records are counted in the header; a log that was not closed may
+    # have a grown, partly unused file after them
+    with open(path, 'rb') as f:
+        f.seek(HEADER_SIZE)
+        records = numpy.fromfile(f, dtype=dtype, count=header['records'])
+    s = records[records['kind'] == KIND_STATE]
+    c = records[records['kind'] == KIND_COMMAND]
+    state = {'time': s['time'], 'position': s['position'], 'position_request': s['request'],
+        'current': s['current'].astype(numpy.uint16)*10, 'fault': s['fault'],
+        'gACT': s['status'] & 0x01, 'gGTO': (s['status'] >> 3) & 0x01,
+        'gSTA': (s['status'] >> 4) & 0x03, 'gOBJ': (s['status'] >> 6) & 0x03}
+    command = {'time': c['time'], 'position': c['request'], 'speed': c['speed'], 'force': c['force']}
+    return [header, state, command]
+
+def main():
+    if len(sys.argv) < 2:
+        print("usage: python gripper_telemetry.py log.tlm")
+        return
+    header = read_header(sys.argv[1])
+    print("Gripper %d log started %s" % (header['slave_id'],
+        time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(header['wall_time']))))
+    print("Records: %d, dropped: %d" % (header['records'], header['dropped']))
+    if numpy is not None and header['records']:
+        header, state, command = load(sys.argv[1])
+        times = numpy.concatenate([state['time'], command['time']])
+        duration = times.max()-times.min()
+        print("State samples: %d, commands: %d, over %.1f s" % (len(state['time']),
+            len(command['time']), duration))
+        if len(state['time']) > 1:
+            print("State sample rate: %.1f Hz" % ((len(state['time'])-1)/(state['time'][-1]-state['time'][0])))
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,231 @@
+# Fault-tolerant Modbus RTU transport for the Robotiq 2-finger gripper
+
+# Wraps the serial port and is used in its place (write, read, close), so
+# the bus, activation and scripts run on it unchanged. Each reply is
+# validated before it is returned: bytes before a plausible frame header
+# (slave ID and function code of the request) are skipped as line noise,
+# and a frame that fails its CRC is dropped and the search resumes at the
+# next byte. A frame has ended when the line has been silent for 3.5
+# character times (the Modbus RTU inter-frame gap; a fixed 1.75 ms above
+# 19200 baud, as the Modbus spec recommends), so a short reply is detected
+# within milliseconds rather than after the port's read timeout. A missing,
+# short or corrupted reply is retried a bounded number of times after the
+# line has gone quiet; writes are register writes of the same values, so
+# resending them is safe. If every attempt fails, read() returns no bytes,
+# like a serial timeout, and the caller's reply check reports the error.
+# A Modbus exception reply raises gripper_protocol.protocol_error at once.
+# With a failure_limit set (by gripper_watchdog), failed transactions are
+# counted per slave ID. A gripper with failure_limit failed transactions
+# in a row is taken offline: its calls raise link_down at once while the
+# other grippers keep using the line. An I/O error from the port, or every
+# slave ID on the line failing, takes the whole line down: from then on
+# every call raises link_down at once instead of waiting out timeouts on a
+# dead handle, until the watchdog has reopened the port. The watchdog's
+# thread is let through to recover the line and the offline grippers.
+
+import threading
+import gripper_protocol
+
+class link_down(Exception):
+    # Raised at once while the serial line is down and being reopened
+    pass
+
+class transport:
+    # Serial-like object validating and retrying Modbus RTU transactions
+    def __init__(self, port, retries=2, reply_timeout=0.02):
+        # Inputs:
+            # port: open serial.Serial (its timeout is set to the inter-frame gap)
+            # retries: extra attempts after a failed transaction
+            # reply_timeout: seconds the gripper may take to start replying,
+                # on top of the wire time of the request and reply
+        self.port = port
+        baudrate = getattr(port, 'baudrate', 115200)
+        self.char_time = 11.0/baudrate # Modbus counts 11 bits per character
+        if baudrate > 19200:
+            self.gap = 0.00175
+        else:
+            self.gap = 3.5*self.char_time
+        self.retries = retries
+        self.reply_timeout = reply_timeout
+        port.timeout = self.gap # reads return once the line has been quiet for a gap
+        self._request = None # set by write, retried by read
+        # counters
+        self.frames = 0 # valid replies returned
+        self.retried = 0 # transactions sent again
+        self.timeouts = 0 # no complete reply before the reply timeout
+        self.short_frames = 0 # replies ended by a gap before their full length
+        self.crc_errors = 0
+        self.resync_bytes = 0 # noise bytes skipped to find a frame header
+        self.exceptions = 0 # modbus exception replies
+        self.failures = 0 # transactions that failed every attempt
+        # link state (see gripper_watchdog)
+        self.failure_limit = 0 # failed transactions in a row that take a gripper offline (0 never)
+        self.slave_ids = [] # slave IDs on the line (empty: those seen failing)
+        self.slave_failures = {} # slave ID -> failed transactions in a row
+        self.offline = {} # slave ID -> why that gripper is offline
+        self.down = None # why the line is down, None while it is up
+        self.down_since = 0.0
+        self.link_failures = 0 # times the line was taken down
+        self.recovery_thread = None # the only thread let through while down or to an offline gripper
+
+    def write(self, data):
+        if (self.down is not None or self.offline) and threading.current_thread() is not self.recovery_thread:
+            self.check(bytearray(data[0:1])[0])
+        self._request = bytes(data)
+        try:
+            self.port.write(self._request)
+        except (IOError, OSError) as e: # serial.SerialException is an IOError
+            if not self.failure_limit:
+                raise
+            self._io_error(e)
+
+    def read(self, n):
+        # Validated reply of n bytes to the last request written (b'' on failure)
+        request = self._request
+        self._request = None
+        try:
+            if request is None:
+                return self.port.read(n)
+            for attempt in range(self.retries+1):
+                if attempt:
+                    self.retried += 1
+                    self._drain()
+                    self.port.write(request)
+                reply = self._read_frame(bytearray(request), n)
+                if reply is not None:
+                    if self.slave_failures:
+                        self.slave_failures.pop(bytearray(request[0:1])[0], None)
+                    return reply
+        except (IOError, OSError) as e:
+            if not self.failure_limit:
+                raise
+            self._io_error(e)
+        self.failures += 1
+        if self.failure_limit:
+            self._failed(bytearray(request[0:1])[0])
+        return b''
+
+    def take_down(self, reason):
+        # Mark the line down: calls fail with link_down until resume()
+        if self.down is None:
+            self.down_since = gripper_protocol.monotonic()
+            self.down = reason
+            self.link_failures += 1
+
+    def check(self, slave_id):
+        # Raise link_down if the line is down or gripper slave_id is offline
+        if self.down is not None:
+            raise link_down("Serial line down ("+self.down+"), reconnecting")
+        reason = self.offline.get(slave_id)
+        if reason is not None:
+            raise link_down("Gripper %d offline (%s), recovering" % (slave_id, reason))
+
+    def take_offline(self, slave_id, reason):
+        # Mark one gripper offline: its calls fail with link_down until
+        # bring_online(), while the other grippers keep using the line
+        self.offline[slave_id] = reason
+
+    def bring_online(self, slave_id):
+        self.slave_failures.pop(slave_id, None)
+        self.offline.pop(slave_id, None)
+
+    def reopen(self, port):
+        # (recovery thread) Replace the port with a newly opened one. Calls
+        # from other threads keep failing until resume().
+        self.port = port
+        port.timeout = self.gap
+        self.slave_failures.clear()
+
+    def resume(self):
+        # Let every caller use the line again (offline grippers stay offline)
+        self.down = None
+
+    def reset_input_buffer(self):
+        self._drain()
+
+    def flushInput(self):
+        self._drain()
+
+    def close(self):
+        self.port.close()
+
+    def stats(self):
+        # Outputs:
+            # [frames, retried, timeouts, short_frames, crc_errors, resync_bytes, exceptions, failures]
+        return [self.frames, self.retried, self.timeouts, self.short_frames, self.crc_errors,
+            self.resync_bytes, self.exceptions, self.failures]
+
+    def dump(self):
+        # Plain-text report of the error counters
+        return ("transport frames=%d retried=%d timeouts=%d short_frames=%d crc_errors=%d "
+            "resync_bytes=%d exceptions=%d failures=%d\n") % tuple(self.stats())
+
+    def _read_frame(self, request, n):
+        # Read until a valid n byte reply (or exception reply) to request;
+        # None if none arrives
+        slave_id = request[0]
+        function = request[1]
+        error_function = function | 0x80
+        monotonic = gripper_protocol.monotonic
+        deadline = monotonic()+self.reply_timeout+(len(request)+n)*self.char_time
+        buf = bytearray()
+        while True:
+            # skip line noise up to the next plausible frame header
+            i = 0
+            while i < len(buf) and not (buf[i] == slave_id and
+                    (i+1 == len(buf) or buf[i+1] == function or buf[i+1] == error_function)):
+                i += 1
+            if i:
+                del buf[0:i]
+                self.resync_bytes += i
+            need = n
+            if len(buf) >= 2 and buf[1] == error_function:
+                need = 5
+            if len(buf) >= need:
+                if gripper_protocol.crc16(buf, 0, need) == 0:
+                    if need == 5 and n != 5:
+                        self.exceptions += 1
+                        raise gripper_protocol.protocol_error(
+                            "Modbus exception 0x%02X from slave %d" % (buf[2], slave_id))
+                    self.frames += 1
+                    return bytes(buf[0:need])
+                self.crc_errors += 1
+                del buf[0]
+                self.resync_bytes += 1
+                continue
+            if monotonic() >= deadline:
+                self.timeouts += 1
+                return None
+            data = self.port.read(need-len(buf))
+            if data:
+                buf += bytearray(data)
+            elif buf:
+                self.short_frames += 1 # the line went quiet mid-frame
+                return None
+
+    def _failed(self, slave_id):
+        # Count a failed transaction: take the gripper offline at the
+        # failure limit, or the line down if every gripper on it is failing
+        limit = self.failure_limit
+        failures = self.slave_failures
+        failures[slave_id] = failures.get(slave_id, 0)+1
+        if failures[slave_id] < limit:
+            return
+        slave_ids = self.slave_ids or list(failures)
+        failing = [s for s in slave_ids if s in self.offline or failures.get(s, 0) >= limit]
+        if len(failing) == len(slave_ids):
+            self.take_down("%d failed transactions in a row" % failures[slave_id])
+        elif slave_id not in self.offline:
+            self.take_offline(slave_id, "%d failed transactions in a row" % failures[slave_id])
+
+    def _io_error(self, e):
+        # The port failed: take the line down for the watchdog to reopen it
+        self.take_down(str(e) or e.__class__.__name__)
+        raise link_down("Serial line down ("+self.down+"), reconnecting")
+
+    def _drain(self):
+        # Discard input until the line has been quiet for a gap (bounded)
+        monotonic = gripper_protocol.monotonic
+        t_end = monotonic()+self.reply_timeout
+        while self.port.read(256) and monotonic() < t_end:
+            pass
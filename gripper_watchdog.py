@@ -0,0 +1,193 @@
+# Serial line watchdog for the Robotiq 2-finger gripper service
+
+# Reopens the serial port of a gripper_bus when the line fails (e.g. the
+# USB-serial adapter drops), without restarting the service. The line's
+# gripper_transport takes it down on an I/O error from the port or when
+# every gripper on it has failed failure_limit transactions in a row; from
+# then on every call on the line fails at once with
+# gripper_transport.link_down. The watchdog thread notices, then tries to
+# reopen the port with exponential backoff. Once the port is open it
+# recovers each gripper on the line: activation is skipped if the status
+# register shows the gripper is still active, and the last acknowledged
+# setpoint is sent again. The line is handed back to the callers as soon
+# as one gripper has recovered; a gripper that did not is left offline.
+# A single gripper that stops answering is taken offline by the transport
+# without taking the line down: its calls fail at once while the others
+# carry on, and the watchdog retries it with the same backoff until it
+# recovers. The time from failure to recovery is recorded in a histogram.
+
+import time
+import threading
+import gripper_protocol
+import gripper_metrics
+
+class watchdog:
+    # Reconnects one serial line and recovers the grippers on it
+    def __init__(self, bus, open_port, controllers, failure_limit=3, check_interval=0.05,
+            min_backoff=0.1, max_backoff=5.0):
+        # Inputs:
+            # bus: gripper_bus.bus whose gripper is a gripper_transport.transport
+            # open_port: function returning a newly opened serial port
+            # controllers: gripper_imp objects on the line (recovered in order)
+            # failure_limit: failed transactions in a row that take a gripper
+                # offline (or the line down, once every gripper is failing)
+            # check_interval: seconds between checks of the line
+            # min_backoff, max_backoff: first and longest wait between reopen
+                # attempts (the wait doubles after each failed attempt)
+        self.bus = bus
+        self.transport = bus.gripper
+        self.open_port = open_port
+        self.controllers = list(controllers)
+        self.check_interval = check_interval
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.transport.failure_limit = failure_limit
+        self.transport.slave_ids = [c._slave_id for c in self.controllers]
+        bus.watchdog = self # for getConnectionStatus
+        self._running = False
+        self._thread = None
+        self._retry = {} # offline slave ID -> [time of the next attempt, backoff]
+        # counters
+        self.disconnects = 0
+        self.reconnects = 0
+        self.attempts = 0 # reopen attempts, failed ones included
+        self.failed_attempts = 0
+        self.gripper_failures = 0 # grippers taken offline on a line that stayed up
+        self.gripper_recoveries = 0 # offline grippers brought back
+        self.last_error = '' # why the last failed attempt failed
+        self.last_reconnect_time = 0.0
+        self.reconnect_times = gripper_metrics.histogram() # seconds from failure to recovery
+
+    def start(self):
+        # Start the watchdog thread
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="gripper_watchdog")
+        self._thread.daemon = True
+        self.transport.recovery_thread = self._thread
+        self._thread.start()
+
+    def stop(self):
+        # Stop the watchdog thread (giving up any reconnection in progress)
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.transport.recovery_thread = None
+
+    def online(self, slave_id=None):
+        # True while the line is up (and gripper slave_id, if given, is not offline)
+        return self.transport.down is None and slave_id not in self.transport.offline
+
+    def down_for(self):
+        # Seconds the line has been down (0 while it is up)
+        if self.transport.down is None:
+            return 0.0
+        return gripper_protocol.monotonic()-self.transport.down_since
+
+    def dump(self):
+        # Plain-text report of the reconnection counters and times (ms)
+        h = self.reconnect_times
+        text = ("link %s disconnects=%d reconnects=%d attempts=%d failed_attempts=%d "
+            "gripper_failures=%d gripper_recoveries=%d offline=%s\n") % (
+            "up" if self.online() else "down", self.disconnects, self.reconnects, self.attempts,
+            self.failed_attempts, self.gripper_failures, self.gripper_recoveries,
+            ",".join([str(s) for s in sorted(self.transport.offline)]) or "none")
+        n = h.samples()
+        if n:
+            text += "  reconnect    n=%d mean=%.3f max=%.3f\n" % (n, 1e3*h.sum/n, 1e3*h.max)
+        return text
+
+    def _run(self):
+        # time.sleep rather than Event.wait, as in gripper_poller
+        while self._running:
+            time.sleep(self.check_interval)
+            if self.transport.down is not None:
+                self._reconnect()
+            elif self.transport.offline:
+                self._retry_offline()
+
+    def _reconnect(self):
+        transport = self.transport
+        self.disconnects += 1
+        print("Serial line down ("+transport.down+"), reconnecting...")
+        backoff = self.min_backoff
+        while self._running:
+            self.attempts += 1
+            try:
+                transport.port.close() # release the device so it can be opened again
+            except (IOError, OSError):
+                pass
+            try:
+                transport.reopen(self.open_port())
+                if self._recover():
+                    break
+            except Exception as e:
+                # e.g. serial.SerialException while the adapter is unplugged,
+                # or link_down and protocol_error from a line still failing
+                self.last_error = str(e) or e.__class__.__name__
+            self.failed_attempts += 1
+            time.sleep(backoff)
+            backoff = min(2*backoff, self.max_backoff)
+        else:
+            return
+        t = gripper_protocol.monotonic()-transport.down_since
+        self.reconnect_times.record(t)
+        self.last_reconnect_time = t
+        self.reconnects += 1
+        transport.resume()
+        print("Serial line restored after %.2f s" % t)
+
+    def _recover(self):
+        # Reactivate the grippers if needed and restore their setpoints
+        # (this thread is the only one the transport lets through). A
+        # gripper that fails is left offline for _retry_offline.
+        # Outputs:
+            # recovered: False if no gripper on the line recovered
+        transport = self.transport
+        recovered = 0
+        for controller in self.controllers:
+            slave_id = controller._slave_id
+            if self._recover_gripper(controller):
+                transport.bring_online(slave_id)
+                self._retry.pop(slave_id, None)
+                recovered += 1
+            else:
+                transport.take_offline(slave_id, self.last_error)
+        return recovered > 0 or not self.controllers
+
+    def _retry_offline(self):
+        # Try to recover the offline grippers on a line that is up, each
+        # with its own exponential backoff
+        transport = self.transport
+        now = gripper_protocol.monotonic()
+        for controller in self.controllers:
+            slave_id = controller._slave_id
+            if slave_id not in transport.offline:
+                self._retry.pop(slave_id, None)
+                continue
+            retry = self._retry.get(slave_id)
+            if retry is None:
+                self.gripper_failures += 1
+                print("Gripper %d offline (%s), recovering..." % (slave_id, transport.offline[slave_id]))
+                retry = self._retry[slave_id] = [now, self.min_backoff]
+            if now < retry[0]:
+                continue
+            if self._recover_gripper(controller):
+                transport.bring_online(slave_id)
+                del self._retry[slave_id]
+                self.gripper_recoveries += 1
+                print("Gripper %d back online" % slave_id)
+            else:
+                retry[0] = gripper_protocol.monotonic()+retry[1]
+                retry[1] = min(2*retry[1], self.max_backoff)
+
+    def _recover_gripper(self, controller):
+        try:
+            if controller.recover():
+                return True
+            self.last_error = "gripper %d did not recover" % controller._slave_id
+        except Exception as e:
+            self.last_error = "gripper %d: %s" % (controller._slave_id, str(e) or e.__class__.__name__)
+        return False
@@ -0,0 +1,625 @@
+# Tests of the driver against gripper_simulator.py
+
+# Each test starts a simulated gripper on a pty in this process, so no
+# hardware is needed. Runs with either Python:
+#   python -m pytest test_gripper_simulator.py
+#   python -m unittest test_gripper_simulator
+# The gripper_imp tests need numpy and the gripper_async tests need
+# Python 3; each is skipped without it. Without Robot Raconteur the
+# gripper_imp tests use a stand-in for the node's NewStructure, the only
+# part of it gripper_imp uses outside a running service.
+
+import os
+import sys
+import types
+import random
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import serial
+import gripper_protocol
+import gripper_serial
+import gripper_simulator
+import gripper_transport
+import gripper_bus
+import gripper_commands
+import gripper_shared_state
+import gripper_watchdog
+import gripper_metrics
+
+class _structure(object):
+    pass
+
+class _node(object):
+    # Stand-in for RR.RobotRaconteurNode.s
+    def NewStructure(self, name):
+        return _structure()
+
+    def RegisterServiceType(self, definition):
+        pass
+
+try:
+    import RobotRaconteur as RR
+except ImportError:
+    RR = types.ModuleType('RobotRaconteur')
+    RR.RobotRaconteurNode = type('RobotRaconteurNode', (object,), {'s': _node()})
+    sys.modules['RobotRaconteur'] = RR
+try:
+    import numpy
+    import gripper_calibration
+    import gripper_telemetry
+    import gripper_2finger_RR
+except ImportError:
+    gripper_2finger_RR = None
+try:
+    import asyncio
+    import gripper_async
+except (ImportError, SyntaxError): # Python 2
+    gripper_async = None
+
+SLAVE_ID = gripper_protocol.SLAVE_ID
+
+def wait_until(condition, timeout=2.0):
+    # Poll condition() until it is true (False on timeout)
+    t_end = gripper_protocol.monotonic()+timeout
+    while not condition():
+        if gripper_protocol.monotonic() >= t_end:
+            return False
+        time.sleep(0.001)
+    return True
+
+@unittest.skipUnless(hasattr(os, 'openpty'), "the simulator needs a pseudo-terminal")
+class simulator_test(unittest.TestCase):
+    object_at = None
+
+    def setUp(self):
+        random.seed(1) # the simulator's fault injection
+        self.sim = gripper_simulator.simulator(object_at=self.object_at, activation_time=0.05)
+        port = self.sim.start()
+        self.port = serial.Serial(port=port, baudrate=115200, bytesize=8, parity='N',
+            stopbits=1, timeout=1)
+
+    def tearDown(self):
+        self.port.close()
+        self.sim.stop()
+
+    def activate(self, gripper=None):
+        self.assertTrue(gripper_serial.activate(gripper or self.port, True, timeout=2))
+
+class activation_test(simulator_test):
+    def test_activates(self):
+        self.activate()
+        state = gripper_serial.read_state(self.port)
+        self.assertTrue(gripper_serial.is_active(state))
+        self.assertEqual(state.fault, 0)
+
+    def test_already_active_is_not_reactivated(self):
+        self.activate()
+        model = self.sim.models[SLAVE_ID]
+        activated_at = model._activated_at
+        requests = self.sim.requests
+        self.activate()
+        self.assertEqual(self.sim.requests-requests, 1) # the status read only
+        self.assertEqual(model._activated_at, activated_at)
+        self.assertEqual(model.gSTA, 3)
+
+class round_trip_test(simulator_test):
+    def test_set_position_and_read_state(self):
+        self.activate()
+        commands = gripper_protocol.command_builder()
+        ack = gripper_serial.transact(self.port, commands.set_position(120, 255, 100),
+            gripper_protocol.WRITE_ACK_LEN)
+        gripper_protocol.check_write_ack(ack, SLAVE_ID)
+        finished, state = gripper_serial.wait_for_state(self.port,
+            lambda state: state.gOBJ == 3, 2.0)
+        self.assertTrue(finished)
+        self.assertEqual(state.position_echo, 120)
+        self.assertEqual(state.position, 120)
+
+    def test_trajectory_reports_positions_reached(self):
+        gripper = gripper_transport.transport(self.port)
+        self.activate(gripper)
+        commands = gripper_protocol.command_builder()
+        def send(position, speed, force):
+            gripper_protocol.check_write_ack(gripper_serial.transact(gripper,
+                commands.set_position(position, speed, force), gripper_protocol.WRITE_ACK_LEN))
+        positions = [40, 60, 80, 100, 110] # each reachable within 0.2 s
+        result = gripper_commands.execute_trajectory([0.0, 0.2, 0.4, 0.6, 0.8], positions,
+            [255]*5, [100]*5, send, lambda: gripper_serial.read_state(gripper).position)
+        self.assertEqual(result['position_reached'], positions)
+        self.assertEqual(result['deadline_misses'], 0)
+
+@unittest.skipIf(gripper_2finger_RR is None, "needs numpy")
+class gripper_imp_test(simulator_test):
+    object_at = 180
+
+    def setUp(self):
+        simulator_test.setUp(self)
+        RR.RobotRaconteurNode.s.RegisterServiceType(gripper_2finger_RR.service_definition())
+        self.gripper = gripper_2finger_RR.gripper_imp(gripper_transport.transport(self.port))
+        self.assertTrue(self.gripper.activate(timeout=2))
+        self._dir = None
+
+    def tearDown(self):
+        if self._dir is not None:
+            shutil.rmtree(self._dir)
+        simulator_test.tearDown(self)
+
+    def dir(self):
+        # Temporary directory, removed after the test
+        if self._dir is None:
+            self._dir = tempfile.mkdtemp()
+        return self._dir
+
+    def test_position_reached(self):
+        r = self.gripper.moveAndWait(100, 255, 150, 2.0)
+        self.assertEqual(r.outcome, 3)
+        self.assertEqual(r.position, 100)
+
+    def test_object_detected_while_closing(self):
+        r = self.gripper.grasp(255, 150, 2.0)
+        self.assertEqual(r.outcome, 2)
+        self.assertEqual(r.position, self.object_at)
+        self.assertTrue(r.current > 0)
+
+    def test_timeout_while_moving(self):
+        r = self.gripper.moveAndWait(250, 0, 150, 0.05) # the slowest speed
+        self.assertEqual(r.outcome, 0)
+        self.assertTrue(r.position < self.object_at)
+
+    def test_unacknowledged_set_position_raises(self):
+        self.gripper.setPosition(50, 255, 100)
+        del self.sim.models[SLAVE_ID] # the gripper stops answering
+        with self.assertRaises(gripper_protocol.protocol_error):
+            self.gripper.setPosition(60, 255, 100)
+        self.assertEqual(self.gripper._setpoint, (50, 255, 100)) # the last acknowledged
+
+    def test_concurrent_writers_record_the_last_write(self):
+        # the first write is acknowledged, then held in its bookkeeping while
+        # a second writer runs: the second must be recorded last
+        held = threading.Event()
+        class holding_recorder(object):
+            def __init__(self):
+                self.positions = []
+            def record_command(self, position, speed, force):
+                if position == 10:
+                    held.set()
+                    time.sleep(0.2)
+                self.positions.append(position)
+            def record_state(self, state):
+                pass
+        recorder = self.gripper._recorder = holding_recorder()
+        first = threading.Thread(target=self.gripper.setPositionForced, args=(10, 255, 100))
+        first.start()
+        self.assertTrue(held.wait(2))
+        self.gripper.setPositionForced(20, 255, 100)
+        first.join()
+        self.assertEqual(self.gripper.readState().position_echo, 20)
+        self.assertEqual(recorder.positions, [10, 20])
+        self.assertEqual(self.gripper._setpoint, (20, 255, 100))
+
+    def test_repeated_and_deadband_setpoints_are_suppressed(self):
+        g = self.gripper
+        g.setPosition(100, 255, 100)
+        requests = self.sim.requests
+        g.setPosition(100, 255, 100) # a repeat
+        g.setDeadband(3)
+        g.setPosition(102, 255, 100) # within the deadband
+        self.assertEqual(self.sim.requests, requests)
+        g.setPosition(102, 200, 100) # another speed
+        g.setPosition(110, 200, 100)
+        g.setPositionForced(110, 200, 100)
+        self.assertEqual(self.sim.requests-requests, 3)
+        c = g.getSuppressionCounters()
+        self.assertEqual((c.sent, c.duplicates, c.deadband), (4, 1, 1))
+        self.assertTrue(c.bus_time_saved > 0)
+        # a reset gripper is not following the last command: resend it
+        self.sim.models[SLAVE_ID] = gripper_simulator.gripper_model(self.object_at, 0.05)
+        self.assertEqual(g.readState().gSTA, 0)
+        requests = self.sim.requests
+        g.setPosition(110, 200, 100)
+        self.assertEqual(self.sim.requests-requests, 1)
+
+    def test_metrics_count_calls_and_time_phases(self):
+        g = self.gripper
+        g.resetMetrics()
+        g.setPosition(60, 255, 100)
+        g.getPosition()
+        g.getPosition()
+        metrics = g.getMetrics()
+        self.assertEqual(metrics['setPosition'].count, 1)
+        self.assertEqual(metrics['getPosition'].count, 2)
+        self.assertEqual(metrics['getPosition'].errors, 0)
+        total = metrics['setPosition'].phase_sum[gripper_metrics.TOTAL]
+        self.assertTrue(0 < total < 1.0)
+        self.assertEqual(sum(metrics['getPosition'].total), 2) # histogram samples
+        self.assertTrue('getPosition count=2' in g.getMetricsText())
+        g.enableMetrics(False)
+        g.getPosition()
+        g.enableMetrics(True)
+        self.assertEqual(g.getMetrics()['getPosition'].count, 2)
+
+    def test_telemetry_log_round_trip(self):
+        path = os.path.join(self.dir(), 'run.tlm')
+        g = self.gripper
+        g.startTelemetry(path)
+        g.setPosition(80, 200, 50)
+        self.assertTrue(wait_until(lambda: g.getPosition() == 80))
+        state = g.readState()
+        g.stopTelemetry()
+        header, states, commands = gripper_telemetry.load(path)
+        self.assertEqual(header['slave_id'], SLAVE_ID)
+        self.assertEqual(header['dropped'], 0)
+        self.assertEqual(commands['position'].tolist(), [80])
+        self.assertEqual((commands['speed'].tolist(), commands['force'].tolist()), ([200], [50]))
+        self.assertEqual(states['time'][-1], state.timestamp)
+        self.assertEqual(states['position'][-1], 80)
+        self.assertEqual(states['position_request'][-1], 80)
+        self.assertEqual(states['gSTA'][-1], 3)
+        self.assertEqual(states['current'][-1], state.current//10*10)
+        self.assertTrue(commands['time'][0] < states['time'][-1])
+
+    def test_shared_state_reader_sees_reads(self):
+        path = os.path.join(self.dir(), 'gripper.state')
+        g = self.gripper
+        g.startSharedState(path)
+        reader = gripper_shared_state.reader(path)
+        g.setPosition(70, 255, 100)
+        self.assertTrue(wait_until(lambda: g.getPosition() == 70))
+        snapshot = reader.read()
+        self.assertEqual((snapshot.position, snapshot.position_echo, snapshot.online), (70, 70, 1))
+        self.assertEqual(snapshot.position_mm, g._calibration.mm(70))
+        g.stopSharedState()
+        self.assertEqual(reader.read().online, 0)
+        reader.close()
+
+    def test_calibrated_units(self):
+        g = self.gripper
+        cal = g._calibration
+        g.setPositionMM(cal.mm(100)+0.1, 255, 100) # nearest count
+        self.assertEqual(g._setpoint, (100, 255, 100))
+        self.assertTrue(wait_until(lambda: g.getPosition() == 100))
+        self.assertEqual(g.getPositionMM(), cal.mm(100))
+        self.assertEqual(g.getForce(), cal.newtons(g.getCurrent()))
+        tables = g.getCalibration()
+        self.assertEqual(tables.position_mm[100], cal.mm(100))
+
+    def test_state_clients_start_and_stop_polling(self):
+        class endpoint(object):
+            # Stand-in for a wire connection or pipe endpoint
+            def __init__(self, n):
+                self.Endpoint = n
+                self.Index = 0
+                self.OutValue = None
+                self.packets = []
+            def SendPacket(self, s):
+                self.packets.append(s)
+        self.gripper.stream_rate = 100.0
+        wire = endpoint(1)
+        pipe = endpoint(2)
+        broadcaster = self.gripper._broadcaster
+        broadcaster.wireConnect(wire)
+        self.assertTrue(wait_until(lambda: wire.OutValue is not None))
+        broadcaster.pipeConnect(pipe)
+        self.assertTrue(wait_until(lambda: len(pipe.packets) > 1))
+        poller = self.gripper._poller
+        wire.WireConnectionClosedCallback(wire)
+        self.assertTrue(self.gripper._poller is poller) # the pipe is still connected
+        pipe.PipeEndpointClosedCallback(pipe)
+        self.assertTrue(self.gripper._poller is None)
+        self.assertFalse(poller.is_running())
+
+    def test_state_clients_leave_explicit_polling_running(self):
+        class endpoint(object):
+            Endpoint = 1
+            OutValue = None
+        self.gripper.startPolling(100.0)
+        wire = endpoint()
+        self.gripper._broadcaster.wireConnect(wire)
+        self.assertTrue(wait_until(lambda: wire.OutValue is not None))
+        wire.WireConnectionClosedCallback(wire)
+        self.assertTrue(self.gripper._poller.is_running())
+        self.gripper.stopPolling()
+
+@unittest.skipIf(gripper_2finger_RR is None, "needs numpy")
+class watchdog_test(simulator_test):
+    # Two grippers on one line, as with grippers=port:9,port:10
+    def setUp(self):
+        self.sim = gripper_simulator.simulator(slave_ids=(SLAVE_ID, SLAVE_ID+1), activation_time=0.05)
+        self.port = self.open_port()
+        bus = gripper_bus.bus(gripper_transport.transport(self.port, retries=1))
+        self.transport = bus.gripper
+        self.grippers = [gripper_2finger_RR.gripper_imp(bus, slave_id)
+            for slave_id in (SLAVE_ID, SLAVE_ID+1)]
+        for g in self.grippers:
+            self.assertTrue(g.activate(timeout=2))
+        self.watchdog = gripper_watchdog.watchdog(bus, self.open_port, self.grippers,
+            failure_limit=3, check_interval=0.01, min_backoff=0.05)
+        self.watchdog.start()
+
+    def open_port(self):
+        if self.sim.port is None:
+            self.sim.start()
+        return serial.Serial(port=self.sim.port, baudrate=115200, timeout=1)
+
+    def tearDown(self):
+        self.watchdog.stop()
+        self.transport.port.close()
+        self.sim.stop()
+
+    def fail_until_offline(self, g):
+        # Call g until the transport has taken it offline
+        # Outputs:
+            # calls: failed calls before the one that failed at once
+        for calls in range(10):
+            try:
+                g.readState()
+            except gripper_transport.link_down:
+                return calls
+            except gripper_protocol.protocol_error:
+                pass
+        self.fail("gripper %d was not taken offline" % g._slave_id)
+
+    def test_silent_gripper_goes_offline_and_recovers(self):
+        first, second = self.grippers
+        second.setPosition(150, 255, 100)
+        del self.sim.models[SLAVE_ID+1] # stops answering
+        self.assertEqual(self.fail_until_offline(second), 3)
+        t = gripper_protocol.monotonic()
+        with self.assertRaises(gripper_transport.link_down):
+            second.getPosition()
+        self.assertTrue(gripper_protocol.monotonic()-t < 0.01) # fails at once
+        # the other gripper keeps the line
+        first.setPosition(100, 255, 100)
+        self.assertEqual(first.readState().position_echo, 100)
+        self.assertTrue(self.watchdog.online())
+        self.assertFalse(self.watchdog.online(SLAVE_ID+1))
+        self.assertEqual(second.getConnectionStatus().online, 0)
+        self.assertEqual(first.getConnectionStatus().online, 1)
+        # back, powered off: reactivated with its setpoint restored
+        self.sim.models[SLAVE_ID+1] = gripper_simulator.gripper_model(None, 0.05)
+        self.assertTrue(wait_until(lambda: self.watchdog.online(SLAVE_ID+1), 5))
+        state = second.readState()
+        self.assertEqual((state.gSTA, state.position_echo), (3, 150))
+        self.assertEqual(self.watchdog.gripper_failures, 1)
+        self.assertEqual(self.watchdog.gripper_recoveries, 1)
+        self.assertEqual(self.watchdog.disconnects, 0)
+
+    def test_line_down_fails_polled_calls_until_reconnected(self):
+        first, second = self.grippers
+        first.startPolling(100)
+        self.assertTrue(wait_until(lambda: first.getStateAge() > 0))
+        models = dict(self.sim.models)
+        self.sim.models.clear() # every gripper silent: the line goes down
+        self.fail_until_offline(second)
+        self.assertTrue(wait_until(lambda: not self.watchdog.online(), 5))
+        with self.assertRaises(gripper_transport.link_down):
+            first.getPosition() # not the snapshot polled before
+        self.sim.models.update(models)
+        self.assertTrue(wait_until(lambda: self.watchdog.online(SLAVE_ID) and
+            self.watchdog.online(SLAVE_ID+1), 5))
+        self.assertEqual(self.watchdog.reconnects, 1)
+        self.assertEqual(first.getPosition(), 0)
+        first.stopPolling()
+
+@unittest.skipIf(gripper_2finger_RR is None, "needs numpy")
+class calibration_test(unittest.TestCase):
+    def test_nominal_conversions(self):
+        cal = gripper_calibration.calibration()
+        self.assertEqual(cal.mm(0), 85.0)
+        self.assertEqual(cal.mm(255), 0.0)
+        self.assertEqual(cal.newtons(500), 117.5)
+        self.assertEqual(cal.newtons(5000), 235.0) # beyond the table
+        for counts in (0, 1, 100, 254, 255):
+            self.assertEqual(cal.counts(cal.mm(counts)), counts)
+        self.assertEqual(cal.counts(-5.0), 255) # clamped to the stroke
+        self.assertEqual(cal.counts(90.0), 0)
+        openings = numpy.linspace(-1.0, 86.0, 200)
+        self.assertEqual(cal.to_counts(openings).tolist(), [cal.counts(mm) for mm in openings])
+        self.assertEqual(cal.to_mm([0, 255]).tolist(), [85.0, 0.0])
+
+    def test_fit_averages_noise_in_bins(self):
+        random.seed(2)
+        raw = [random.randint(0, 255) for i in range(2000)]
+        measured = [85.0-c/3.0+random.gauss(0, 0.5) for c in raw]
+        curve = gripper_calibration.fit_curve(raw, measured, 8)
+        self.assertEqual(len(curve[0]), 8)
+        for c, mm in zip(*curve):
+            self.assertAlmostEqual(mm, 85.0-c/3.0, delta=0.1)
+        cal = gripper_calibration.fit([raw, measured])
+        self.assertAlmostEqual(cal.mm(128), 85.0-128/3.0, delta=0.2)
+
+    def test_non_monotonic_curve_is_rejected(self):
+        with self.assertRaises(ValueError):
+            gripper_calibration.fit_curve([0, 100, 200, 255], [85, 50, 60, 0], 8)
+        with self.assertRaises(ValueError):
+            gripper_calibration.calibration([[0, 100, 255], [85.0, 85.0, 0.0]])
+        with self.assertRaises(ValueError):
+            gripper_calibration.calibration([[0, 0, 255], [85.0, 40.0, 0.0]])
+
+class shared_state_test(simulator_test):
+    def setUp(self):
+        simulator_test.setUp(self)
+        self.activate()
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'gripper.state')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        simulator_test.tearDown(self)
+
+    def test_reader_sees_published_states(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'x'*10) # left over, of the wrong size
+        publisher = gripper_shared_state.publisher(self.path)
+        reader = gripper_shared_state.reader(self.path)
+        self.assertEqual(reader.slave_id, SLAVE_ID)
+        self.assertTrue(reader.read() is None) # nothing published yet
+        state = gripper_serial.read_state(self.port)
+        publisher.publish(state)
+        snapshot = reader.read()
+        self.assertEqual(snapshot.samples, 1)
+        self.assertEqual(snapshot.online, 1)
+        self.assertEqual((snapshot.gSTA, snapshot.position, snapshot.timestamp),
+            (state.gSTA, state.position, state.timestamp))
+        sequence = snapshot.sequence
+        publisher.close()
+        snapshot = reader.read()
+        self.assertEqual(snapshot.online, 0) # the last state, marked offline
+        # a new publisher reuses the segment: the reader stays attached
+        publisher = gripper_shared_state.publisher(self.path)
+        publisher.publish(gripper_serial.read_state(self.port))
+        snapshot = reader.read()
+        self.assertEqual(snapshot.online, 1)
+        self.assertTrue(snapshot.sequence > sequence)
+        publisher.close()
+        reader.close()
+
+class transport_test(simulator_test):
+    def test_retries_damaged_replies(self):
+        gripper = gripper_transport.transport(self.port, retries=8)
+        self.activate(gripper)
+        self.sim.fault_rate = 0.3
+        frames = gripper.frames
+        for i in range(100):
+            state = gripper_serial.read_state(gripper)
+            self.assertTrue(gripper_serial.is_active(state))
+        self.assertTrue(self.sim.faults > 0)
+        self.assertTrue(gripper.retried > 0)
+        self.assertEqual(gripper.failures, 0)
+        self.assertEqual(gripper.frames-frames, 100)
+
+    def test_gives_up_without_replies(self):
+        gripper = gripper_transport.transport(self.port, retries=2)
+        reply = gripper_serial.transact(gripper, gripper_protocol.frames(SLAVE_ID+1).read_status,
+            gripper_protocol.STATUS_REPLY_LEN) # no gripper at that slave ID
+        self.assertEqual(reply, b'')
+        self.assertEqual(gripper.retried, 2)
+        self.assertEqual(gripper.failures, 1)
+
+class bus_test(simulator_test):
+    def setUp(self):
+        simulator_test.setUp(self)
+        self.activate()
+        self.bus = gripper_bus.bus(gripper_transport.transport(self.port))
+        self.frames = gripper_protocol.frames(SLAVE_ID)
+        self.commands = gripper_protocol.command_builder()
+
+    def queue(self, request, reply_len, priority, merge=False):
+        # Start a transaction on its own thread
+        # Outputs:
+            # [thread, result]: result receives reply and times once it is done
+        result = {'times': [None, None, None]}
+        def run():
+            result['reply'] = self.bus.transact(SLAVE_ID, request, reply_len, priority,
+                None, merge, result['times'])
+        thread = threading.Thread(target=run)
+        thread.start()
+        return [thread, result]
+
+    def test_commands_go_before_queued_reads(self):
+        self.bus.acquire(SLAVE_ID) # hold the line while the requests queue up
+        read, read_result = self.queue(self.frames.read_status,
+            gripper_protocol.STATUS_REPLY_LEN, gripper_bus.PRIORITY_READ)
+        self.assertTrue(wait_until(lambda: self.bus.queue_depth() == 1))
+        command, command_result = self.queue(self.commands.set_position(60, 255, 100),
+            gripper_protocol.WRITE_ACK_LEN, gripper_bus.PRIORITY_COMMAND)
+        self.assertTrue(wait_until(lambda: self.bus.queue_depth() == 2))
+        self.bus.release()
+        read.join()
+        command.join()
+        self.assertTrue(command_result['times'][1] < read_result['times'][1])
+        self.assertEqual(self.bus.preempted, 1)
+        gripper_protocol.check_write_ack(command_result['reply'], SLAVE_ID)
+        state = gripper_protocol.decode_status(read_result['reply'], SLAVE_ID, 0.0)
+        self.assertEqual(state.position_echo, 60) # the read saw the command
+
+    def test_identical_reads_merge(self):
+        self.bus.acquire(SLAVE_ID)
+        requests = self.sim.requests
+        first, first_result = self.queue(self.frames.read_status,
+            gripper_protocol.STATUS_REPLY_LEN, gripper_bus.PRIORITY_READ, True)
+        self.assertTrue(wait_until(lambda: self.bus.queue_depth() == 1))
+        second, second_result = self.queue(self.frames.read_status,
+            gripper_protocol.STATUS_REPLY_LEN, gripper_bus.PRIORITY_READ, True)
+        self.assertTrue(wait_until(lambda: self.bus.merged == 1))
+        self.bus.release()
+        first.join()
+        second.join()
+        self.assertEqual(self.sim.requests-requests, 1)
+        self.assertEqual(first_result['reply'], second_result['reply'])
+        self.assertEqual(second_result['times'], [None, None, None]) # no turn of its own
+        self.assertEqual(self.bus.queue_depth(), 0)
+
+@unittest.skipIf(gripper_async is None, "needs Python 3")
+class async_transport_test(simulator_test):
+    def test_late_reply_is_not_taken_for_the_next_request(self):
+        # no async def: this module also runs on Python 2
+        loop = asyncio.new_event_loop()
+        run = loop.run_until_complete
+        try:
+            transport = run(gripper_async.open_transport(self.sim.port, timeout=0.5))
+            gripper = gripper_async.async_gripper(transport)
+            self.assertTrue(run(gripper.activate(timeout=2)))
+            self.sim.response_delay = 0.03
+            with self.assertRaises(asyncio.TimeoutError):
+                run(gripper.get_state(timeout=0.01))
+            self.sim.response_delay = 0.0005
+            run(gripper.set_position(80, 255, 100)) # raises if given the late status reply
+            state = run(gripper.get_state())
+            self.assertEqual(state.position_echo, 80)
+            self.assertEqual(transport.drains, 1)
+            self.assertTrue(transport.stray_bytes > 0)
+            run(transport.close())
+        finally:
+            loop.close()
+
+    def test_cancelled_request_is_not_counted_and_drains(self):
+        loop = asyncio.new_event_loop()
+        run = loop.run_until_complete
+        try:
+            transport = run(gripper_async.open_transport(self.sim.port, timeout=0.5))
+            gripper = gripper_async.async_gripper(transport)
+            self.assertTrue(run(gripper.activate(timeout=2)))
+            transactions = transport.transactions
+            self.sim.response_delay = 0.03
+            with self.assertRaises(asyncio.TimeoutError):
+                run(asyncio.wait_for(gripper.get_state(), 0.01)) # cancels the transaction
+            self.sim.response_delay = 0.0005
+            run(gripper.set_position(80, 255, 100))
+            self.assertEqual(transport.cancelled, 1)
+            self.assertEqual(transport.timeouts, 0)
+            self.assertEqual(transport.drains, 1)
+            self.assertEqual(transport.transactions-transactions, 1) # the write only
+            run(transport.close())
+        finally:
+            loop.close()
+
+    @unittest.skipIf(gripper_2finger_RR is None, "needs numpy")
+    def test_gripper_imp_on_adapter(self):
+        # gripper_imp driving the gripper through async_serial_adapter, with
+        # the event loop on its own thread
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever)
+        thread.start()
+        try:
+            transport = asyncio.run_coroutine_threadsafe(
+                gripper_async.open_transport(self.sim.port, timeout=0.5), loop).result()
+            adapter = gripper_async.async_serial_adapter(transport, loop)
+            self.assertEqual(adapter.read(gripper_protocol.STATUS_REPLY_LEN), b'') # nothing written
+            gripper = gripper_2finger_RR.gripper_imp(adapter)
+            self.assertTrue(gripper.activate(timeout=2))
+            r = gripper.moveAndWait(90, 255, 100, 2.0)
+            self.assertEqual(r.outcome, 3)
+            self.assertEqual(gripper.getPosition(), 90)
+            self.assertEqual(gripper._setpoint, (90, 255, 100))
+            adapter.close()
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+
+if __name__=='__main__':
+    unittest.main()